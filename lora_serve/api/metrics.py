@@ -1,7 +1,11 @@
 # lora_serve/api/metrics.py
+import asyncio
+
 from fastapi import APIRouter, Response
 from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
+from ..core.metrics import EVENT_LOOP_LAG_MS
+
 metrics_router = APIRouter()
 
 @metrics_router.get("/metrics")
@@ -10,3 +14,11 @@ async def metrics():
     data = generate_latest()
     return Response(content=data, media_type=CONTENT_TYPE_LATEST)
 
+
+async def monitor_event_loop(interval_ms: int = 100):
+    """Sleep `interval_ms` in a loop and record how late each wakeup is (event-loop lag)."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval_ms / 1000)
+        EVENT_LOOP_LAG_MS.observe(max(0.0, (loop.time() - start) * 1000 - interval_ms))
@@ -0,0 +1,191 @@
+# OpenAI-compatible endpoints over the same router as /v1/generate
+import asyncio
+import json
+import time
+import uuid
+from contextlib import aclosing
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException
+from sse_starlette.sse import EventSourceResponse
+
+from ..core import tracing
+from ..core.config import settings
+from ..core.metrics import REQUESTS_TOTAL, REQUEST_LATENCY_MS
+from ..core.types import GenerateRequest, GenerateResult
+from ..decoding.tokenize import TokenizerPool
+from .routes import _before_deadline, _router
+from .schemas import (ChatChoice, ChatChoiceMessage, ChatCompletionIn, ChatCompletionOut, ChatMessage,
+                      CompletionChoice, CompletionIn, CompletionOut, Usage)
+
+openai_router = APIRouter()
+
+
+@openai_router.get("/models")
+async def list_models():
+    """The base model and every adapter under the adapter root (usable as `model`)."""
+    root = Path(settings.adapter_root)
+    adapters = sorted(p.name for p in root.iterdir() if p.is_dir()) if root.is_dir() else []
+    return {"object": "list",
+            "data": [{"id": m, "object": "model", "owned_by": "lora-serve"} for m in [settings.model_id, *adapters]]}
+
+
+@openai_router.post("/completions", response_model=CompletionOut)
+async def completions(body: CompletionIn):
+    prompts = [body.prompt] if isinstance(body.prompt, str) else body.prompt
+    if len(prompts) != 1:
+        raise HTTPException(400, "exactly one prompt per request is supported")
+    if body.stream and (body.best_of or 0) > body.n:
+        raise HTTPException(400, "best_of > n cannot be streamed")
+    req = await _request(body, prompts[0], body.max_tokens, best_of=body.best_of)
+    if body.stream:
+        return _stream(req, body, "completions")
+    res = await _submit(req, body, "completions")
+    return CompletionOut(id=f"cmpl-{uuid.uuid4().hex}", created=int(time.time()), model=_model_name(body.model),
+                         choices=[CompletionChoice(index=i, text=c.text, finish_reason=c.finish_reason)
+                                  for i, c in enumerate(res.choices or [res])],
+                         usage=_usage(res))
+
+
+@openai_router.post("/chat/completions", response_model=ChatCompletionOut)
+async def chat_completions(body: ChatCompletionIn):
+    if not body.messages:
+        raise HTTPException(400, "messages must not be empty")
+    # templating and tokenizing run on a tokenizer worker thread, not on the event loop
+    pool = await _chat_tokenizer()
+    prompt, prompt_ids = await pool.run(lambda tokenizer: _chat_encode(tokenizer, body.messages))
+    max_tokens = body.max_completion_tokens or body.max_tokens or settings.chat_max_tokens
+    req = await _request(body, prompt, max_tokens)
+    req.prompt_ids = prompt_ids
+    if body.stream:
+        return _stream(req, body, "chat_completions")
+    res = await _submit(req, body, "chat_completions")
+    return ChatCompletionOut(id=f"chatcmpl-{uuid.uuid4().hex}", created=int(time.time()), model=_model_name(body.model),
+                             choices=[ChatChoice(index=i, message=ChatChoiceMessage(content=c.text),
+                                                 finish_reason=c.finish_reason)
+                                      for i, c in enumerate(res.choices or [res])],
+                             usage=_usage(res))
+
+
+async def _request(body, prompt: str, max_tokens: int, best_of: Optional[int] = None) -> GenerateRequest:
+    if body.temperature < 0:
+        raise HTTPException(400, "temperature must be >= 0")
+    if not 1 <= body.n <= settings.max_choices or not body.n <= (best_of or body.n) <= settings.max_choices:
+        raise HTTPException(400, f"need 1 <= n <= best_of <= {settings.max_choices}")
+    adapter_id = None
+    if body.model and body.model not in (settings.model_id, "base"):
+        adapter_id = body.model
+        try:
+            await _router.resolve_path(adapter_id)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail=f"Model '{body.model}' not found")
+    stop = [body.stop] if isinstance(body.stop, str) else body.stop
+    return GenerateRequest(prompt=prompt, max_tokens=max_tokens, temperature=body.temperature, top_p=body.top_p,
+                           adapter_id=adapter_id, tenant_id=body.tenant_id or body.user, stream=body.stream,
+                           top_k=body.top_k, repetition_penalty=body.repetition_penalty, seed=body.seed,
+                           stop=stop or None, n=body.n, best_of=best_of)
+
+
+async def _submit(req: GenerateRequest, body, endpoint: str) -> GenerateResult:
+    start = time.time()
+    REQUESTS_TOTAL.labels(endpoint=endpoint, adapter_id=req.adapter_id or "base").inc()
+    with tracing.span(endpoint, adapter_id=req.adapter_id or "", tenant=req.tenant_id or "default", n=req.n):
+        try:
+            res = await asyncio.wait_for(_router.submit(req), settings.request_timeout_s or None)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Request timed out")
+    REQUEST_LATENCY_MS.labels(endpoint=endpoint).observe((time.time() - start) * 1000)
+    return res
+
+
+def _stream(req: GenerateRequest, body, endpoint: str) -> EventSourceResponse:
+    """SSE in OpenAI's chunk format: `data: {chunk}` lines, then `data: [DONE]`."""
+    chat = endpoint == "chat_completions"
+    base = {"id": f"{'chatcmpl' if chat else 'cmpl'}-{uuid.uuid4().hex}",
+            "object": "chat.completion.chunk" if chat else "text_completion",
+            "created": int(time.time()), "model": _model_name(body.model)}
+    include_usage = body.stream_options is not None and body.stream_options.include_usage
+    REQUESTS_TOTAL.labels(endpoint=endpoint, adapter_id=req.adapter_id or "base").inc()
+    start = time.time()
+
+    def chunk(index: int, text: Optional[str], finish_reason: Optional[str] = None, role: bool = False) -> dict:
+        if chat:
+            delta = {"role": "assistant", "content": ""} if role else {} if text is None else {"content": text}
+            choice = {"index": index, "delta": delta, "finish_reason": finish_reason}
+        else:
+            choice = {"index": index, "text": text or "", "logprobs": None, "finish_reason": finish_reason}
+        return {"data": json.dumps({**base, "choices": [choice]})}
+
+    async def event_gen():
+        results: List[GenerateResult] = []
+        if chat:
+            for i in range(req.n):
+                yield chunk(i, None, role=True)
+        with tracing.span(f"{endpoint}_stream", adapter_id=req.adapter_id or "", tenant=req.tenant_id or "default",
+                          n=req.n):
+            try:
+                async with aclosing(_router.stream_choices(req)) as chunks:
+                    async for index, text, result in _before_deadline(chunks, settings.request_timeout_s or None):
+                        if text:
+                            yield chunk(index, text)
+                        if result is not None:
+                            results.append(result)
+                            yield chunk(index, None, result.finish_reason)
+            except asyncio.TimeoutError:
+                yield {"event": "error", "data": "request timed out"}
+                return
+
+        if include_usage and results:
+            prompt, completion = results[0].prompt_tokens, sum(r.tokens for r in results)
+            usage = Usage(prompt_tokens=prompt, completion_tokens=completion, total_tokens=prompt + completion)
+            yield {"data": json.dumps({**base, "choices": [], "usage": usage.model_dump()})}
+        REQUEST_LATENCY_MS.labels(endpoint=endpoint).observe((time.time() - start) * 1000)
+        yield {"data": "[DONE]"}
+
+    return EventSourceResponse(event_gen())
+
+
+def _usage(res: GenerateResult) -> Usage:
+    # res.tokens counts every sampled continuation (best_of included)
+    return Usage(prompt_tokens=res.prompt_tokens, completion_tokens=res.tokens,
+                 total_tokens=res.prompt_tokens + res.tokens)
+
+
+def _model_name(model: Optional[str]) -> str:
+    return model or settings.model_id
+
+
+def _chat_encode(tokenizer, messages: List[ChatMessage]) -> Tuple[str, List[int]]:
+    prompt, templated = _chat_prompt(tokenizer, messages)
+    # a chat template already holds the special tokens (BOS etc.); do not add them twice
+    return prompt, tokenizer(prompt, add_special_tokens=not templated)["input_ids"]
+
+
+def _chat_prompt(tokenizer, messages: List[ChatMessage]) -> Tuple[str, bool]:
+    turns = []
+    for m in messages:
+        content = m.content
+        if isinstance(content, list):  # content parts: only text is supported
+            content = "".join(part.get("text", "") for part in content if part.get("type") == "text")
+        turns.append({"role": m.role, "content": content or ""})
+    if getattr(tokenizer, "chat_template", None):
+        return tokenizer.apply_chat_template(turns, tokenize=False, add_generation_prompt=True), True
+    # no template shipped with the model: plain "role: content" turns
+    return "".join(f"{t['role']}: {t['content']}\n" for t in turns) + "assistant:", False
+
+
+_chat_pool: Optional[TokenizerPool] = None
+_chat_pool_lock = asyncio.Lock()
+
+
+async def _chat_tokenizer() -> TokenizerPool:
+    # the router's pool; without one (LORASERVE_TOKENIZER_WORKERS=0) a single-thread pool of
+    # our own, loaded off the event loop on first use
+    global _chat_pool
+    if _router.tokenizer is not None:
+        return _router.tokenizer
+    async with _chat_pool_lock:
+        if _chat_pool is None:
+            _chat_pool = await asyncio.to_thread(TokenizerPool.from_pretrained, settings.model_id, workers=1)
+    return _chat_pool
@@ -1,27 +1,104 @@
 
 import asyncio
+import json
 import logging
+from contextlib import aclosing
 from sse_starlette.sse import EventSourceResponse
 import time
-from fastapi import APIRouter, Depends, HTTPException
+from collections import Counter
+from typing import AsyncIterator, Optional
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from sse_starlette.sse import EventSourceResponse
+from ..core import profiling, tracing
 from ..core.config import settings
 from ..core.types import GenerateRequest
 from ..core.adapters import LoRAAdapterManager
 from ..core.engines.hf_engine import HFEngine
-from ..core.metrics import REQUESTS_TOTAL, REQUEST_LATENCY_MS, TOKENS_GENERATED
+from ..core.engines.process_engine import start_engine_processes
+from ..core.router import RequestRouter
+from ..decoding.tokenize import TokenizerPool
+from ..storage.cache_store import ResponseCache
+from ..core.metrics import ADAPTER_PREFETCHES, REQUESTS_TOTAL, REQUEST_LATENCY_MS
 from ..scheduler.queue import TenantQueues
 from ..scheduler.batcher import DynamicBatcher
-from .schemas import GenerateIn, GenerateOut
+from ..scheduler.policies import WeightedFairPolicy
+from ..scheduler.warmer import AdapterWarmer
+from .schemas import GenerateBatchIn, GenerateIn, GenerateOut
 
 logger = logging.getLogger(__name__)
 api_router = APIRouter()
 
-_adapters = LoRAAdapterManager(base_dir=__import__("pathlib").Path(settings.adapter_root))
-_engine = HFEngine(model_id=settings.model_id, dtype=settings.dtype, device=settings.device)
-_queues = TenantQueues()
-_batcher = DynamicBatcher(_engine, _queues, _adapters, settings.max_batch_tokens, settings.max_wait_ms)
-asyncio.get_event_loop().create_task(_batcher.run_forever())
+_engine_kwargs = dict(model_id=settings.model_id, dtype=settings.dtype, device=settings.device,
+                      multi_lora=settings.multi_lora, kv_block_tokens=settings.kv_block_tokens,
+                      kv_capacity_blocks=settings.kv_capacity_blocks, prefix_cache_mb=settings.prefix_cache_mb,
+                      memory_budget_mb=settings.memory_budget_mb,
+                      spec_decode=settings.enable_spec_decode, spec_proposer=settings.spec_proposer,
+                      draft_model_id=settings.draft_model_id, spec_max_draft_tokens=settings.spec_max_draft_tokens)
+if settings.engine_workers > 1:
+    _engines = start_engine_processes(settings.engine_workers, _engine_kwargs, pin_threads=settings.engine_pin_threads,
+                                      share_weights=settings.engine_share_weights,
+                                      weights_dir=settings.engine_weights_dir)
+else:
+    _engines = [HFEngine(**_engine_kwargs)]
+
+# one adapter store / queue set / batcher / warmer per engine; the router spreads requests over them
+_batchers = []
+for _engine in _engines:
+    _adapters = LoRAAdapterManager(base_dir=__import__("pathlib").Path(settings.adapter_root), engine=_engine,
+                                   host_budget_mb=settings.adapter_host_budget_mb,
+                                   active_budget_mb=settings.adapter_active_budget_mb,
+                                   mmap_weights=settings.adapter_mmap, load_workers=settings.adapter_load_workers)
+    _queues = TenantQueues(policy=WeightedFairPolicy(settings.tenant_weights, settings.tenant_priorities,
+                                                      settings.tenant_max_concurrency))
+    _batcher = DynamicBatcher(_engine, _queues, _adapters, settings.max_batch_tokens, settings.max_wait_ms,
+                              max_staleness_ms=settings.adapter_max_staleness_ms,
+                              warm_adapters=settings.warm_adapters)
+    _warmer = AdapterWarmer(_queues, _adapters, interval_ms=settings.prefetch_interval_ms,
+                            top_k=settings.prefetch_top_k)
+    asyncio.get_event_loop().create_task(_batcher.run_forever())
+    asyncio.get_event_loop().create_task(_warmer.run_forever())
+    _batchers.append(_batcher)
+_tokenizer = None
+if settings.tokenizer_workers > 0:
+    _tokenizer = TokenizerPool.from_pretrained(settings.model_id, workers=settings.tokenizer_workers)
+_cache = None
+if settings.response_cache_mb > 0:
+    _cache = ResponseCache(settings.model_id, budget_mb=settings.response_cache_mb, ttl_s=settings.response_cache_ttl_s,
+                           disk_dir=settings.response_cache_dir, disk_budget_mb=settings.response_cache_disk_mb)
+_router = RequestRouter(_batchers, affinity_slack=settings.router_affinity_slack, tokenizer=_tokenizer,
+                        cache=_cache)
+
+
+@api_router.post("/adapters/{adapter_id}/prefetch")
+async def prefetch_adapter(adapter_id: str):
+    try:
+        tier = await _router.prefetch(adapter_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Adapter '{adapter_id}' not found")
+    ADAPTER_PREFETCHES.labels(source="api").inc()
+    return {"adapter_id": adapter_id, "tier": tier}
+
+
+@api_router.post("/admin/profile")
+async def capture_profile(seconds: float = 5.0, batches: int = 0, format: str = "chrome", interval_ms: float = 5.0):
+    """
+    Profile the live server for `seconds` (or until `batches` engine steps ran, if sooner):
+    torch profiler on the engines plus sampled event-loop stacks. format=chrome returns
+    a Chrome trace (chrome://tracing, Perfetto); format=folded the loop's collapsed stacks.
+    """
+    if format not in ("chrome", "folded"):
+        raise HTTPException(400, "format must be 'chrome' or 'folded'")
+    if profiling.active():
+        raise HTTPException(409, "A profile capture is already running")
+    seconds = min(seconds, settings.profile_max_seconds)
+    session = await profiling.ProfileSession(_batchers, interval_ms=max(interval_ms, 1.0)).run(seconds, batches)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    if format == "folded":
+        return Response(session.folded(), media_type="text/plain",
+                        headers={"Content-Disposition": f'attachment; filename="profile-{stamp}.folded"'})
+    return Response(json.dumps(session.chrome_trace()), media_type="application/json",
+                    headers={"Content-Disposition": f'attachment; filename="profile-{stamp}.json"'})
 
 
 @api_router.post("/generate", response_model=GenerateOut)
@@ -29,19 +106,67 @@ async def generate(body: GenerateIn):
     logger.debug("Received /generate request: %s", body.dict())
     start = time.time()
 
-    # validate adapter up front
-    if body.adapter_id:
+    # the router validates the adapter up front (and warms its host-memory copy); the batcher attaches it
+    req = GenerateRequest(**body.model_dump())
+    REQUESTS_TOTAL.labels(endpoint="generate", adapter_id=body.adapter_id or "base").inc()
+    with tracing.span("generate", adapter_id=body.adapter_id or "", tenant=body.tenant_id or "default",
+                      max_tokens=body.max_tokens):
         try:
-            path = await _adapters.resolve_path(body.adapter_id)  # existence check only
+            res = await asyncio.wait_for(_router.submit(req), settings.request_timeout_s or None)
         except FileNotFoundError:
             raise HTTPException(status_code=404, detail=f"Adapter '{body.adapter_id}' not found")
-        await _engine.attach_adapter(body.adapter_id, str(path))
-
-    req = GenerateRequest(**body.model_dump())
-    res = await _batcher.enqueue(req)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Request timed out")
+    REQUEST_LATENCY_MS.labels(endpoint="generate").observe((time.time() - start) * 1000)
     return GenerateOut(text=res.text, tokens=res.tokens)
 
 
+@api_router.post("/generate/batch")
+async def generate_batch(body: GenerateBatchIn):
+    """
+    Many prompts in one call, scheduled together. Results stream back as NDJSON in
+    completion order, one line per item: {"index", "text", "tokens", "prompt_tokens",
+    "finish_reason"}, or {"index", "error", "status"} if that item failed.
+    """
+    if not body.items:
+        raise HTTPException(400, "items must not be empty")
+    if len(body.items) > settings.bulk_max_items:
+        raise HTTPException(413, f"At most {settings.bulk_max_items} items per call")
+    for i, item in enumerate(body.items):
+        if item.temperature is not None and item.temperature < 0:
+            raise HTTPException(400, f"items[{i}]: temperature must be >= 0")
+    reqs = [GenerateRequest(**{**item.model_dump(), "stream": False}) for item in body.items]
+    for adapter_id, n in Counter(r.adapter_id or "base" for r in reqs).items():
+        REQUESTS_TOTAL.labels(endpoint="generate_batch", adapter_id=adapter_id).inc(n)
+    start = time.time()
+
+    async def lines():
+        pending = set(range(len(reqs)))
+        with tracing.span("generate_batch", items=len(reqs)):
+            try:
+                async with aclosing(_router.submit_many(reqs)) as results:
+                    async for i, out in _before_deadline(results, settings.request_timeout_s or None):
+                        pending.discard(i)
+                        REQUEST_LATENCY_MS.labels(endpoint="generate_batch").observe((time.time() - start) * 1000)
+                        yield _batch_line(i, reqs[i], out)
+            except asyncio.TimeoutError:
+                for i in sorted(pending):
+                    yield json.dumps({"index": i, "error": "Request timed out", "status": 504}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def _batch_line(index: int, req: GenerateRequest, out) -> str:
+    if isinstance(out, FileNotFoundError):
+        line = {"index": index, "error": f"Adapter '{req.adapter_id}' not found", "status": 404}
+    elif isinstance(out, BaseException):
+        line = {"index": index, "error": str(out) or type(out).__name__, "status": 500}
+    else:
+        line = {"index": index, "text": out.text, "tokens": out.tokens, "prompt_tokens": out.prompt_tokens,
+                "finish_reason": out.finish_reason}
+    return json.dumps(line) + "\n"
+
+
 @api_router.post("/generate/stream")
 async def generate_stream(body: GenerateIn):
     # 1) Validate quick things (adapter exists, ranges, etc.)
@@ -51,11 +176,9 @@ async def generate_stream(body: GenerateIn):
     adapter_id = body.adapter_id
     if adapter_id:
         try:
-            path = await _adapters.resolve_path(adapter_id)  # existence check only
+            await _router.resolve_path(adapter_id)  # existence check only
         except FileNotFoundError:
             raise HTTPException(status_code=404, detail=f"Adapter '{adapter_id}' not found")
-        # Attach now (single-request path; ok to do here)
-        await _engine.attach_adapter(adapter_id, str(path))
 
     req = GenerateRequest(
         prompt=body.prompt,
@@ -65,16 +188,49 @@ async def generate_stream(body: GenerateIn):
         adapter_id=adapter_id,
         tenant_id=body.tenant_id,
         stream=True,
+        top_k=body.top_k,
+        repetition_penalty=body.repetition_penalty,
+        seed=body.seed,
+        stop=body.stop,
     )
 
+    REQUESTS_TOTAL.labels(endpoint="stream", adapter_id=adapter_id or "base").inc()
+    start = time.time()
+
     async def event_gen():
         # Optional: initial hello
         yield {"event": "start", "data": ""}
 
-        async for chunk in _engine.stream_generate_single(req):
-            # OpenAI-style: each line is `data: <json>`
-            yield {"data": chunk}
+        # batched with every other request; chunks arrive as the engine steps. A client
+        # disconnect cancels this generator; closing the stream drops the request's row.
+        with tracing.span("generate_stream", adapter_id=adapter_id or "", tenant=body.tenant_id or "default",
+                          max_tokens=body.max_tokens):
+            try:
+                async with aclosing(_router.stream(req)) as chunks:
+                    async for chunk in _before_deadline(chunks, settings.request_timeout_s or None):
+                        # OpenAI-style: each line is `data: <json>`
+                        yield {"data": chunk}
+            except asyncio.TimeoutError:
+                yield {"event": "error", "data": "request timed out"}
+                return
 
+        REQUEST_LATENCY_MS.labels(endpoint="stream").observe((time.time() - start) * 1000)
         yield {"event": "end", "data": "[DONE]"}
 
     return EventSourceResponse(event_gen())
+
+
+async def _before_deadline(chunks: AsyncIterator, timeout: Optional[float]) -> AsyncIterator:
+    """
+    Yield from `chunks` until `timeout` seconds have passed in total, then raise
+    asyncio.TimeoutError (the pending step of `chunks` is cancelled).
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while True:
+        remaining = None if deadline is None else max(0.0, deadline - loop.time())
+        try:
+            chunk = await asyncio.wait_for(chunks.__anext__(), remaining)
+        except StopAsyncIteration:
+            return
+        yield chunk
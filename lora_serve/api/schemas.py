@@ -9,7 +9,96 @@ class GenerateIn(BaseModel):
     adapter_id: str | None = None
     tenant_id: str | None = None
     stream: bool = False
+    top_k: int = 0
+    repetition_penalty: float = 1.0
+    seed: int | None = None
+    stop: list[str] | None = None
 
 class GenerateOut(BaseModel):
     text: str
     tokens: int
+
+class GenerateBatchIn(BaseModel):
+    items: list[GenerateIn]  # per-item params and adapter; `stream` is ignored
+
+
+# ---- OpenAI-compatible API (/v1/completions, /v1/chat/completions) ----------
+# `model` is the base model id or an adapter id; top_k, repetition_penalty and
+# tenant_id are extensions. Unsupported OpenAI fields are ignored.
+
+class StreamOptions(BaseModel):
+    include_usage: bool = False
+
+class CompletionIn(BaseModel):
+    model: str | None = None
+    prompt: str | list[str]
+    max_tokens: int = 16
+    temperature: float = 1.0
+    top_p: float = 1.0
+    n: int = 1
+    best_of: int | None = None
+    stream: bool = False
+    stream_options: StreamOptions | None = None
+    stop: str | list[str] | None = None
+    seed: int | None = None
+    user: str | None = None
+    top_k: int = 0
+    repetition_penalty: float = 1.0
+    tenant_id: str | None = None
+
+class ChatMessage(BaseModel):
+    role: str
+    content: str | list[dict] | None = None
+
+class ChatCompletionIn(BaseModel):
+    model: str | None = None
+    messages: list[ChatMessage]
+    max_tokens: int | None = None
+    max_completion_tokens: int | None = None
+    temperature: float = 1.0
+    top_p: float = 1.0
+    n: int = 1
+    stream: bool = False
+    stream_options: StreamOptions | None = None
+    stop: str | list[str] | None = None
+    seed: int | None = None
+    user: str | None = None
+    top_k: int = 0
+    repetition_penalty: float = 1.0
+    tenant_id: str | None = None
+
+class Usage(BaseModel):
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+
+class CompletionChoice(BaseModel):
+    index: int
+    text: str
+    logprobs: None = None
+    finish_reason: str | None = None
+
+class CompletionOut(BaseModel):
+    id: str
+    object: str = "text_completion"
+    created: int
+    model: str
+    choices: list[CompletionChoice]
+    usage: Usage
+
+class ChatChoiceMessage(BaseModel):
+    role: str = "assistant"
+    content: str
+
+class ChatChoice(BaseModel):
+    index: int
+    message: ChatChoiceMessage
+    finish_reason: str | None = None
+
+class ChatCompletionOut(BaseModel):
+    id: str
+    object: str = "chat.completion"
+    created: int
+    model: str
+    choices: list[ChatChoice]
+    usage: Usage
@@ -3,13 +3,16 @@ import asyncio
 from fastapi import FastAPI
 from .core.config import settings
 from .core.logging import configure_logging
+from .core.tracing import setup_tracing, shutdown_tracing
 from .api.routes import api_router
+from .api.openai import openai_router
 # from .metrics.prometheus import metrics_app
-from .api.metrics import metrics_router
+from .api.metrics import metrics_router, monitor_event_loop
 
 def create_app() -> FastAPI:
     app = FastAPI(title="LoRAServe")
     app.include_router(api_router, prefix="/v1")
+    app.include_router(openai_router, prefix="/v1")
     app.include_router(metrics_router)
     # app.mount("/metrics", metrics_app)
     return app
@@ -20,4 +23,9 @@ app = create_app()
 async def on_startup():
     # TODO: warm up models if desired
     configure_logging(level=os.getenv("LORASERVE_LOGLEVEL", "INFO"))
-    await asyncio.sleep(0)
+    setup_tracing(settings.trace_endpoint, settings.trace_sample_ratio)
+    asyncio.get_running_loop().create_task(monitor_event_loop())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    shutdown_tracing()
@@ -1,14 +1,55 @@
 
 import asyncio
-from pathlib import Path
+import logging
+import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from .engines.multi_lora import LoRAWeights, load_lora_weights, lora_nbytes
+from ..storage.files import dir_digest, dir_stamp
+from .metrics import ADAPTER_CACHE_EVICTIONS, ADAPTER_CACHE_HITS, ADAPTER_CACHE_MISSES, ADAPTER_LOAD_MS, ADAPTER_TIER_BYTES
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _HostAdapter:
+    path: Path
+    config: dict
+    weights: LoRAWeights
+    nbytes: int
+
 
 class LoRAAdapterManager:
-    def __init__(self, base_dir: Path, max_loaded: int = 8):
-        self.base_dir = base_dir
-        self.max_loaded = max_loaded
-        self.loaded: OrderedDict[str, Path] = OrderedDict()
+    """
+    Tiered adapter store: disk -> host RAM (parsed tensors) -> active in the engine.
+
+    Host and active tiers are LRUs with byte budgets. Disk reads and parsing run in a
+    thread pool so they never block the event loop; concurrent requests for the same
+    adapter share one load. Evicting from the active tier detaches the adapter from the
+    engine, but never while running sequences still use it (see acquire/release).
+    Engines that read adapters themselves (`accepts_parsed_adapters = False`, e.g. a
+    worker process) only get the path, and the host tier keeps no tensors for them.
+    """
+
+    def __init__(self, base_dir: Path, engine=None, host_budget_mb: int = 2048, active_budget_mb: int = 512,
+                 mmap_weights: bool = False, load_workers: int = 2):
+        self.base_dir = Path(base_dir)
+        self.engine = engine
+        self.host_budget = host_budget_mb * 2**20
+        self.active_budget = active_budget_mb * 2**20
+        self.mmap_weights = mmap_weights
+        self._parse = getattr(engine, "accepts_parsed_adapters", True)
+        self.host: OrderedDict[str, _HostAdapter] = OrderedDict()
+        self.active: OrderedDict[str, int] = OrderedDict()  # adapter_id -> bytes
+        self._pins: Dict[str, int] = {}
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._digests: Dict[str, Tuple[tuple, str]] = {}  # adapter_id -> (dir stamp, sha256)
         self._lock = asyncio.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=load_workers, thread_name_prefix="adapter-load")
 
     async def resolve_path(self, adapter_id: str) -> Path:
         # existence-only; no cache mutation
@@ -18,14 +59,139 @@ class LoRAAdapterManager:
         return path
 
     async def ensure_loaded(self, adapter_id: str) -> Path:
+        """Bring `adapter_id` into the host tier; returns its path."""
+        return (await self._host_entry(adapter_id)).path
+
+    async def ensure_active(self, adapter_id: str) -> Path:
+        """Bring `adapter_id` into host memory and attach it to the engine."""
+        entry = await self._host_entry(adapter_id)
+        if self.engine is None:
+            return entry.path
         async with self._lock:
-            if adapter_id in self.loaded:
-                self.loaded.move_to_end(adapter_id)
-                return self.loaded[adapter_id]
-            path = self.base_dir / adapter_id
-            if not path.exists():
-                raise FileNotFoundError(path)
-            if len(self.loaded) >= self.max_loaded:
-                self.loaded.popitem(last=False)  # Evict LRU
-            self.loaded[adapter_id] = path
-            return path
+            if adapter_id in self.active:
+                self.active.move_to_end(adapter_id)
+                ADAPTER_CACHE_HITS.labels(tier="active").inc()
+                if not getattr(self.engine, "supports_mixed_adapters", False):
+                    # resident but maybe not selected: PEFT re-selects without reloading
+                    await self.engine.attach_adapter(adapter_id, str(entry.path))
+                return entry.path
+            ADAPTER_CACHE_MISSES.labels(tier="active").inc()
+            start = time.perf_counter()
+            parsed = (entry.config, entry.weights) if entry.weights else None
+            await self.engine.attach_adapter(adapter_id, str(entry.path), parsed)
+            ADAPTER_LOAD_MS.labels(tier="active").observe((time.perf_counter() - start) * 1000)
+            self.active[adapter_id] = entry.nbytes
+            await self._evict_active(keep=adapter_id)
+            self._publish()
+        return entry.path
+
+    async def prefetch(self, adapter_id: str) -> str:
+        """
+        Load ahead of need; returns the tier reached. Engines that mix adapters per row
+        get it attached too; single-adapter engines only get the host copy, since
+        attaching would switch the adapter under a running batch.
+        """
+        if getattr(self.engine, "supports_mixed_adapters", False):
+            await self.ensure_active(adapter_id)
+            return "active"
+        await self.ensure_loaded(adapter_id)
+        return "host"
+
+    async def content_hash(self, adapter_id: str) -> str:
+        """sha256 of the adapter's files; recomputed only when a file's size or mtime changes."""
+        path = await self.resolve_path(adapter_id)
+        loop = asyncio.get_running_loop()
+        stamp = await loop.run_in_executor(self._pool, dir_stamp, path)
+        cached = self._digests.get(adapter_id)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        digest = await loop.run_in_executor(self._pool, dir_digest, path)
+        self._digests[adapter_id] = (stamp, digest)
+        return digest
+
+    def is_cached(self, adapter_id: str) -> bool:
+        """Already in host memory or on its way there."""
+        return adapter_id in self.host or adapter_id in self._loading
+
+    def acquire(self, adapter_id: Optional[str]) -> None:
+        """Pin an adapter while a running sequence uses it (it will not be detached)."""
+        if adapter_id is not None:
+            self._pins[adapter_id] = self._pins.get(adapter_id, 0) + 1
+
+    def release(self, adapter_id: Optional[str]) -> None:
+        if adapter_id is None or adapter_id not in self._pins:
+            return
+        self._pins[adapter_id] -= 1
+        if not self._pins[adapter_id]:
+            del self._pins[adapter_id]
+
+    def stats(self):
+        return {
+            "host_adapters": len(self.host),
+            "host_bytes": sum(e.nbytes for e in self.host.values()),
+            "active_adapters": len(self.active),
+            "active_bytes": sum(self.active.values()),
+            "pinned": dict(self._pins),
+        }
+
+    async def _host_entry(self, adapter_id: str) -> _HostAdapter:
+        entry = self.host.get(adapter_id)
+        if entry is not None:
+            self.host.move_to_end(adapter_id)
+            ADAPTER_CACHE_HITS.labels(tier="host").inc()
+            return entry
+        pending = self._loading.get(adapter_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        ADAPTER_CACHE_MISSES.labels(tier="host").inc()
+        path = await self.resolve_path(adapter_id)
+        fut = asyncio.get_running_loop().create_future()
+        self._loading[adapter_id] = fut
+        try:
+            start = time.perf_counter()
+            entry = await asyncio.get_running_loop().run_in_executor(self._pool, self._read, path)
+            ADAPTER_LOAD_MS.labels(tier="host").observe((time.perf_counter() - start) * 1000)
+            self.host[adapter_id] = entry
+            self._evict_host()
+            self._publish()
+            fut.set_result(entry)
+            return entry
+        except Exception as ex:
+            fut.set_exception(ex)
+            fut.exception()  # retrieved here; waiters get it re-raised
+            raise
+        finally:
+            del self._loading[adapter_id]
+
+    def _read(self, path: Path) -> _HostAdapter:
+        if self._parse:
+            try:
+                config, weights = load_lora_weights(str(path), self.mmap_weights)
+            except ValueError:
+                pass  # not a plain LoRA (e.g. DoRA): nothing to pre-parse, PEFT loads it from disk
+            else:
+                return _HostAdapter(path=path, config=config, weights=weights, nbytes=lora_nbytes(weights))
+        nbytes = sum(f.stat().st_size for f in path.iterdir() if f.is_file())
+        return _HostAdapter(path=path, config={}, weights={}, nbytes=nbytes)
+
+    def _evict_host(self):
+        # host copies are only a cache of disk: the newest entry stays even if it alone exceeds the budget
+        while len(self.host) > 1 and sum(e.nbytes for e in self.host.values()) > self.host_budget:
+            victim, _ = self.host.popitem(last=False)
+            ADAPTER_CACHE_EVICTIONS.labels(tier="host").inc()
+            logger.info("Adapter '%s' evicted from host memory", victim)
+
+    async def _evict_active(self, keep: str):
+        while sum(self.active.values()) > self.active_budget:
+            victim = next((a for a in self.active if a not in self._pins and a != keep), None)
+            if victim is None:
+                break  # everything else resident is in use; stay over budget until the next attach
+            del self.active[victim]
+            await self.engine.detach_adapter(victim)
+            ADAPTER_CACHE_EVICTIONS.labels(tier="active").inc()
+            logger.info("Adapter '%s' detached from the engine (active tier over budget)", victim)
+
+    def _publish(self):
+        ADAPTER_TIER_BYTES.labels(tier="host").set(sum(e.nbytes for e in self.host.values()))
+        ADAPTER_TIER_BYTES.labels(tier="active").set(sum(self.active.values()))
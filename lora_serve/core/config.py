@@ -8,9 +8,43 @@ class Settings(BaseSettings):
     device: str = "cuda"
     max_batch_tokens: int = 8192
     max_wait_ms: int = 10
-    kv_block_tokens: int = 512
-    kv_capacity_blocks: int = 4096
-    enable_spec_decode: bool = True
+    request_timeout_s: float = 0      # generation deadline per request; the row is dropped when hit (0 = none)
+    kv_block_tokens: int = 16         # tokens per paged KV block
+    kv_capacity_blocks: int = 4096    # upper bound on KV blocks (pool grows lazily)
+    prefix_cache_mb: int = 256        # KV memory kept for reusable prompt prefixes (0 = off)
+    memory_budget_mb: int = 0         # per engine: weights + KV pool + activations; admission stays inside it (0 = off)
+    multi_lora: bool = False          # per-row adapters in one batch (stacked LoRA, no PEFT)
+    engine_workers: int = 1                # >1: one engine process (model replica) per worker
+    engine_pin_threads: bool = True        # give each engine process its own slice of CPUs
+    engine_share_weights: bool = True      # CPU replicas mmap one copy of the base weights
+    engine_weights_dir: str | None = None  # where that copy is written (default /dev/shm)
+    router_affinity_slack: int = 4         # extra queued requests tolerated to reuse a resident adapter
+    tokenizer_workers: int = 2             # threads tokenizing prompts before scheduling (0 = engine tokenizes)
+    response_cache_mb: int = 64            # memory for cached deterministic responses (0 = off)
+    response_cache_ttl_s: float = 3600     # cached responses expire after this (0 = never)
+    response_cache_dir: str | None = None  # optional on-disk tier
+    response_cache_disk_mb: int = 1024
+    trace_endpoint: str | None = None      # OTLP/HTTP collector for request spans, e.g. http://localhost:4318/v1/traces
+    trace_sample_ratio: float = 1.0        # fraction of requests traced
+    profile_max_seconds: float = 60        # longest capture POST /v1/admin/profile may run
+    max_choices: int = 16                  # cap on n / best_of of the OpenAI endpoints
+    chat_max_tokens: int = 256             # chat completions without max_tokens
+    bulk_max_items: int = 10000            # prompts per POST /v1/generate/batch
+    adapter_host_budget_mb: int = 2048    # parsed adapter weights kept in host RAM
+    adapter_active_budget_mb: int = 512   # adapter weights attached to the model
+    adapter_mmap: bool = False            # host tier maps safetensors files instead of copying them
+    adapter_load_workers: int = 2         # threads reading/parsing adapters off the event loop
+    adapter_max_staleness_ms: int = 500   # affinity: longest another adapter's request waits for a switch
+    warm_adapters: list[str] = []         # attached and exercised at startup (JSON list)
+    prefetch_interval_ms: int = 50        # background warmer tick
+    prefetch_top_k: int = 4               # warmer also keeps the k busiest adapters cached
+    # per-tenant fairness (JSON objects keyed by tenant_id, e.g. {"batch": 0.25})
+    tenant_weights: dict[str, float] = {}          # share of served tokens (default 1.0)
+    tenant_priorities: dict[str, int] = {}         # strict priority class, higher first (default 0)
+    tenant_max_concurrency: dict[str, int] = {}    # cap on requests in flight (default unlimited)
+    enable_spec_decode: bool = False
+    spec_proposer: str = "ngram"      # "ngram" (prompt lookup) or "draft" (draft_model_id)
+    spec_max_draft_tokens: int = 4    # upper bound for the adaptive draft length
     draft_model_id: str | None = None
 
     # v2-style config:
@@ -0,0 +1,44 @@
+
+# Small helpers to move K/V between plain tensors and transformers' cache objects.
+from typing import Optional
+
+import torch
+from transformers import DynamicCache
+
+
+def to_cache(layers) -> DynamicCache:
+    """Build a DynamicCache from per-layer (key, value) tensors [batch, heads, tokens, dim]."""
+    cache = DynamicCache()
+    for idx, (k, v) in enumerate(layers):
+        cache.update(k, v, idx)
+    return cache
+
+
+def narrow_cache(cache, rows: Optional[torch.Tensor], width: int):
+    """Keep `rows` (all if None) and the last `width` positions of every layer of a transformers cache, in place."""
+    def cut(t: torch.Tensor) -> torch.Tensor:
+        if rows is not None:
+            t = t.index_select(0, rows)
+        return t[:, :, t.shape[2] - width:]
+
+    if hasattr(cache, "layers"):
+        for layer in cache.layers:
+            layer.keys, layer.values = cut(layer.keys), cut(layer.values)
+    else:  # older transformers
+        cache.key_cache = [cut(k) for k in cache.key_cache]
+        cache.value_cache = [cut(v) for v in cache.value_cache]
+    return cache
+
+
+def cache_layers(cache) -> list:
+    """Per-layer (key, value) tensors of a transformers cache."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))  # older transformers
+
+
+def kv_bytes_per_token(config, dtype: torch.dtype) -> int:
+    """K+V bytes one token occupies across all layers."""
+    heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    return 2 * config.num_hidden_layers * heads * head_dim * torch.finfo(dtype).bits // 8
@@ -1,11 +1,23 @@
 
-from typing import List, AsyncIterator, Protocol
-from ...core.types import GenerateRequest, GenerateResult, VerifyRequest, VerifyResult
+from typing import Dict, List, Optional, Protocol
+from ...core.types import GenerateRequest, GenerateResult, StepOutput, VerifyRequest, VerifyResult
 
 class IEngine(Protocol):
-    async def warmup(self) -> None: ...
-    async def attach_adapter(self, adapter_id: str, path: str) -> None: ...
+    # True if rows of one batch may use different adapters (multi-LoRA mode)
+    supports_mixed_adapters: bool
+
+    async def warmup(self, adapters: Optional[Dict[str, str]] = None) -> None: ...
+    async def attach_adapter(self, adapter_id: str, path: str, parsed=None) -> None: ...
     async def detach_adapter(self, adapter_id: str) -> None: ...
     async def generate_batch(self, reqs: List[GenerateRequest]) -> List[GenerateResult]: ...
-    async def stream_generate_batch(self, reqs: List[GenerateRequest]) -> List[AsyncIterator[GenerateResult]]: ...
     async def verify_batch(self, reqs: List[VerifyRequest]) -> List[VerifyResult]: ...
+
+    # Iteration-level (continuous batching) surface, driven by the scheduler:
+    # sequences may be added between any two steps and leave as soon as they finish.
+    # Streaming requests (req.stream) get their newly decoded text in StepOutput.text.
+    # A sequence added with `fork_of` skips prefill: it shares that sequence's prompt K/V
+    # and samples its own continuation from the same prefill logits (n > 1 requests).
+    def add_sequence(self, seq_id: str, req: GenerateRequest, fork_of: Optional[str] = None) -> None: ...
+    def abort_sequence(self, seq_id: str) -> None: ...
+    def has_unfinished(self) -> bool: ...
+    async def step(self) -> List[StepOutput]: ...
@@ -1,14 +1,33 @@
 
-# Minimal HF-backed engine stub (no actual HF load for scaffold)
-from typing import List, AsyncIterator
+# HF-backed engine with an iteration-level (continuous batching) decode loop
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from queue import SimpleQueue
+from typing import Dict, List, Optional, Tuple
 import asyncio
+import contextlib
+import inspect
+import itertools
 import logging
-import threading
+import os
+import time
 import torch
-import threading
-from ...core.types import GenerateRequest, GenerateResult, VerifyRequest, VerifyResult
+from safetensors.torch import save_file
+from ...core import profiling
+from ...core.types import GenerateRequest, GenerateResult, StepOutput, VerifyRequest, VerifyResult
+from .cache_utils import cache_layers, narrow_cache, to_cache
 from .engine import IEngine
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer
+from .memory import MemoryModel, is_out_of_memory
+from .multi_lora import MultiLoRAModel, _mmap_safetensors
+from ...core.metrics import (FORWARD_TOKENS_PER_S, KV_PREEMPTIONS, MEMORY_BUDGET_BYTES, OOM_BATCH_SPLITS,
+                             PREFILL_PADDING_EFFICIENCY, PREFILL_TOKENS, STAGE_MS, WASTED_TOKENS_AVOIDED)
+from ...decoding.sampler import SamplingBatch, sample
+from ...decoding.stream import IncrementalDetokenizer
+from ...decoding.spec_decode import DraftModelProposer, NgramProposer, SpeculativeOrchestrator, target_probs_for
+from ...kv_cache.manager import KVCacheManager
+from ...kv_cache.prefix_cache import PrefixCache
+from transformers import AutoTokenizer, AutoModelForCausalLM
 
 try:
     from peft import PeftModel  # core wrapper that can hold/load adapters
@@ -21,13 +40,49 @@ except Exception:
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class _Sequence:
+    seq_id: str
+    req: GenerateRequest
+    prompt_ids: List[int]
+    output_ids: List[int] = field(default_factory=list)
+    # tokens whose K/V live in the paged KV cache (every token but the last once decoding)
+    num_cached: int = 0
+    generator: Optional[torch.Generator] = None  # seeded requests only
+    fork_of: Optional[str] = None  # n > 1: joins once this sequence is prefilled, sharing its prompt K/V
+    logprob: float = 0.0           # of the sampled tokens, tracked for best_of ranking only
+
+    @property
+    def all_ids(self) -> List[int]:
+        return self.prompt_ids + self.output_ids
+
+
+@dataclass
+class _Live:
+    """Event-loop view of an unfinished sequence."""
+    req: GenerateRequest
+    prompt_tokens: int
+    detok: IncrementalDetokenizer
+    forks: int = 0
+    prompt_ids: List[int] = field(default_factory=list)
+
+
+def _ranked(req: GenerateRequest) -> bool:
+    """best_of > n: continuations are ranked by likelihood, so their log-probabilities are tracked."""
+    return (req.best_of or 0) > req.n
+
+
 class HFEngine(IEngine):
-    def __init__(self, model_id: str, dtype: str = "bfloat16", device: str = "cuda"):
+    def __init__(self, model_id: str, dtype: str = "bfloat16", device: str = "cuda", multi_lora: bool = False,
+                 kv_block_tokens: int = 16, kv_capacity_blocks: int = 4096, prefix_cache_mb: int = 256,
+                 spec_decode: bool = False, spec_proposer: str = "ngram", draft_model_id: Optional[str] = None,
+                 spec_max_draft_tokens: int = 4, shared_weights: Optional[str] = None, memory_budget_mb: int = 0):
         self.model_id = model_id
         self.device = device if torch.cuda.is_available() else "cpu"
 
         # dtype handling
-        _dtype = {"bfloat16": torch.bfloat16, "float16": torch.float16, "fp16": torch.float16}.get(dtype, torch.float16)
+        _dtype = {"bfloat16": torch.bfloat16, "float16": torch.float16, "fp16": torch.float16,
+                  "float32": torch.float32, "fp32": torch.float32}.get(dtype, torch.float16)
 
         logger.info("Loading base model %s (dtype=%s, device=%s)", model_id, _dtype, self.device)
         self.tokenizer = AutoTokenizer.from_pretrained(model_id, use_fast=True, trust_remote_code=True)
@@ -42,297 +97,847 @@ class HFEngine(IEngine):
         )
         self.model.eval()
         torch.set_grad_enabled(False)
+        if shared_weights and self.device == "cpu":
+            self._map_shared_weights(Path(shared_weights))
         torch.backends.cuda.matmul.allow_tf32 = True
+        # only compute the logits we need (last position) when the model supports it
+        self._has_logits_to_keep = "logits_to_keep" in inspect.signature(self.model.forward).parameters
 
         # adapter_id -> attached flag/path
         self._adapters: dict[str, str] = {}
         self._adapter_lock = asyncio.Lock()
 
-    async def warmup(self) -> None:
-        await asyncio.sleep(0)
+        # multi-LoRA mode: adapters stay resident side by side and each row picks its own,
+        # instead of PEFT's single globally active adapter
+        self.multi_lora = MultiLoRAModel(self.model) if multi_lora else None
+        self.supports_mixed_adapters = multi_lora
+
+        # continuous batching state
+        eos = getattr(getattr(self.model, "generation_config", None), "eos_token_id", None)
+        eos = eos if isinstance(eos, list) else [eos]
+        self._eos_ids = {t for t in eos + [self.tokenizer.eos_token_id] if t is not None}
+        self._waiting: list[_Sequence] = []
+        self._running: dict[str, _Sequence] = {}
+        self._gb_ids = itertools.count()
+
+        # all model work (steps, verification, adapter changes) runs on one worker thread;
+        # the event loop only hands sequences over and awaits finished steps
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="engine",
+                                          initializer=torch.set_grad_enabled, initargs=(False,))
+        self._inbox: SimpleQueue = SimpleQueue()  # ("add", _Sequence) | ("abort", seq_id)
+        self._live: Dict[str, _Live] = {}         # unfinished sequences, as seen by the event loop
+        self._forks: Dict[str, List[_Sequence]] = {}  # seq_id -> forks waiting for its prefill
+        # last decode step's output cache ([(seq_id, cached tokens)], cache): the next decode
+        # extends it in place of re-gathering every row's context from the paged store. It is
+        # [rows, longest context] on top of the pool, charged to the activation budget
+        self._dense: Optional[Tuple[List[Tuple[str, int]], object]] = None
+        self._next_step: Optional[asyncio.Future] = None
+        self._steps = 0  # batch ids in profiles
+        self._profiler: Optional[torch.profiler.profile] = None  # while a capture runs (start_profile)
+
+        # memory budget: weights, then the KV pool, the rest for forward-pass activations and
+        # the kept decode cache (see _fits_memory)
+        self.memory = MemoryModel.for_model(self.model, _dtype)
+        block_bytes = kv_block_tokens * self.memory.kv_bytes_per_token
+        self._activation_budget: Optional[int] = None
+        if memory_budget_mb > 0:
+            self._calibrate_memory()
+            free = memory_budget_mb * 2**20 - self.memory.weight_bytes
+            if free <= 0:
+                raise ValueError(f"memory_budget_mb={memory_budget_mb} does not even hold the weights "
+                                 f"({self.memory.weight_bytes / 2**20:.0f} MiB)")
+            kv_capacity_blocks = max(1, min(kv_capacity_blocks, int(free * 0.75) // block_bytes))
+            self._activation_budget = free - kv_capacity_blocks * block_bytes
+            MEMORY_BUDGET_BYTES.labels(part="weights").set(self.memory.weight_bytes)
+            MEMORY_BUDGET_BYTES.labels(part="kv").set(kv_capacity_blocks * block_bytes)
+            MEMORY_BUDGET_BYTES.labels(part="activations").set(self._activation_budget)
+            logger.info("Memory budget %d MiB: weights %.0f, KV %d blocks (%.0f MiB), activations %.0f MiB",
+                        memory_budget_mb, self.memory.weight_bytes / 2**20, kv_capacity_blocks,
+                        kv_capacity_blocks * block_bytes / 2**20, self._activation_budget / 2**20)
+        # tokens of KV the pool can hold; the scheduler caps its batch budget to it
+        self.max_batch_tokens = kv_capacity_blocks * kv_block_tokens
+
+        # paged KV storage, one block table per sequence
+        self.kv = KVCacheManager(kv_block_tokens, kv_capacity_blocks)
+        # prompt-prefix reuse over those blocks, scoped per adapter
+        self.prefix = PrefixCache(self.kv.alloc, max_blocks=prefix_cache_mb * 2**20 // block_bytes)
+        self._active_adapter: Optional[str] = None  # PEFT mode: globally selected adapter
+
+        # speculative decoding: drafts verified in one target pass per step
+        self.spec: Optional[SpeculativeOrchestrator] = None
+        if spec_decode:
+            if spec_proposer == "draft":
+                if not draft_model_id:
+                    raise ValueError("spec_proposer='draft' requires draft_model_id")
+                logger.info("Loading draft model %s", draft_model_id)
+                draft = AutoModelForCausalLM.from_pretrained(draft_model_id, dtype=_dtype, trust_remote_code=True)
+                draft.to(self.model.device).eval()
+                proposer = DraftModelProposer(draft, vocab_size=self.model.config.vocab_size)
+            else:
+                proposer = NgramProposer()
+            self.spec = SpeculativeOrchestrator(proposer, max_draft_steps=spec_max_draft_tokens)
 
-    async def attach_adapter(self, adapter_id: str, path: str) -> None:
+    def _map_shared_weights(self, path: Path) -> None:
+        """
+        Swap the base parameters for read-only views of an mmap'd safetensors snapshot
+        (written by whichever process gets there first), so engine processes on one
+        host share a single physical copy of the weights through the page cache.
+        """
+        params = dict(self.model.named_parameters())  # tied weights appear once
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            save_file({n: p.detach().contiguous() for n, p in params.items()}, str(tmp))
+            os.replace(tmp, path)
+        mapped = _mmap_safetensors(path)
+        if mapped.keys() != params.keys() or any(mapped[n].shape != p.shape for n, p in params.items()):
+            logger.warning("Shared weights %s do not match %s; keeping a private copy", path, self.model_id)
+            return
+        for name, p in params.items():
+            p.data = mapped[name]
+        logger.info("Base weights mapped from %s", path)
+
+    def _calibrate_memory(self) -> None:
+        """Fit the activation estimate to the allocator's peak over a few probe forwards."""
+        if self.device != "cuda":
+            logger.info("No allocator statistics on %s; using the config-derived activation estimate", self.device)
+            return
+        limit = getattr(self.model.config, "max_position_embeddings", None) or 2048
+        # prefills, then decode steps over a long context (the gathered K/V dominates those)
+        shapes = [(1, min(128, limit), 0, 1), (4, min(512, limit), 0, 1),
+                  (2, 1, min(256, limit - 1), 1), (8, 1, min(1024, limit - 1), 1)]
+
+        def measure(shape) -> int:
+            rows, new, past, _ = shape
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+            self._probe_forward(rows, new, past)
+            torch.cuda.synchronize()
+            return torch.cuda.max_memory_allocated() - base
+
+        start = time.perf_counter()
+        self.memory.calibrate(measure, shapes)
+        torch.cuda.empty_cache()
+        logger.info("Memory model calibrated in %.0f ms: %.1f KiB activations per token, %.2f K/V copies",
+                    (time.perf_counter() - start) * 1000, self.memory.act_bytes_per_token / 1024,
+                    self.memory.kv_copies)
+
+    def _probe_forward(self, rows: int, new: int, past: int) -> None:
+        """One forward shaped like `_forward`'s: random tokens on `past` positions of dense, gathered K/V."""
+        config = self.model.config
+        heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        extra = {"logits_to_keep": 1} if self._has_logits_to_keep else {}
+        with torch.inference_mode():
+            ids = torch.randint(0, config.vocab_size, (rows, new), device=self.model.device)
+            cache = None
+            if past:
+                # as KVCacheManager.gather lays it out: one tensor for all layers, then wrapped in a cache
+                kv = torch.zeros((config.num_hidden_layers, 2, rows, heads, past, dim),
+                                 dtype=self.model.dtype, device=self.model.device)
+                cache = to_cache([(kv[layer, 0], kv[layer, 1]) for layer in range(config.num_hidden_layers)])
+                del kv
+            mask = torch.ones((rows, past + new), dtype=torch.long, device=self.model.device)
+            self.model(input_ids=ids, attention_mask=mask, past_key_values=cache, use_cache=True, **extra)
+
+    async def warmup(self, adapters: Optional[Dict[str, str]] = None) -> None:
+        """
+        Run a tiny generation on the base model and on each of `adapters` ({id: path},
+        attached if needed) so kernels, the KV pool and adapter weights are hot before
+        the first real request. Must not overlap with a running step loop.
+        """
+        adapters = adapters or {}
+        reqs = [GenerateRequest(prompt="Hello", max_tokens=2, temperature=0, adapter_id=a) for a in [None, *adapters]]
+        start = time.perf_counter()
+        if self.multi_lora is not None:
+            for adapter_id, path in adapters.items():
+                await self.attach_adapter(adapter_id, path)
+            await self.generate_batch(reqs)
+        else:
+            for r in reqs:  # PEFT: one selected adapter per batch
+                if r.adapter_id is not None:
+                    await self.attach_adapter(r.adapter_id, adapters[r.adapter_id])
+                await self.generate_batch([r])
+        self._steps = 0  # batch ids count the scheduler's steps, as DynamicBatcher does
+        logger.info("Warmup done in %.0f ms (%d adapters)", (time.perf_counter() - start) * 1000, len(adapters))
+
+    async def attach_adapter(self, adapter_id: str, path: str, parsed=None) -> None:
+        """
+        Make `adapter_id` usable. `parsed` is the (config, weights) pair already held in host
+        memory by the adapter store; multi-LoRA mode uses it directly, PEFT reads `path`.
+        """
+        async with self._adapter_lock:
+            await self._on_worker(self._attach, adapter_id, path, parsed)
+
+    def _attach(self, adapter_id: str, path: str, parsed) -> None:
+        if self.multi_lora is not None:
+            self.multi_lora.load(adapter_id, path, parsed)
+            self._adapters[adapter_id] = str(path)
+            return
         if not _HAS_PEFT:
             logger.warning("PEFT not installed; skipping adapter %s", adapter_id)
             return
 
-        async with self._adapter_lock:
-            # Already have this adapter registered?
-            existing = []
-            if isinstance(self.model, PeftModel) and hasattr(self.model, "peft_config"):
-                existing = list(getattr(self.model, "peft_config", {}).keys())
+        # Already have this adapter registered?
+        existing = []
+        if isinstance(self.model, PeftModel) and hasattr(self.model, "peft_config"):
+            existing = list(getattr(self.model, "peft_config", {}).keys())
 
-            if not isinstance(self.model, PeftModel):
-                # First adapter: wrap base model with PEFT and register under adapter_id
+        if not isinstance(self.model, PeftModel):
+            # First adapter: wrap base model with PEFT and register under adapter_id
+            try:
+                self.model = PeftModel.from_pretrained(
+                    self.model,
+                    path,
+                    adapter_name=adapter_id,     # <-- key line
+                    is_trainable=False,          # inference
+                )
+            except TypeError:
+                # Older PEFT: no adapter_name kw; it will be "default"
+                self.model = PeftModel.from_pretrained(self.model, path)
+        else:
+            # Model already PEFT-wrapped: load this adapter if missing
+            if adapter_id not in existing:
+                # Register the new adapter under adapter_id
+                kwargs = {"adapter_name": adapter_id}
                 try:
-                    self.model = PeftModel.from_pretrained(
-                        self.model,
-                        path,
-                        adapter_name=adapter_id,     # <-- key line
-                        is_trainable=False,          # inference
-                    )
+                    self.model.load_adapter(path, **kwargs)
                 except TypeError:
-                    # Older PEFT: no adapter_name kw; it will be "default"
-                    self.model = PeftModel.from_pretrained(self.model, path)
+                    # Older PEFT signatures (no adapter_name kw)
+                    self.model.load_adapter(path)
+                    # It likely registered as "default" – we'll handle selection below
+
+        # Now select the adapter safely
+        try:
+            names = list(getattr(self.model, "peft_config", {}).keys())
+            if adapter_id in names:
+                self.model.set_adapter(adapter_id)
+            elif "default" in names:
+                logger.debug("Adapter '%s' not registered; falling back to 'default'", adapter_id)
+                self.model.set_adapter("default")
             else:
-                # Model already PEFT-wrapped: load this adapter if missing
-                if adapter_id not in existing:
-                    # Register the new adapter under adapter_id
-                    kwargs = {"adapter_name": adapter_id}
-                    try:
-                        self.model.load_adapter(path, **kwargs)
-                    except TypeError:
-                        # Older PEFT signatures (no adapter_name kw)
-                        self.model.load_adapter(path)
-                        # It likely registered as "default" – we'll handle selection below
-
-            # Now select the adapter safely
-            try:
-                names = list(getattr(self.model, "peft_config", {}).keys())
-                if adapter_id in names:
-                    self.model.set_adapter(adapter_id)
-                elif "default" in names:
-                    logger.debug("Adapter '%s' not registered; falling back to 'default'", adapter_id)
-                    self.model.set_adapter("default")
-                else:
-                    raise RuntimeError(f"No selectable adapters found: have {names}")
-            except Exception as e:
-                logger.exception("set_adapter failed for '%s' (have=%s): %s", adapter_id, existing, e)
-                raise
+                raise RuntimeError(f"No selectable adapters found: have {names}")
+        except Exception as e:
+            logger.exception("set_adapter failed for '%s' (have=%s): %s", adapter_id, existing, e)
+            raise
 
-            # book-keeping
-            self._adapters[adapter_id] = str(path)
-            logger.info("Adapter '%s' active (available=%s)", adapter_id, list(self.model.peft_config.keys()))
+        # book-keeping
+        self._adapters[adapter_id] = str(path)
+        self._active_adapter = adapter_id
+        logger.info("Adapter '%s' active (available=%s)", adapter_id, list(self.model.peft_config.keys()))
 
     async def detach_adapter(self, adapter_id: str) -> None:
         """Detach and free a specific LoRA adapter if loaded."""
-        if not _HAS_PEFT or not isinstance(self.model, PeftModel):
-            logger.debug("No PEFT model attached; nothing to detach.")
-            return
-
         async with self._adapter_lock:
-            if adapter_id not in self._adapters:
-                logger.debug("Adapter %s not found in engine cache", adapter_id)
-                return
-
-            logger.info("Detaching adapter %s", adapter_id)
-            try:
-                if hasattr(self.model, "unload_adapter"):
-                    self.model.unload_adapter(adapter_id)
-                else:
-                    # Fallback: clear from config dicts
-                    if hasattr(self.model, "peft_config") and adapter_id in self.model.peft_config:
-                        del self.model.peft_config[adapter_id]
-            except Exception as e:
-                logger.warning("Failed to unload adapter %s: %s", adapter_id, e)
+            await self._on_worker(self._detach, adapter_id)
 
-            # remove from cache and LRU
+    def _detach(self, adapter_id: str) -> None:
+        if self.multi_lora is not None:
+            self.multi_lora.unload(adapter_id)
             self._adapters.pop(adapter_id, None)
+            self.prefix.drop(adapter_id)
+            return
+        if not _HAS_PEFT or not isinstance(self.model, PeftModel):
+            logger.debug("No PEFT model attached; nothing to detach.")
+            return
+        if adapter_id not in self._adapters:
+            logger.debug("Adapter %s not found in engine cache", adapter_id)
+            return
 
-            # optional: torch.cuda.empty_cache() if GPU mem high
-            # import torch; torch.cuda.empty_cache()
-
-    async def generate_batch(self, reqs: List[GenerateRequest]) -> List[GenerateResult]:
-        logger.debug("generate_batch called with %d reqs", len(reqs))
-        prompts = [r.prompt for r in reqs]
-        if not prompts:
-            return []
-
-        # Decide generation knobs for the whole batch (simple policy)
-        max_new = max(max(1, r.max_tokens) for r in reqs)
-        # If ANY request wants sampling (temperature > 0), enable sampling
-        do_sample = any(r.temperature and r.temperature > 0 for r in reqs)
-        # Since torch generate() can’t take per-row temperatures, pick a batch value.
-        # Easiest: use the max across reqs when sampling is on.
-        batch_temp = max((r.temperature or 0.0) for r in reqs) if do_sample else None
-        batch_top_p = max((r.top_p or 0.0) for r in reqs) if do_sample else None
-
-        # Tokenize as a padded batch
-        tok = self.tokenizer(
-            prompts,
-            return_tensors="pt",
-            padding=True,
-            truncation=True,  # truncate *inputs* if needed to model's max position
-        )
-        input_ids = tok["input_ids"].to(self.model.device)
-        attn_mask = tok["attention_mask"].to(self.model.device)
-        input_len = input_ids.shape[1]
-        logger.debug("tokens ready. going to generation inference.")
-
+        logger.info("Detaching adapter %s", adapter_id)
         try:
-            with torch.inference_mode():
-                outputs = self.model.generate(
-                    input_ids=input_ids,
-                    attention_mask=attn_mask,
-                    max_new_tokens=max_new,
-                    do_sample=do_sample,
-                    temperature=batch_temp,
-                    top_p=batch_top_p,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                )
-        except RuntimeError as e:
-            # Very basic OOM backoff: try halving max_new once.
-            if "CUDA out of memory" in str(e) and max_new > 1:
-                logger.warning("OOM at max_new=%d; retrying with %d", max_new, max_new // 2)
-                with torch.inference_mode():
-                    outputs = self.model.generate(
-                        input_ids=input_ids,
-                        attention_mask=attn_mask,
-                        max_new_tokens=max_new // 2,
-                        do_sample=do_sample,
-                        temperature=batch_temp,
-                        top_p=batch_top_p,
-                        pad_token_id=self.tokenizer.pad_token_id,
-                        eos_token_id=self.tokenizer.eos_token_id,
-                    )
+            if hasattr(self.model, "delete_adapter"):
+                self.model.delete_adapter(adapter_id)
+            elif hasattr(self.model, "unload_adapter"):
+                self.model.unload_adapter(adapter_id)
             else:
-                logger.exception("generate_batch failed")
-                raise
-
-        # Split the batched outputs row-wise and decode only *new* tokens
-        results: list[GenerateResult] = []
-        for i in range(outputs.shape[0]):
-            out_ids = outputs[i]
-            # Guard against edge cases (e.g., EOS at step 0)
-            new_slice = out_ids[input_len:] if out_ids.shape[0] > input_len else out_ids[:0]
-            text = self.tokenizer.decode(new_slice, skip_special_tokens=True)
-            results.append(GenerateResult(text=text, tokens=len(new_slice)))
-        logger.debug("generate_batch: done (max_new=%d, do_sample=%s)", max_new, do_sample)
-        return results
-
-        # Fake generation for scaffold
-        out = []
-        for r in reqs:
-            text = f"[adapter={r.adapter_id or 'none'}] {r.prompt} ... (generated)"
-            out.append(GenerateResult(text=text, tokens=min(r.max_tokens, 32)))
-
-        # logger.debug("Tokenizing %d prompts", len(prompts))
-        # logger.debug("Model.generate done (batch=%d)", len(prompts))
-        await asyncio.sleep(0)
-        return out
-
-    async def stream_generate_single(self, req: GenerateRequest):
+                # Fallback: clear from config dicts
+                if hasattr(self.model, "peft_config") and adapter_id in self.model.peft_config:
+                    del self.model.peft_config[adapter_id]
+        except Exception as e:
+            logger.warning("Failed to unload adapter %s: %s", adapter_id, e)
+
+        # remove from cache and LRU
+        self._adapters.pop(adapter_id, None)
+        self.prefix.drop(adapter_id)
+        if self._active_adapter == adapter_id:
+            self._active_adapter = None
+
+        # optional: torch.cuda.empty_cache() if GPU mem high
+        # import torch; torch.cuda.empty_cache()
+
+    def _on_worker(self, fn, *args) -> asyncio.Future:
+        """Run `fn` on the engine's worker thread (serialized with steps); awaitable."""
+        return asyncio.get_running_loop().run_in_executor(self._worker, fn, *args)
+
+    async def start_profile(self) -> None:
+        """Start the torch profiler on the worker thread (it only records the thread it runs on)."""
+        if self._profiler is None:
+            self._profiler = profiling.torch_profiler()
+            await self._on_worker(self._profiler.__enter__)
+
+    async def stop_profile(self) -> dict:
+        """Stop it; returns the Chrome trace of the capture."""
+        prof, self._profiler = self._profiler, None
+        if prof is None:
+            return {}
+        await self._on_worker(prof.__exit__, None, None, None)
+        return await asyncio.get_running_loop().run_in_executor(None, profiling.chrome_trace, prof)
+
+    def _annotate(self, seqs: List[_Sequence]):
+        if self._profiler is None:
+            return contextlib.nullcontext()
+        adapters = ",".join(sorted({s.req.adapter_id or "base" for s in seqs}))
+        return torch.profiler.record_function(f"batch {self._steps} rows={len(seqs)} adapters={adapters}")
+
+    # ---- continuous batching -------------------------------------------------
+
+    def add_sequence(self, seq_id: str, req: GenerateRequest, fork_of: Optional[str] = None) -> None:
         """
-        Async generator yielding text chunks as they are produced.
-        NOTE: single-request path (no batching).
+        Register a request; it is prefilled on the next step() and then joins decode.
+        With `fork_of` (an unfinished sequence of the same request) it is not prefilled:
+        it joins when that one is, sharing its prompt K/V copy-on-write and sampling its
+        first token from the same logits.
         """
-        prompt = req.prompt
-        do_sample = (req.temperature or 0) > 0
-        tok = self.tokenizer(
-            [prompt], return_tensors="pt", padding=False, truncation=True
-        )
-        input_ids = tok["input_ids"].to(self.model.device)
-        attn_mask = tok.get("attention_mask")
-        if attn_mask is not None:
-            attn_mask = attn_mask.to(self.model.device)
-
-        # streamer will yield decoded text *incrementally*
-        streamer = TextIteratorStreamer(
-            self.tokenizer, skip_prompt=True, skip_special_tokens=True
-        )
+        parent = self._live.get(fork_of) if fork_of is not None else None
+        seed = req.seed
+        if parent is not None:
+            # a fork shares its parent's prompt K/V if it joins the parent's prefill; the ids let it
+            # be prefilled on its own if the parent was admitted before the fork reached the worker
+            prompt_ids = parent.prompt_ids
+            parent.forks += 1
+            prompt_tokens = parent.prompt_tokens
+            seed = None if seed is None else seed + parent.forks  # distinct, reproducible continuations
+        else:
+            fork_of = None
+            prompt_ids = req.prompt_ids
+            if prompt_ids is None:
+                prompt_ids = self.tokenizer(req.prompt, truncation=True)["input_ids"]
+            if not prompt_ids:
+                prompt_ids = [self.tokenizer.bos_token_id or self.tokenizer.pad_token_id]
+            prompt_tokens = len(prompt_ids)
+        generator = None
+        if seed is not None:
+            generator = torch.Generator(device=self.model.device).manual_seed(seed)
+        self._live[seq_id] = _Live(req, prompt_tokens, IncrementalDetokenizer(self.tokenizer, req.stream, stop=req.stop),
+                                   prompt_ids=list(prompt_ids))
+        self._inbox.put(("add", _Sequence(seq_id=seq_id, req=req, prompt_ids=list(prompt_ids), generator=generator,
+                                          fork_of=fork_of)))
+
+    def abort_sequence(self, seq_id: str) -> None:
+        self._live.pop(seq_id, None)
+        self._inbox.put(("abort", seq_id))
+        if not self._live:
+            # no further step may come to pick the abort up: release its rows and K/V on the worker now
+            self._worker.submit(self._drain_inbox)
+
+    def has_unfinished(self) -> bool:
+        return bool(self._live)
+
+    async def step(self) -> List[StepOutput]:
+        """
+        Run one iteration: prefill newly added sequences (emitting their first token)
+        and advance every already-running sequence by one token. Finished sequences
+        are dropped from the batch immediately.
 
-        gen_kwargs = dict(
-            input_ids=input_ids,
-            attention_mask=attn_mask,
-            max_new_tokens=max(1, req.max_tokens),
-            do_sample=do_sample,
-            temperature=req.temperature if do_sample else None,
-            top_p=req.top_p if do_sample else None,
-            pad_token_id=self.tokenizer.pad_token_id,
-            eos_token_id=self.tokenizer.eos_token_id,
-            streamer=streamer,
-        )
+        KV blocks are taken from the paged cache as tokens are produced. A waiting
+        sequence is only prefilled once its prompt fits; a running sequence that cannot
+        get its next block is preempted (KV freed) and recomputed from the waiting list.
 
-        # Run .generate() in a background thread, read tokens here
-        def _run():
-            try:
-                with torch.inference_mode():
-                    self.model.generate(**gen_kwargs)
-            except Exception as e:
-                logger.exception("stream generate failed: %s", e)
-                # close streamer by stopping iteration
-                try:
-                    streamer.on_finalized_text()
-                except Exception:
-                    pass
-
-        t = threading.Thread(target=_run, daemon=True)
-        t.start()
-
-        # The streamer is an iterator that blocks until next chunk is available.
-        # Bridge it to an async generator:
-        loop = asyncio.get_event_loop()
-        while True:
-            chunk = await loop.run_in_executor(None, next, streamer, None)
-            if chunk is None:
+        The model work runs on the engine's worker thread. As soon as step N comes back,
+        step N+1 is started there, so detokenizing and dispatching N's outputs overlaps
+        with N+1's forward pass; sequences added meanwhile join the step after that.
+        """
+        if self._next_step is not None and self._next_step.get_loop() is not asyncio.get_running_loop():
+            self._next_step = None  # started by an event loop that is gone (offline callers using asyncio.run)
+        if self._next_step is None:
+            self._next_step = self._on_worker(self._step)
+        try:
+            raw = await self._next_step
+        finally:
+            self._next_step = None
+        finished = {o.seq_id for o in raw if o.finished}
+        if any(seq_id not in finished for seq_id in self._live):
+            self._next_step = self._on_worker(self._step)
+        return self._detokenize(raw)
+
+    def _step(self) -> List[StepOutput]:
+        """One iteration on the worker thread; outputs carry token ids only (no text yet)."""
+        self._drain_inbox()
+        outputs: list[StepOutput] = []
+        decoding = self._reserve_decode(list(self._running.values()))
+        new = self._admit_waiting(outputs)
+        self._steps += 1
+
+        with torch.inference_mode(), self._annotate(decoding + new):
+            if new:
+                # prefill only what the prefix cache did not already cover
+                chunks = [s.all_ids[s.num_cached:] for s in new]
+                self._record_padding(chunks)
+                start = time.perf_counter()
+                new, logits = self._forward_last(new, chunks, outputs)
+                for s in new:
+                    self.prefix.insert(self._kv_scope(s), s.prompt_ids, self.kv.alloc.tables[s.seq_id])
+                if new:
+                    new, logits = self._fork(new, logits)
+                    outputs += self._append_tokens(new, [[t] for t in self._sample_next(logits, new)])
+                FORWARD_TOKENS_PER_S.labels(phase="prefill").observe(
+                    sum(len(c) for c in chunks) / (time.perf_counter() - start))
+            self._fail_forks(outputs)
+            if decoding:
+                start, before = time.perf_counter(), len(outputs)
+                if self.spec is not None:
+                    outputs += self._spec_decode(decoding)
+                else:
+                    decoding, logits = self._forward_last(decoding, [s.all_ids[-1:] for s in decoding], outputs,
+                                                          decode=True)
+                    if decoding:
+                        outputs += self._append_tokens(decoding, [[t] for t in self._sample_next(logits, decoding)])
+                FORWARD_TOKENS_PER_S.labels(phase="decode").observe(
+                    sum(len(o.token_ids) for o in outputs[before:]) / (time.perf_counter() - start))
+
+        if not self._running:
+            self._dense = None
+        self.kv.publish_metrics()
+        return outputs
+
+    def _record_padding(self, chunks: List[List[int]]) -> None:
+        real = sum(len(c) for c in chunks)
+        padded = len(chunks) * max(len(c) for c in chunks)
+        PREFILL_TOKENS.labels(kind="real").inc(real)
+        PREFILL_TOKENS.labels(kind="padded").inc(padded)
+        PREFILL_PADDING_EFFICIENCY.observe(real / padded)
+
+    def _drain_inbox(self) -> None:
+        while not self._inbox.empty():
+            op, arg = self._inbox.get()
+            if op == "add" and any(s.seq_id == arg.fork_of and not s.output_ids for s in self._waiting):
+                self._forks.setdefault(arg.fork_of, []).append(arg)
+            elif op == "add":
+                # a fork whose parent was already prefilled (a step drained the inbox between the
+                # two adds) runs as a sequence of its own; the prefix cache still shares the prompt
+                arg.fork_of = None
+                self._waiting.append(arg)
+            else:
+                aborted = next((s for s in self._waiting if s.seq_id == arg), None)
+                self._waiting = [s for s in self._waiting if s.seq_id != arg]
+                self._release(arg)
+                for forks in self._forks.values():
+                    forks[:] = [s for s in forks if s.seq_id != arg]
+                forks = self._forks.pop(arg, [])
+                if forks and aborted is not None:
+                    # aborted before its prefill: the first fork is prefilled instead
+                    first, rest = forks[0], forks[1:]
+                    first.fork_of, first.prompt_ids = None, aborted.prompt_ids
+                    self._waiting.append(first)
+                    for s in rest:
+                        s.fork_of = first.seq_id
+                    if rest:
+                        self._forks[first.seq_id] = rest
+
+    def _detokenize(self, raw: List[StepOutput]) -> List[StepOutput]:
+        """Event-loop half of a step: add text to the worker's outputs, drop aborted rows."""
+        start = time.perf_counter()
+        outputs = []
+        for out in raw:
+            live = self._live.get(out.seq_id)
+            if live is None:
+                continue  # aborted while the step was running
+            d = live.detok
+            delta = d.add(out.token_ids, final=out.finished)
+            if live.req.stream:
+                out.text = delta
+            if d.stopped and not out.finished:
+                # stop string: leave the batch now instead of decoding on to max_tokens
+                self.abort_sequence(out.seq_id)
+                out.finished = True
+                out.result = GenerateResult(text="", tokens=len(d.ids), prompt_tokens=live.prompt_tokens,
+                                            finish_reason="stop")
+            if out.finished:
+                self._live.pop(out.seq_id, None)
+                if out.result is not None:
+                    out.result.text = d.text
+                    if d.stopped:
+                        out.result.finish_reason = "stop"  # even when the stop string completed on the last token
+                    saved = live.req.max_tokens - out.result.tokens
+                    if saved > 0:
+                        WASTED_TOKENS_AVOIDED.labels(reason="stop" if d.stopped else "eos").inc(saved)
+            outputs.append(out)
+        STAGE_MS.labels(stage="detokenize").observe((time.perf_counter() - start) * 1000)
+        return outputs
+
+    def _reserve_decode(self, seqs: List["_Sequence"]) -> List["_Sequence"]:
+        """Reserve one more KV slot per running sequence, preempting the shortest on shortage."""
+        ready = []
+        for s in sorted(seqs, key=lambda s: s.num_cached, reverse=True):
+            if self._allocate(s.seq_id, s.num_cached + 1, write_from=s.num_cached):
+                ready.append(s)
+                continue
+            logger.warning("KV cache full; preempting %s (%d tokens)", s.seq_id, s.num_cached)
+            KV_PREEMPTIONS.inc()
+            self._running.pop(s.seq_id, None)
+            self._dense = None
+            self.kv.free(s.seq_id)
+            s.num_cached = 0
+            self._waiting.insert(0, s)
+        return ready
+
+    def _admit_waiting(self, outputs: List[StepOutput]) -> List["_Sequence"]:
+        """
+        Pop waiting sequences (FIFO) whose full token list fits in the KV cache and whose
+        prefill (and the decode step after it) fits the activation budget.
+        """
+        admitted = []
+        while self._waiting:
+            s = self._waiting[0]
+            if (admitted or self._running) and not self._fits_memory(admitted + [s]):
                 break
-            yield chunk
-
-    async def stream_generate_batch(self, reqs: List[GenerateRequest]) -> List[AsyncIterator[GenerateResult]]:
-        async def _one(r: GenerateRequest):
-            for _ in range(3):
-                yield GenerateResult(text="...", tokens=1)
-                await asyncio.sleep(0.05)
-        return [ _one(r) for r in reqs ]
-
-    async def stream_generate_single(self, req: GenerateRequest):
+            if self._allocate_prompt(s):
+                admitted.append(self._waiting.pop(0))
+            elif not admitted and not self._running:
+                # nothing else holds KV: this sequence can never fit
+                self._waiting.pop(0)
+                error = f"prompt needs {len(s.all_ids)} tokens of KV cache; capacity is too small"
+                outputs.append(StepOutput(seq_id=s.seq_id, token_ids=[], finished=True, error=error))
+            else:
+                break
+        return admitted
+
+    def _fits_memory(self, group: List["_Sequence"]) -> bool:
+        if self._activation_budget is None:
+            return True
+        longest = max(len(s.all_ids) for s in group)
+        running = max([s.num_cached + 1 for s in self._running.values()], default=0)
+        context = max(longest, running)
+        # the prefill runs while the last decode step's dense cache, padded to the longest
+        # running row, is still held (see _forward); the decode forward counts it among its copies
+        kept = self.memory.dense_cache_bytes(len(self._running), running)
+        need = max(self.memory.activation_bytes(len(group), longest) + kept,
+                   self.memory.activation_bytes(len(self._running) + len(group), 1, context))
+        return need <= self._activation_budget
+
+    def _allocate_prompt(self, s: "_Sequence") -> bool:
+        """Reuse the longest cached prefix, then reserve blocks for the rest of the prompt."""
+        blocks, cached = self.prefix.lookup(self._kv_scope(s), s.all_ids)
+        if cached:
+            self.kv.share(s.seq_id, blocks, cached)
+        if self._allocate(s.seq_id, len(s.all_ids), write_from=cached):
+            s.num_cached = cached
+            self.prefix.record(cached)
+            return True
+        self.kv.free(s.seq_id)
+        return False
+
+    def _allocate(self, seq_id: str, tokens: int, write_from: Optional[int] = None) -> bool:
         """
-        Async generator yielding text chunks as they are produced.
-        NOTE: single-request path (no batching).
+        Reserve KV for `tokens` tokens, reclaiming idle prefix-cache blocks if short. With
+        `write_from`, the shared blocks (forks, cached prefixes) that positions
+        write_from..tokens-1 will be written to are copied now as well, so the forward
+        cannot run out of blocks halfway through its writes.
         """
-        prompt = req.prompt
-        do_sample = (req.temperature or 0) > 0
-        tok = self.tokenizer(
-            [prompt], return_tensors="pt", padding=False, truncation=True
-        )
-        input_ids = tok["input_ids"].to(self.model.device)
-        attn_mask = tok.get("attention_mask")
-        if attn_mask is not None:
-            attn_mask = attn_mask.to(self.model.device)
-
-        # streamer will yield decoded text *incrementally*
-        streamer = TextIteratorStreamer(
-            self.tokenizer, skip_prompt=True, skip_special_tokens=True
-        )
+        def reserve() -> bool:
+            if self.kv.allocate(seq_id, tokens) is None:
+                return False
+            return write_from is None or self.kv.unshare(seq_id, write_from, tokens)
+
+        if reserve():
+            return True
+        have = len(self.kv.alloc.tables.get(seq_id, ()))
+        copies = 0 if write_from is None else self.kv.alloc.shared_in(seq_id, write_from, tokens)
+        short = self.kv.alloc.blocks_for(tokens) - have + copies - self.kv.alloc.free_blocks()
+        self.prefix.evict(short, reclaim=True)
+        return reserve()
+
+    def _kv_scope(self, s: "_Sequence") -> Optional[str]:
+        """Adapter whose weights produce this sequence's K/V (prefix-cache namespace)."""
+        # PEFT mode: the scheduler only batches rows of the selected adapter (see _adapter_scope)
+        return s.req.adapter_id
+
+    def _forward(self, seqs: List["_Sequence"], chunks: List[List[int]], keep: int = 1,
+                 decode: bool = False) -> torch.Tensor:
+        """
+        Extend each sequence by its chunk of tokens in one batched forward pass.
+
+        Cached K/V are gathered from the paged store into a left-padded batch cache
+        ([pad | cached] for every row), the new tokens are left-padded after it, and the
+        resulting K/V of the real new tokens are written back into each row's blocks.
+        Prefill (nothing cached) and decode (one token) are the two common cases.
+
+        A one-token decode step leaves its output cache in that same left-padded layout,
+        one position wider, so it is kept for the next decode: while the batch keeps
+        its rows, nothing is gathered (rows that left are dropped, leading padding no
+        row needs is sliced off). Returns the logits of the last `keep` positions,
+        [batch, keep, vocab].
+        """
+        past_lens = [s.num_cached for s in seqs]
+        past_w = max(past_lens)
+        new_w = max(len(c) for c in chunks)
+        input_ids = torch.full((len(seqs), new_w), self.tokenizer.pad_token_id, dtype=torch.long)
+        position_ids = torch.zeros((len(seqs), new_w), dtype=torch.long)
+        attn_mask = torch.zeros((len(seqs), past_w + new_w), dtype=torch.long)
+        for i, (n_past, chunk) in enumerate(zip(past_lens, chunks)):
+            n = len(chunk)
+            input_ids[i, new_w - n:] = torch.tensor(chunk)
+            position_ids[i, new_w - n:] = torch.arange(n_past, n_past + n)
+            attn_mask[i, past_w - n_past:past_w] = 1
+            attn_mask[i, past_w + new_w - n:] = 1
+
+        past = self._dense_past(seqs, past_w) if decode and past_w else None
+        if past is None and past_w:
+            past = to_cache(self.kv.gather([s.seq_id for s in seqs], past_lens, past_w))
+
+        self._set_row_adapters(seqs)
+        extra = {"logits_to_keep": keep} if self._has_logits_to_keep else {}
+        with self._adapter_scope(seqs):
+            out = self.model(
+                input_ids=input_ids.to(self.model.device),
+                attention_mask=attn_mask.to(self.model.device),
+                position_ids=position_ids.to(self.model.device),
+                past_key_values=past,
+                use_cache=True,
+                **extra,
+            )
+        layers = cache_layers(out.past_key_values)
+        for i, (s, chunk) in enumerate(zip(seqs, chunks)):
+            lo = past_w + new_w - len(chunk)
+            self.kv.write(s.seq_id, s.num_cached, [(k[i, :, lo:], v[i, :, lo:]) for k, v in layers])
+            s.num_cached += len(chunk)
+        if decode and new_w == 1:
+            self._dense = ([(s.seq_id, s.num_cached) for s in seqs], out.past_key_values)
+        return out.logits[:, -keep:, :]
+
+    def _dense_past(self, seqs: List["_Sequence"], width: int):
+        """The kept decode cache narrowed to `seqs`, if it holds exactly their cached K/V; else None."""
+        if self._dense is None:
+            return None
+        ids, cache = self._dense
+        row = {seq_id: (i, n) for i, (seq_id, n) in enumerate(ids)}
+        # dropped either way: a gathered batch is never held alongside it
+        self._dense = None
+        if any(row.get(s.seq_id, (0, -1))[1] != s.num_cached for s in seqs):
+            return None
+        index = [row[s.seq_id][0] for s in seqs]
+        keep = None if index == list(range(len(ids))) else torch.tensor(index, device=self.model.device)
+        return narrow_cache(cache, keep, width)
+
+    def _forward_last(self, seqs: List["_Sequence"], chunks: List[List[int]], outputs: List[StepOutput],
+                      decode: bool = False) -> Tuple[List["_Sequence"], Optional[torch.Tensor]]:
+        """`_forward_or_split` keeping the last position only: logits [ran, vocab]."""
+        seqs, logits = self._forward_or_split(seqs, chunks, outputs, decode=decode)
+        return seqs, None if logits is None else logits[:, -1]
+
+    def _forward_or_split(self, seqs: List["_Sequence"], chunks: List[List[int]], outputs: List[StepOutput],
+                          keep: int = 1, decode: bool = False) -> Tuple[List["_Sequence"], Optional[torch.Tensor]]:
+        """
+        `_forward`, except that a batch that runs out of memory is split in half and each
+        half retried; a single sequence that still does not fit is finished with an error
+        in `outputs`. Returns the sequences that ran (in order) and their logits,
+        [ran, keep, vocab] (a row's positions are the last ones).
+        """
+        cached = [s.num_cached for s in seqs]
+        try:
+            return seqs, self._forward(seqs, chunks, keep=keep, decode=decode)
+        except Exception as ex:
+            if not is_out_of_memory(ex):
+                raise
+            error = ex
+        for s, n in zip(seqs, cached):
+            s.num_cached = n  # K/V written before the failure is simply rewritten
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+        self.memory.grow()
+        if len(seqs) == 1:
+            logger.error("Out of memory on a single sequence %s (%d tokens)", seqs[0].seq_id, len(seqs[0].all_ids))
+            self._release(seqs[0].seq_id)
+            outputs.append(StepOutput(seq_id=seqs[0].seq_id, token_ids=[], finished=True,
+                                      error=f"out of memory: {error!r}"))
+            return [], None
+        OOM_BATCH_SPLITS.inc()
+        logger.warning("Out of memory on a batch of %d; retrying in halves", len(seqs))
+        mid = len(seqs) // 2
+        ran, logits = [], []
+        for part in (slice(0, mid), slice(mid, None)):
+            part_seqs, part_logits = self._forward_or_split(seqs[part], chunks[part], outputs, keep, decode)
+            if part_seqs:
+                ran += part_seqs
+                logits.append(part_logits)
+        if not logits:
+            return ran, None
+        width = max(part.shape[1] for part in logits)  # a half may have shorter chunks: left-pad its logits
+        return ran, torch.cat([torch.nn.functional.pad(part, (0, 0, width - part.shape[1], 0)) for part in logits])
+
+    def _spec_decode(self, seqs: List["_Sequence"]) -> List[StepOutput]:
+        """
+        Speculative decode step: each row feeds [last token + its drafts] through the
+        target in a single forward pass; rejection sampling decides how many drafts
+        survive, and the K/V written for rejected drafts is dropped again.
+        """
+        drafts = []
+        for s in seqs:
+            tokens, q = self.spec.draft(s.seq_id, s.all_ids, s.req, s.generator)
+            room = max(0, s.req.max_tokens - len(s.output_ids) - 1)  # never draft past max_tokens
+            tokens = tokens[:room]
+            if tokens and not self._allocate(s.seq_id, s.num_cached + 1 + len(tokens), write_from=s.num_cached):
+                tokens = []
+            drafts.append((tokens, q[:len(tokens)] if q is not None and tokens else None))
+
+        chunks = [s.all_ids[-1:] + tokens for s, (tokens, _) in zip(seqs, drafts)]
+        width = max(len(c) for c in chunks)
+        outputs: List[StepOutput] = []
+        ran, logits = self._forward_or_split(seqs, chunks, outputs, keep=width, decode=True)
+        ran_ids = {s.seq_id for s in ran}
+        rows = [(s, d, c) for s, d, c in zip(seqs, drafts, chunks) if s.seq_id in ran_ids]
+
+        emitted = []
+        for i, (s, (tokens, q), chunk) in enumerate(rows):
+            n = len(chunk)
+            # row j scores the token following chunk[j]
+            contexts = [s.all_ids + tokens[:j] for j in range(n)]
+            p = target_probs_for(logits[i, -n:], [s.req] * n, [s.generator] * n, contexts)
+            accepted = self.spec.accept(s.seq_id, tokens, q, p, s.generator)
+            self._score([s], logits[i:i + 1, -n:], [accepted])
+            s.num_cached -= n - len(accepted)  # K/V of rejected drafts is invalid
+            self.kv.truncate(s.seq_id, s.num_cached)
+            emitted.append(accepted)
+        return outputs + self._append_tokens(ran, emitted)
+
+    def _adapter_scope(self, seqs: List["_Sequence"]):
+        """PEFT mode: a base-model batch bypasses the selected adapter instead of running through it."""
+        if self.multi_lora is None and _HAS_PEFT and isinstance(self.model, PeftModel) and seqs[0].req.adapter_id is None:
+            return self.model.disable_adapter()
+        return contextlib.nullcontext()
+
+    def _set_row_adapters(self, seqs: List["_Sequence"]) -> None:
+        if self.multi_lora is not None:
+            self.multi_lora.set_rows([s.req.adapter_id for s in seqs])
+
+    def _sample_next(self, logits: torch.Tensor, seqs: List["_Sequence"]) -> List[int]:
+        """Sample every row with its own parameters in one vectorized pass."""
+        batch = SamplingBatch.from_requests([s.req for s in seqs], [s.generator for s in seqs], logits.device)
+        context = [s.all_ids for s in seqs] if any(s.req.repetition_penalty != 1.0 for s in seqs) else None
+        tokens = sample(logits, batch, context).tolist()
+        self._score(seqs, logits.unsqueeze(1), [[t] for t in tokens])
+        return tokens
+
+    def _score(self, seqs: List["_Sequence"], logits: torch.Tensor, tokens: List[List[int]]) -> None:
+        """best_of rows: add the model log-probabilities of their new tokens (logits [rows, >=len, vocab])."""
+        for i, s in enumerate(seqs):
+            if _ranked(s.req) and tokens[i]:
+                logprobs = torch.log_softmax(logits[i, :len(tokens[i])].float(), dim=-1)
+                s.logprob += logprobs[torch.arange(len(tokens[i])), torch.tensor(tokens[i])].sum().item()
+
+    def _fork(self, seqs: List["_Sequence"], logits: torch.Tensor) -> Tuple[List["_Sequence"], torch.Tensor]:
+        """
+        Add the forks waiting for these just-prefilled sequences (n > 1): each shares its
+        parent's prompt blocks copy-on-write and gets a copy of its logits row.
+        """
+        if not self._forks:
+            return seqs, logits
+        rows, index = [], []
+        for i, s in enumerate(seqs):
+            rows.append(s)
+            index.append(i)
+            for f in self._forks.pop(s.seq_id, ()):
+                self.kv.fork(s.seq_id, f.seq_id)
+                f.prompt_ids, f.num_cached = s.prompt_ids, s.num_cached
+                rows.append(f)
+                index.append(i)
+        return rows, logits[index]
+
+    def _fail_forks(self, outputs: List[StepOutput]) -> None:
+        """Forks of a sequence that failed before its prefill finish with the same error."""
+        for out in [o for o in outputs if o.error and o.seq_id in self._forks]:
+            outputs += [StepOutput(seq_id=f.seq_id, token_ids=[], finished=True, error=out.error)
+                        for f in self._forks.pop(out.seq_id)]
+
+    def _append_tokens(self, seqs: List["_Sequence"], token_lists: List[List[int]]) -> List[StepOutput]:
+        outputs = []
+        for s, tokens in zip(seqs, token_lists):
+            emitted = []
+            finished = False
+            for tok in tokens:
+                s.output_ids.append(tok)
+                emitted.append(tok)
+                finished = tok in self._eos_ids or len(s.output_ids) >= max(1, s.req.max_tokens)
+                if finished:
+                    break
+            result = None
+            if finished:
+                self._release(s.seq_id)
+                # text is filled in by _detokenize on the event loop
+                reason = "stop" if emitted[-1] in self._eos_ids else "length"
+                result = GenerateResult(text="", tokens=len(s.output_ids), prompt_tokens=len(s.prompt_ids),
+                                        finish_reason=reason, logprob=s.logprob if _ranked(s.req) else None)
+            else:
+                self._running[s.seq_id] = s
+            outputs.append(StepOutput(seq_id=s.seq_id, token_ids=emitted, finished=finished, result=result))
+        return outputs
 
-        gen_kwargs = dict(
-            input_ids=input_ids,
-            attention_mask=attn_mask,
-            max_new_tokens=max(1, req.max_tokens),
-            do_sample=do_sample,
-            temperature=req.temperature if do_sample else None,
-            top_p=req.top_p if do_sample else None,
-            pad_token_id=self.tokenizer.pad_token_id,
-            eos_token_id=self.tokenizer.eos_token_id,
-            streamer=streamer,
-        )
+    def _release(self, seq_id: str) -> None:
+        self._running.pop(seq_id, None)
+        self.kv.free(seq_id)
+        if self.spec is not None:
+            self.spec.forget(seq_id)
 
-        # Run .generate() in a background thread, read tokens here
-        def _run():
-            try:
-                with torch.inference_mode():
-                    self.model.generate(**gen_kwargs)
-            except Exception as e:
-                logger.exception("stream generate failed: %s", e)
-                # close streamer by stopping iteration
-                try:
-                    streamer.on_finalized_text()
-                except Exception:
-                    pass
-
-        t = threading.Thread(target=_run, daemon=True)
-        t.start()
-
-        # The streamer is an iterator that blocks until next chunk is available.
-        # Bridge it to an async generator:
-        loop = asyncio.get_event_loop()
-        while True:
-            chunk = await loop.run_in_executor(None, next, streamer, None)
-            if chunk is None:
-                break
-            yield chunk
+    async def generate_batch(self, reqs: List[GenerateRequest]) -> List[GenerateResult]:
+        """
+        Convenience driver: run `reqs` through the step loop until all of them finish.
+        Used by tests/offline callers; the server drives step() from DynamicBatcher instead.
+        """
+        logger.debug("generate_batch called with %d reqs", len(reqs))
+        seq_ids = [f"gb-{next(self._gb_ids)}" for _ in reqs]
+        for seq_id, r in zip(seq_ids, reqs):
+            self.add_sequence(seq_id, r)
+
+        pending = set(seq_ids)
+        results: dict[str, GenerateResult] = {}
+        while pending:
+            for out in await self.step():
+                if out.finished and out.seq_id in pending:
+                    if out.error:
+                        for seq_id in pending:
+                            self.abort_sequence(seq_id)
+                        raise RuntimeError(out.error)
+                    results[out.seq_id] = out.result
+                    pending.discard(out.seq_id)
+        return [results[i] for i in seq_ids]
 
     async def verify_batch(self, reqs: List[VerifyRequest]) -> List[VerifyResult]:
-        # Accept all as a placeholder
-        return [ VerifyResult(accepted=len(r.proposed), text="(verified)", tokens=len(r.proposed)) for r in reqs ]
+        """
+        Greedy verification of externally proposed tokens: prompt + proposal go through
+        the target in one forward pass per batch; the longest prefix matching the
+        target's argmax is accepted, followed by the target's own next token.
+        """
+        seqs = [
+            _Sequence(seq_id=f"verify-{next(self._gb_ids)}", req=GenerateRequest(prompt=r.prompt, temperature=0),
+                      prompt_ids=self.tokenizer(r.prompt, truncation=True)["input_ids"])
+            for r in reqs
+        ]
+        chunks = [s.prompt_ids + list(r.proposed) for s, r in zip(seqs, reqs)]
+        width = max(len(c) for c in chunks)
+        logits = await self._on_worker(self._verify_forward, seqs, chunks, width)
+
+        results = []
+        for i, (s, r, chunk) in enumerate(zip(seqs, reqs, chunks)):
+            # position of the logits that predict proposed[0]
+            base = width - len(chunk) + len(s.prompt_ids) - 1
+            greedy = logits[i, base:base + len(r.proposed) + 1].argmax(dim=-1).tolist()
+            accepted = 0
+            while accepted < len(r.proposed) and r.proposed[accepted] == greedy[accepted]:
+                accepted += 1
+            tokens = list(r.proposed[:accepted]) + [greedy[accepted]]
+            text = self.tokenizer.decode(tokens, skip_special_tokens=True)
+            results.append(VerifyResult(accepted=accepted, text=text, tokens=len(tokens)))
+        return results
+
+    def _verify_forward(self, seqs: List["_Sequence"], chunks: List[List[int]], width: int) -> torch.Tensor:
+        try:
+            for s, chunk in zip(seqs, chunks):
+                if not self._allocate(s.seq_id, len(chunk)):
+                    raise MemoryError("KV cache too small for verification batch")
+            with torch.inference_mode():
+                return self._forward(seqs, chunks, keep=width)
+        finally:
+            for s in seqs:
+                self.kv.free(s.seq_id)
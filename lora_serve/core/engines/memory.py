@@ -0,0 +1,102 @@
+# Memory model of a loaded engine: weights + paged KV + per-step activation peak
+import logging
+from dataclasses import dataclass
+from typing import Callable, Iterable, Tuple
+
+import torch
+
+from .cache_utils import kv_bytes_per_token
+
+logger = logging.getLogger(__name__)
+
+# (rows, new tokens per row, cached tokens per row, kept logit positions)
+Shape = Tuple[int, int, int, int]
+
+
+@dataclass
+class MemoryModel:
+    """
+    Bytes an engine needs: resident weights, K/V per cached token, and the transient
+    peak of one forward pass over a left-padded [rows, past + new] batch. That peak is
+    modelled as hidden states per new token, attention scores per (query, key) pair,
+    the kept logits, and dense copies of the cached K/V (the batch gathered from the
+    paged store and the cache's concatenation with the new tokens: `kv_copies` x
+    rows x past). The per-token and K/V-copy terms are fitted to measured peaks at
+    startup (`calibrate`), the rest comes from the model config.
+
+    Between decode steps the engine keeps the last step's output cache, dense and
+    left-padded to the longest row, outside the paged pool (`dense_cache_bytes`);
+    the activation budget pays for it, the KV pool capacity does not.
+    """
+    weight_bytes: int
+    kv_bytes_per_token: int
+    act_bytes_per_token: float
+    score_bytes: int   # one query x key attention score, all heads
+    logit_bytes: int   # one kept row of logits
+    kv_copies: float = 2.0  # dense [rows, past] K/V copies alive during a forward
+    calibrated: bool = False
+
+    @classmethod
+    def for_model(cls, model, dtype: torch.dtype) -> "MemoryModel":
+        """Config-derived estimate (before calibration)."""
+        config = model.config
+        elem = torch.finfo(dtype).bits // 8
+        hidden = config.hidden_size
+        intermediate = getattr(config, "intermediate_size", None) or 4 * hidden
+        weights = sum(p.numel() * p.element_size() for p in model.parameters())
+        weights += sum(b.numel() * b.element_size() for b in model.buffers())
+        kv = kv_bytes_per_token(config, dtype)
+        return cls(
+            weight_bytes=weights,
+            kv_bytes_per_token=kv,
+            # residual + attention projections + MLP gate/up/activation, and the new K/V
+            act_bytes_per_token=(4 * hidden + 3 * intermediate) * elem + kv,
+            score_bytes=2 * config.num_attention_heads * elem,  # scores + softmax
+            logit_bytes=config.vocab_size * (elem + 4),          # logits + fp32 upcast for sampling
+        )
+
+    def activation_bytes(self, rows: int, new: int, past: int = 0, keep: int = 1) -> int:
+        """Transient peak of one forward over `rows` rows of `new` tokens on `past` cached ones."""
+        return int(rows * new * self.act_bytes_per_token
+                   + rows * new * (past + new) * self.score_bytes
+                   + rows * keep * self.logit_bytes
+                   + rows * past * self.kv_copies * self.kv_bytes_per_token)
+
+    def dense_cache_bytes(self, rows: int, context: int) -> int:
+        """Kept decode cache of `rows` rows padded to the longest `context` (alongside the pool)."""
+        return rows * context * self.kv_bytes_per_token
+
+    def calibrate(self, measure: Callable[[Shape], int], shapes: Iterable[Shape]) -> None:
+        """
+        Refit from peaks measured by `measure(shape)` (bytes above the resident
+        baseline): the per-token term from the shapes without cached tokens, then the
+        K/V-copy term from the rest (decode steps over a long context). The largest
+        residual wins each time, so the estimate stays an upper bound for the shapes seen.
+        """
+        shapes = sorted(shapes, key=lambda shape: shape[2] > 0)
+        per_token, copies = [], []
+        for rows, new, past, keep in shapes:
+            peak = measure((rows, new, past, keep))
+            rest = peak - rows * new * (past + new) * self.score_bytes - rows * keep * self.logit_bytes
+            if past == 0:
+                per_token.append(max(rest, 0) / (rows * new))
+            else:
+                rest -= rows * new * (max(per_token) if per_token else self.act_bytes_per_token)
+                copies.append(max(rest, 0) / (rows * past * self.kv_bytes_per_token))
+            logger.debug("Memory probe %s: peak %.1f MiB", (rows, new, past, keep), peak / 2**20)
+        if per_token:
+            self.act_bytes_per_token = max(per_token)
+        if copies:
+            self.kv_copies = max(copies)
+        self.calibrated = bool(per_token or copies)
+
+    def grow(self, factor: float = 1.25) -> None:
+        """A forward ran out of memory within the estimate: be more conservative from now on."""
+        self.act_bytes_per_token *= factor
+        self.kv_copies *= factor
+
+
+def is_out_of_memory(ex: BaseException) -> bool:
+    """Allocation failure of a forward pass (CUDA OOM or a host MemoryError)."""
+    oom = getattr(torch, "OutOfMemoryError", None) or getattr(torch.cuda, "OutOfMemoryError", ())
+    return isinstance(ex, (MemoryError, oom)) or (isinstance(ex, RuntimeError) and "out of memory" in str(ex))
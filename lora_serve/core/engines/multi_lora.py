@@ -0,0 +1,211 @@
+
+# Mixed-adapter LoRA: several adapters stay resident as stacked A/B matrices and each
+# batch row picks its own adapter (gathered "BGMV"-style matmuls, plain torch).
+import json
+import logging
+import math
+import mmap
+import re
+import struct
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+_KEY_RE = re.compile(r"^(?:base_model\.model\.)?(?P<module>.+)\.lora_(?P<ab>[AB])(?:\.[^.]+)?\.weight$")
+
+_ST_DTYPES = {"F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+              "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8,
+              "BOOL": torch.bool}
+
+# {module_name: (A [r, in], B [out, r])}
+LoRAWeights = Dict[str, Tuple[torch.Tensor, torch.Tensor]]
+
+
+def load_lora_weights(path: str, mmap_file: bool = False) -> Tuple[dict, LoRAWeights]:
+    """
+    Read a PEFT LoRA checkpoint into (adapter_config, weights). With `mmap_file` the
+    tensors are zero-copy views of the mapped file, so host memory is the page cache.
+    """
+    root = Path(path)
+    config = json.loads((root / "adapter_config.json").read_text())
+    if config.get("peft_type", "LORA") != "LORA" or config.get("use_dora"):
+        raise ValueError(f"Adapter at {path} is not a plain LoRA adapter")
+
+    st_file = root / "adapter_model.safetensors"
+    if st_file.exists() and mmap_file:
+        state = _mmap_safetensors(st_file)
+    elif st_file.exists():
+        from safetensors.torch import load_file
+        state = load_file(str(st_file))
+    else:
+        state = torch.load(root / "adapter_model.bin", map_location="cpu", weights_only=True, mmap=mmap_file)
+
+    pairs: Dict[str, Dict[str, torch.Tensor]] = {}
+    for key, tensor in state.items():
+        m = _KEY_RE.match(key)
+        if m:
+            pairs.setdefault(m.group("module"), {})[m.group("ab")] = tensor
+    weights = {name: (ab["A"], ab["B"]) for name, ab in pairs.items() if "A" in ab and "B" in ab}
+    return config, weights
+
+
+def lora_nbytes(weights: LoRAWeights) -> int:
+    return sum(t.numel() * t.element_size() for ab in weights.values() for t in ab)
+
+
+def _mmap_safetensors(path: Path) -> Dict[str, torch.Tensor]:
+    """Tensors of a .safetensors file as read-only views over an mmap of it."""
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)  # copy-on-write: torch wants a writable buffer
+    (header_len,) = struct.unpack("<Q", buf[:8])
+    header = json.loads(buf[8:8 + header_len])
+    base = 8 + header_len
+    state = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        start, end = info["data_offsets"]
+        dtype = _ST_DTYPES[info["dtype"]]
+        count = (end - start) // torch.empty((), dtype=dtype).element_size()
+        state[name] = torch.frombuffer(buf, dtype=dtype, count=count, offset=base + start).view(info["shape"])
+    return state
+
+
+def _scaling(config: dict, module_name: str, rank: int) -> float:
+    alpha = config.get("lora_alpha", rank)
+    for pattern, value in (config.get("alpha_pattern") or {}).items():
+        if re.search(pattern, module_name):
+            alpha = value
+    return alpha / math.sqrt(rank) if config.get("use_rslora") else alpha / rank
+
+
+class _RowAdapters:
+    """Per-forward row -> slot mapping shared by every wrapped projection."""
+
+    def __init__(self):
+        self.slots: Optional[torch.Tensor] = None  # [batch] long, slot 0 = base model
+
+
+class MultiLoRALinear(nn.Module):
+    """
+    nn.Linear plus a stack of LoRA deltas: y = base(x) + s[i] * B[i] @ A[i] @ x for each
+    row's slot i. Slot 0 is all-zero (base model); ranks are zero-padded to the stack max.
+    """
+
+    def __init__(self, base: nn.Linear, rows: _RowAdapters):
+        super().__init__()
+        self.base = base
+        self.rows = rows
+        w = base.weight
+        self.lora_a = torch.zeros((1, 0, base.in_features), dtype=w.dtype, device=w.device)
+        self.lora_b = torch.zeros((1, base.out_features, 0), dtype=w.dtype, device=w.device)
+        self.scaling = torch.zeros(1, dtype=w.dtype, device=w.device)
+
+    def set_slot(self, slot: int, a: Optional[torch.Tensor], b: Optional[torch.Tensor], scaling: float):
+        num_slots = max(self.lora_a.shape[0], slot + 1)
+        rank = max(self.lora_a.shape[1], a.shape[0] if a is not None else 0)
+        if num_slots != self.lora_a.shape[0] or rank != self.lora_a.shape[1]:
+            self._resize(num_slots, rank)
+        self.lora_a[slot].zero_()
+        self.lora_b[slot].zero_()
+        self.scaling[slot] = 0.0
+        if a is not None:
+            r = a.shape[0]
+            self.lora_a[slot, :r] = a.to(self.lora_a)
+            self.lora_b[slot, :, :r] = b.to(self.lora_b)
+            self.scaling[slot] = scaling
+
+    def _resize(self, num_slots: int, rank: int):
+        old_a, old_b, old_s = self.lora_a, self.lora_b, self.scaling
+        self.lora_a = old_a.new_zeros((num_slots, rank, old_a.shape[2]))
+        self.lora_b = old_b.new_zeros((num_slots, old_b.shape[1], rank))
+        self.scaling = old_s.new_zeros(num_slots)
+        self.lora_a[:old_a.shape[0], :old_a.shape[1]] = old_a
+        self.lora_b[:old_b.shape[0], :, :old_b.shape[2]] = old_b
+        self.scaling[:old_s.shape[0]] = old_s
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        y = self.base(x)
+        slots = self.rows.slots
+        if slots is None or self.lora_a.shape[1] == 0:
+            return y
+        # gather each row's A/B: [batch, r, in] / [batch, out, r]; x is [batch, tokens, in].
+        # Rows whose adapter does not target this projection hit zero-scaled slots.
+        a = self.lora_a[slots]
+        b = self.lora_b[slots]
+        delta = torch.bmm(torch.bmm(x.to(a.dtype), a.transpose(1, 2)), b.transpose(1, 2))
+        return y + (delta * self.scaling[slots].view(-1, 1, 1)).to(y.dtype)
+
+
+class MultiLoRAModel:
+    """Owns adapter slots and the wrapped projections of one base model."""
+
+    def __init__(self, model: nn.Module):
+        self.model = model
+        self.rows = _RowAdapters()
+        self.slots: Dict[str, int] = {}       # adapter_id -> slot (>= 1)
+        self._free: List[int] = []
+        self._next_slot = 1
+        self._layers: Dict[str, MultiLoRALinear] = {}
+        self._targets: Dict[str, List[str]] = {}  # adapter_id -> wrapped module names
+
+    def load(self, adapter_id: str, path: str, parsed: Optional[Tuple[dict, LoRAWeights]] = None) -> int:
+        """Make `adapter_id` resident; `parsed` skips reading `path` when the weights are already in memory."""
+        if adapter_id in self.slots:
+            return self.slots[adapter_id]
+        config, weights = parsed if parsed is not None else load_lora_weights(path)
+        slot = self._free.pop() if self._free else self._next_slot
+        if slot == self._next_slot:
+            self._next_slot += 1
+
+        for name, (a, b) in weights.items():
+            layer = self._wrap(name)
+            if layer is None:
+                logger.warning("Adapter %s targets unknown/non-linear module %s; skipped", adapter_id, name)
+                continue
+            layer.set_slot(slot, a, b, _scaling(config, name, a.shape[0]))
+        for layer in self._layers.values():
+            # every stack must be indexable by every live slot, targeted or not
+            if layer.lora_a.shape[0] < self._next_slot:
+                layer._resize(self._next_slot, layer.lora_a.shape[1])
+        self.slots[adapter_id] = slot
+        self._targets[adapter_id] = [n for n in weights if n in self._layers]
+        logger.info("Adapter '%s' resident in slot %d (%d projections)", adapter_id, slot, len(self._targets[adapter_id]))
+        return slot
+
+    def unload(self, adapter_id: str) -> None:
+        slot = self.slots.pop(adapter_id, None)
+        if slot is None:
+            return
+        for name in self._targets.pop(adapter_id, []):
+            self._layers[name].set_slot(slot, None, None, 0.0)
+        self._free.append(slot)
+
+    def set_rows(self, adapter_ids: List[Optional[str]]) -> None:
+        missing = {a for a in adapter_ids if a and a not in self.slots}
+        if missing:
+            # silently running such rows on the base model would return wrong text
+            raise KeyError(f"Adapters not loaded: {sorted(missing)}")
+        slots = [self.slots[a] if a else 0 for a in adapter_ids]
+        device = next(iter(self._layers.values())).lora_a.device if self._layers else "cpu"
+        self.rows.slots = torch.tensor(slots, dtype=torch.long, device=device) if any(slots) else None
+
+    def _wrap(self, name: str) -> Optional[MultiLoRALinear]:
+        if name in self._layers:
+            return self._layers[name]
+        parent_name, _, child = name.rpartition(".")
+        try:
+            parent = self.model.get_submodule(parent_name) if parent_name else self.model
+        except AttributeError:
+            return None
+        base = getattr(parent, child, None)
+        if not isinstance(base, nn.Linear):
+            return None
+        layer = MultiLoRALinear(base, self.rows)
+        setattr(parent, child, layer)
+        self._layers[name] = layer
+        return layer
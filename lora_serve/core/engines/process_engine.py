@@ -0,0 +1,211 @@
+# HFEngine replicas in worker processes, one IEngine proxy per process
+import asyncio
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+import torch
+
+from ...core.logging import configure_logging
+from ...core.types import GenerateRequest, GenerateResult, StepOutput, VerifyRequest, VerifyResult
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessEngine:
+    """
+    IEngine proxy for an HFEngine living in its own process (see `_engine_main`).
+
+    Calls travel over a pipe as (call_id, method, args) and a reader thread resolves
+    the awaiting futures; add_sequence/abort_sequence are fire-and-forget, as on the
+    in-process engine. Adapter weights are read from `path` by the worker process, so
+    the adapter store keeps no parsed host-tier copy for it (`accepts_parsed_adapters`).
+    """
+    accepts_parsed_adapters = False
+
+    def __init__(self, engine_kwargs: dict, cpus: Optional[List[int]] = None, name: str = "engine-0"):
+        ctx = mp.get_context("spawn")
+        self._conn, child = ctx.Pipe()
+        self.name = name
+        self.process = ctx.Process(target=_engine_main, args=(child, engine_kwargs, cpus), name=name, daemon=True)
+        self.process.start()
+        child.close()
+        self.supports_mixed_adapters = bool(engine_kwargs.get("multi_lora"))
+        self.max_batch_tokens: Optional[int] = None  # reported by the worker once its model is loaded
+        self._calls: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count()
+        self._live: Set[str] = set()
+        self._send_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._closing = False
+        self._reader = threading.Thread(target=self._read_replies, name=f"{name}-reader", daemon=True)
+        self._reader.start()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> None:
+        """Block until the worker has loaded its model."""
+        if not self._ready.wait(timeout) or not self.process.is_alive():
+            raise RuntimeError(f"{self.name} failed to start (exit code {self.process.exitcode})")
+
+    def close(self, timeout: float = 5) -> None:
+        self._closing = True
+        self._send((None, "close", ()))
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    async def warmup(self, adapters: Optional[Dict[str, str]] = None) -> None:
+        await self._call("warmup", adapters)
+
+    async def attach_adapter(self, adapter_id: str, path: str, parsed=None) -> None:
+        await self._call("attach_adapter", adapter_id, path)
+
+    async def detach_adapter(self, adapter_id: str) -> None:
+        await self._call("detach_adapter", adapter_id)
+
+    async def generate_batch(self, reqs: List[GenerateRequest]) -> List[GenerateResult]:
+        return await self._call("generate_batch", reqs)
+
+    async def start_profile(self) -> None:
+        await self._call("start_profile")
+
+    async def stop_profile(self) -> dict:
+        return await self._call("stop_profile")
+
+    async def verify_batch(self, reqs: List[VerifyRequest]) -> List[VerifyResult]:
+        return await self._call("verify_batch", reqs)
+
+    def add_sequence(self, seq_id: str, req: GenerateRequest, fork_of: Optional[str] = None) -> None:
+        self._live.add(seq_id)
+        self._send((None, "add_sequence", (seq_id, req, fork_of)))
+
+    def abort_sequence(self, seq_id: str) -> None:
+        self._live.discard(seq_id)
+        self._send((None, "abort_sequence", (seq_id,)))
+
+    def has_unfinished(self) -> bool:
+        return bool(self._live)
+
+    async def step(self) -> List[StepOutput]:
+        outputs = await self._call("step")
+        for out in outputs:
+            if out.finished:
+                self._live.discard(out.seq_id)
+        return outputs
+
+    async def _call(self, method: str, *args):
+        fut = asyncio.get_running_loop().create_future()
+        call_id = next(self._ids)
+        self._calls[call_id] = fut
+        self._send((call_id, method, args))
+        return await fut
+
+    def _send(self, msg) -> None:
+        with self._send_lock:
+            self._conn.send(msg)
+
+    def _read_replies(self) -> None:
+        while True:
+            try:
+                call_id, ok, value = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            if call_id is None:
+                self.max_batch_tokens = value
+                self._ready.set()
+                continue
+            fut = self._calls.pop(call_id, None)
+            if fut is not None:
+                fut.get_loop().call_soon_threadsafe(_resolve, fut, ok, value)
+        if not self._closing:
+            logger.error("%s exited", self.name)
+        self._ready.set()  # unblock wait_ready(); it checks is_alive()
+        for fut in list(self._calls.values()):
+            fut.get_loop().call_soon_threadsafe(_resolve, fut, False, f"{self.name} exited")
+        self._calls.clear()
+
+
+def start_engine_processes(n: int, engine_kwargs: dict, pin_threads: bool = True,
+                           share_weights: bool = True, weights_dir: Optional[str] = None) -> List[ProcessEngine]:
+    """
+    Start `n` engine processes (models load in parallel) and wait until all are ready.
+    With `pin_threads` each gets a disjoint slice of this process's CPUs and a matching
+    torch thread count; with `share_weights` CPU replicas map one on-disk copy of the
+    base weights instead of each holding their own.
+    """
+    kwargs = dict(engine_kwargs)
+    if share_weights:
+        root = Path(weights_dir or ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()))
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", f"{kwargs['model_id']}-{kwargs.get('dtype', 'bfloat16')}")
+        kwargs["shared_weights"] = str(root / "lora_serve" / f"{slug}.safetensors")
+    slices = _cpu_slices(n) if pin_threads else [None] * n
+    engines = [ProcessEngine(kwargs, cpus, name=f"engine-{i}") for i, cpus in enumerate(slices)]
+    for engine in engines:
+        engine.wait_ready()
+    logger.info("Started %d engine processes", n)
+    return engines
+
+
+def _cpu_slices(n: int) -> List[Optional[List[int]]]:
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    per = len(cpus) // n
+    if not per:
+        return [None] * n  # fewer CPUs than workers: let the OS schedule
+    return [cpus[i * per:(i + 1) * per] for i in range(n)]
+
+
+def _resolve(fut: asyncio.Future, ok: bool, value) -> None:
+    if fut.done():
+        return
+    if ok:
+        fut.set_result(value)
+    else:
+        fut.set_exception(RuntimeError(value))
+
+
+def _engine_main(conn, engine_kwargs: dict, cpus: Optional[List[int]]) -> None:
+    configure_logging(os.getenv("LORASERVE_LOGLEVEL", "INFO"))
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(len(cpus))
+    asyncio.run(_serve(conn, engine_kwargs))
+
+
+async def _serve(conn, engine_kwargs: dict) -> None:
+    from .hf_engine import HFEngine  # only the worker process loads a model
+
+    engine = HFEngine(**engine_kwargs)
+    conn.send((None, True, engine.max_batch_tokens))  # ready
+    loop = asyncio.get_running_loop()
+    closed = loop.create_future()
+
+    async def reply(call_id: int, method: str, args: tuple):
+        try:
+            result = getattr(engine, method)(*args)
+            if asyncio.iscoroutine(result):
+                result = await result
+            conn.send((call_id, True, result))
+        except Exception as ex:
+            logger.exception("%s failed", method)
+            conn.send((call_id, False, f"{type(ex).__name__}: {ex}"))
+
+    def on_readable():
+        try:
+            call_id, method, args = conn.recv()
+        except (EOFError, OSError):
+            method = "close"
+        if method == "close":
+            loop.remove_reader(conn.fileno())
+            closed.set_result(None)
+        elif call_id is None:
+            getattr(engine, method)(*args)
+        else:
+            loop.create_task(reply(call_id, method, args))
+
+    loop.add_reader(conn.fileno(), on_readable)
+    await closed
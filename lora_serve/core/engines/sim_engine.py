@@ -0,0 +1,265 @@
+# Model-free IEngine whose latency comes from a fitted cost model (scheduler benchmarks)
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ...core.types import GenerateRequest, GenerateResult, StepOutput, VerifyRequest, VerifyResult
+from .engine import IEngine
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CostModel:
+    """
+    Milliseconds charged per engine operation. A step is one prefill forward (when
+    sequences join) plus one decode forward over the rows already running. Both run on
+    left-padded batches, so they are charged by the padded shape:
+
+        prefill = prefill_base_ms + rows * (prefill_ms_per_token * longest + prefill_ms_per_token_sq * longest^2)
+        decode  = decode_base_ms + decode_ms_per_row * rows + decode_ms_per_kv_token * rows * longest context
+
+    Attaching an adapter that is not resident costs `adapter_load_ms`; re-selecting a
+    resident one (single-adapter engines) costs `adapter_switch_ms`. The defaults are
+    only plausible; `profile` fits them to a real engine.
+    """
+    prefill_base_ms: float = 5.0
+    prefill_ms_per_token: float = 0.02
+    prefill_ms_per_token_sq: float = 0.0  # attention over the prompt
+    decode_base_ms: float = 10.0
+    decode_ms_per_row: float = 0.2
+    decode_ms_per_kv_token: float = 0.0002
+    adapter_load_ms: float = 30.0
+    adapter_switch_ms: float = 1.0
+
+    def prefill_ms(self, rows: int, longest: int) -> float:
+        return self.prefill_base_ms + rows * (self.prefill_ms_per_token * longest
+                                              + self.prefill_ms_per_token_sq * longest ** 2)
+
+    def decode_ms(self, rows: int, context: int) -> float:
+        return self.decode_base_ms + self.decode_ms_per_row * rows + self.decode_ms_per_kv_token * rows * context
+
+    def save(self, path: str) -> None:
+        Path(path).write_text(json.dumps(asdict(self), indent=2))
+
+    @classmethod
+    def load(cls, path: str) -> "CostModel":
+        return cls(**json.loads(Path(path).read_text()))
+
+    @classmethod
+    async def profile(cls, engine, adapter: Optional[Tuple[str, str]] = None,
+                      prompt_lens: Sequence[int] = (16, 64, 256, 512, 1024),
+                      batch_sizes: Sequence[int] = (1, 2, 4, 8, 16, 32),
+                      steps: int = 4) -> "CostModel":
+        """
+        Fit the parameters to `engine` (an HFEngine) through its step() API: single-row
+        prefills of `prompt_lens` tokens, then `steps` decode steps at each batch size
+        (one with short and one with long prompts, to separate rows from cached tokens).
+        `adapter` is an (id, path) pair used to time a cold attach and a re-select.
+        """
+        rng = random.Random(0)
+        vocab = len(engine.tokenizer)
+        limit = getattr(engine.model.config, "max_position_embeddings", None) or max(prompt_lens)
+        prompt_lens = sorted({min(n, limit - steps - 1) for n in prompt_lens})
+        ids = itertools.count()
+
+        def request(n: int, max_tokens: int) -> GenerateRequest:
+            # random ids: no prefix-cache hits between probes
+            return GenerateRequest(prompt="", max_tokens=max_tokens, temperature=0,
+                                   prompt_ids=[rng.randrange(10, vocab) for _ in range(n)])
+
+        prefill = []
+        for n in prompt_lens:
+            best = None
+            for _ in range(2):
+                engine.add_sequence(f"profile-{next(ids)}", request(n, 1))
+                start = time.perf_counter()
+                await engine.step()
+                best = min(best or 1e9, (time.perf_counter() - start) * 1000)
+            prefill.append((n, best))
+
+        decode = []
+        for prompt in (min(prompt_lens), max(prompt_lens)):
+            for rows in batch_sizes:
+                for _ in range(rows):
+                    engine.add_sequence(f"profile-{next(ids)}", request(prompt, steps + 1))
+                await engine.step()  # prefill, not measured
+                for i in range(steps):
+                    start = time.perf_counter()
+                    outputs = await engine.step()
+                    if outputs:  # rows that hit EOS early leave the batch
+                        decode.append((len(outputs), prompt + i + 1, (time.perf_counter() - start) * 1000))
+                while engine.has_unfinished():
+                    await engine.step()
+
+        model = cls()
+        coef, _ = _fit([[1, n, n * n] for n, _ in prefill], [ms for _, ms in prefill])
+        model.prefill_base_ms, model.prefill_ms_per_token, model.prefill_ms_per_token_sq = coef
+        coef, err = _fit([[1, rows, rows * context] for rows, context, _ in decode], [ms for _, _, ms in decode])
+        model.decode_base_ms, model.decode_ms_per_row, model.decode_ms_per_kv_token = coef
+        if adapter is not None:
+            adapter_id, path = adapter
+            start = time.perf_counter()
+            await engine.attach_adapter(adapter_id, path)
+            model.adapter_load_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            await engine.attach_adapter(adapter_id, path)
+            model.adapter_switch_ms = (time.perf_counter() - start) * 1000
+            await engine.detach_adapter(adapter_id)
+        logger.info("Cost model fitted from %d prefill / %d decode samples (decode rms error %.2f ms): %s",
+                    len(prefill) * 2, len(decode), err, model)
+        return model
+
+
+def _fit(x: List[List[float]], y: List[float]) -> Tuple[List[float], float]:
+    """Least squares with coefficients clipped at 0 (costs never go down with work); returns (coef, rms error)."""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    coef = np.clip(np.linalg.lstsq(x, y, rcond=None)[0], 0, None)
+    return [float(c) for c in coef], float(np.sqrt(np.mean((x @ coef - y) ** 2)))
+
+
+@dataclass
+class _SimSequence:
+    req: GenerateRequest
+    prompt_tokens: int
+    generated: int = 0
+    text: List[str] = field(default_factory=list)
+
+
+class SimEngine(IEngine):
+    """
+    Stands in for HFEngine without a model. Every step advances each running sequence
+    by one token and sleeps for what `cost` charges for it (times `time_scale`; 0 runs
+    as fast as the event loop allows). Prompts count req.prompt_ids, else chars/4;
+    sequences decode max_tokens tokens unless `eos_prob` ends them early. With
+    `kv_capacity_tokens`, waiting sequences are admitted FIFO only while their prompt +
+    max_tokens fit, instead of HFEngine's grow-and-preempt paged cache. Forks (n > 1)
+    join with their parent, are not charged a prefill and share its prompt tokens.
+    """
+
+    def __init__(self, cost: Optional[CostModel] = None, multi_lora: bool = False, time_scale: float = 1.0,
+                 kv_capacity_tokens: Optional[int] = None, eos_prob: float = 0.0, seed: int = 0):
+        self.cost = cost or CostModel()
+        self.supports_mixed_adapters = multi_lora
+        self.time_scale = time_scale
+        self.kv_capacity_tokens = kv_capacity_tokens
+        self.max_batch_tokens = kv_capacity_tokens  # scheduler budget cap, as on HFEngine
+        self.eos_prob = eos_prob
+        self._rng = random.Random(seed)
+        self._adapters: Dict[str, str] = {}
+        self._waiting: Dict[str, _SimSequence] = {}
+        self._running: Dict[str, _SimSequence] = {}
+        self._forks: Dict[str, List[Tuple[str, _SimSequence]]] = {}  # seq_id -> forks waiting for its prefill
+        self._gb_ids = itertools.count()
+        self.busy_ms = 0.0  # simulated time charged so far
+        self.steps = 0
+
+    async def warmup(self, adapters: Optional[Dict[str, str]] = None) -> None:
+        for adapter_id, path in (adapters or {}).items():
+            await self.attach_adapter(adapter_id, path)
+
+    async def attach_adapter(self, adapter_id: str, path: str, parsed=None) -> None:
+        resident = adapter_id in self._adapters
+        self._adapters[adapter_id] = path
+        await self._charge(self.cost.adapter_switch_ms if resident else self.cost.adapter_load_ms)
+
+    async def detach_adapter(self, adapter_id: str) -> None:
+        self._adapters.pop(adapter_id, None)
+
+    async def generate_batch(self, reqs: List[GenerateRequest]) -> List[GenerateResult]:
+        seq_ids = [f"gb-{next(self._gb_ids)}" for _ in reqs]
+        for seq_id, r in zip(seq_ids, reqs):
+            self.add_sequence(seq_id, r)
+        results: Dict[str, GenerateResult] = {}
+        while len(results) < len(seq_ids):
+            for out in await self.step():
+                if out.finished and out.seq_id in seq_ids:
+                    if out.error:
+                        raise RuntimeError(out.error)
+                    results[out.seq_id] = out.result
+        return [results[i] for i in seq_ids]
+
+    async def verify_batch(self, reqs: List[VerifyRequest]) -> List[VerifyResult]:
+        # one prefill over prompt + proposal; every proposed token is accepted
+        longest = max(len(r.prompt) // 4 + len(r.proposed) for r in reqs)
+        await self._charge(self.cost.prefill_ms(len(reqs), longest))
+        return [VerifyResult(accepted=len(r.proposed), text="", tokens=len(r.proposed) + 1) for r in reqs]
+
+    def add_sequence(self, seq_id: str, req: GenerateRequest, fork_of: Optional[str] = None) -> None:
+        prompt = len(req.prompt_ids) if req.prompt_ids is not None else len(req.prompt) // 4
+        if fork_of in self._waiting:
+            self._forks.setdefault(fork_of, []).append((seq_id, _SimSequence(req, max(1, prompt))))
+        else:
+            self._waiting[seq_id] = _SimSequence(req, max(1, prompt))
+
+    def abort_sequence(self, seq_id: str) -> None:
+        self._running.pop(seq_id, None)
+        for forks in self._forks.values():
+            forks[:] = [f for f in forks if f[0] != seq_id]
+        forks = self._forks.pop(seq_id, [])
+        if self._waiting.pop(seq_id, None) is not None and forks:
+            # aborted before its prefill: the first fork is prefilled instead
+            self._waiting[forks[0][0]] = forks[0][1]
+            if forks[1:]:
+                self._forks[forks[0][0]] = forks[1:]
+
+    def has_unfinished(self) -> bool:
+        return bool(self._waiting or self._running)
+
+    async def step(self) -> List[StepOutput]:
+        decoding = list(self._running)
+        new = self._admit()
+        ms = 0.0
+        if new:
+            ms += self.cost.prefill_ms(len(new), max(self._running[i].prompt_tokens for i in new))
+            for seq_id in list(new):
+                for fork_id, f in self._forks.pop(seq_id, ()):
+                    self._running[fork_id] = f
+                    new.append(fork_id)
+        if decoding:
+            context = max(self._running[i].prompt_tokens + self._running[i].generated for i in decoding)
+            ms += self.cost.decode_ms(len(decoding), context)
+        await self._charge(ms)
+        self.steps += 1
+
+        outputs = []
+        for seq_id in decoding + new:
+            s = self._running.get(seq_id)
+            if s is None:
+                continue  # aborted while the step was running
+            s.generated += 1
+            s.text.append(" x")
+            eos = self.eos_prob > 0 and self._rng.random() < self.eos_prob
+            finished = eos or s.generated >= max(1, s.req.max_tokens)
+            result = None
+            if finished:
+                del self._running[seq_id]
+                result = GenerateResult(text="".join(s.text), tokens=s.generated, prompt_tokens=s.prompt_tokens,
+                                        finish_reason="stop" if eos else "length")
+            outputs.append(StepOutput(seq_id=seq_id, token_ids=[0], finished=finished, result=result,
+                                      text=" x" if s.req.stream else ""))
+        return outputs
+
+    def _admit(self) -> List[str]:
+        used = sum(s.prompt_tokens + s.req.max_tokens for s in self._running.values())
+        admitted = []
+        for seq_id, s in list(self._waiting.items()):
+            need = s.prompt_tokens + s.req.max_tokens * (1 + len(self._forks.get(seq_id, ())))
+            if self.kv_capacity_tokens is not None and used + need > self.kv_capacity_tokens and (used or admitted):
+                break
+            used += need
+            self._running[seq_id] = self._waiting.pop(seq_id)
+            admitted.append(seq_id)
+        return admitted
+
+    async def _charge(self, ms: float) -> None:
+        self.busy_ms += ms
+        await asyncio.sleep(ms * self.time_scale / 1000)
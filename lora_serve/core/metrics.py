@@ -1,5 +1,5 @@
 # lora_serve/core/metrics.py
-from prometheus_client import Counter, Histogram
+from prometheus_client import Counter, Gauge, Histogram
 
 # ---- Request-level metrics ----
 
@@ -13,33 +13,254 @@ REQUEST_LATENCY_MS = Histogram(
     "lora_serve_request_latency_ms",
     "End-to-end latency per request (ms)",
     ["endpoint"],
-    buckets=(10, 25, 50, 100, 200, 400, 800, 1600, 3200),
+    buckets=(10, 25, 50, 100, 200, 400, 800, 1600, 3200, 6400, 12800, 25600, 51200),
 )
 
-# If you want streaming TTFT later:
 TTFT_MS = Histogram(
     "lora_serve_ttft_ms",
-    "Time-to-first-token for streaming requests (ms)",
+    "Time from enqueue to the first generated token (ms)",
+    buckets=(5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
 )
 
 # ---- Batching / scheduler metrics ----
 
+PREFILL_TOKENS = Counter(
+    "lora_serve_prefill_tokens_total",
+    "Prompt tokens run through prefill: real ones vs. real + padding",
+    ["kind"],  # real, padded
+)
+
+PREFILL_PADDING_EFFICIENCY = Histogram(
+    "lora_serve_prefill_padding_efficiency",
+    "Real / padded prompt tokens per prefill batch (1.0 = no padding)",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0),
+)
+
 BATCH_SIZE = Histogram(
     "lora_serve_batch_size",
-    "Number of requests per batch",
-    buckets=(1, 2, 4, 8, 16, 32, 64),
+    "Requests in the running batch per engine step",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+
+BATCH_OCCUPANCY = Histogram(
+    "lora_serve_batch_occupancy",
+    "Fraction of the batch token budget held by running requests, per engine step",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
 )
 
 QUEUE_WAIT_MS = Histogram(
     "lora_serve_queue_wait_ms",
     "Time a request spent in the queue before being batched (ms)",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+)
+
+FORWARD_TOKENS_PER_S = Histogram(
+    "lora_serve_forward_tokens_per_s",
+    "Tokens per second of one engine forward pass (prefill: prompt tokens; decode: emitted tokens)",
+    ["phase"],  # prefill, decode
+    buckets=(10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000),
+)
+
+TENANT_QUEUE_DEPTH = Gauge(
+    "lora_serve_tenant_queue_depth",
+    "Requests waiting in each tenant's queue",
+    ["tenant"],
+)
+
+TENANT_SERVED_TOKENS = Counter(
+    "lora_serve_tenant_served_tokens_total",
+    "Prompt + generated tokens served per tenant (the fairness cost)",
+    ["tenant"],
+)
+
+# ---- Adapter store (tiers: host, active) ----
+
+ADAPTER_CACHE_HITS = Counter(
+    "lora_serve_adapter_cache_hits_total",
+    "Adapter lookups served from a tier",
+    ["tier"],
+)
+
+ADAPTER_CACHE_MISSES = Counter(
+    "lora_serve_adapter_cache_misses_total",
+    "Adapter lookups that had to load into a tier",
+    ["tier"],
+)
+
+ADAPTER_CACHE_EVICTIONS = Counter(
+    "lora_serve_adapter_cache_evictions_total",
+    "Adapters evicted from a tier to stay within its byte budget",
+    ["tier"],
+)
+
+ADAPTER_LOAD_MS = Histogram(
+    "lora_serve_adapter_load_ms",
+    "Time to bring an adapter into a tier (host: read + parse, active: attach) (ms)",
+    ["tier"],
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+)
+
+ADAPTER_TIER_BYTES = Gauge(
+    "lora_serve_adapter_tier_bytes",
+    "Adapter weight bytes held in each tier",
+    ["tier"],
+)
+
+ADAPTER_PREFETCHES = Counter(
+    "lora_serve_adapter_prefetches_total",
+    "Adapters loaded ahead of need",
+    ["source"],  # api, warmer, startup
+)
+
+ADAPTER_SWITCHES = Counter(
+    "lora_serve_adapter_switches_total",
+    "Times a single-adapter engine changed its selected adapter between batches",
+)
+
+ADAPTER_SWITCH_MS = Histogram(
+    "lora_serve_adapter_switch_ms",
+    "Time spent switching the selected adapter (including a cold attach) (ms)",
+    buckets=(0.1, 0.5, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000),
+)
+
+# ---- Event loop ----
+
+EVENT_LOOP_LAG_MS = Histogram(
+    "lora_serve_event_loop_lag_ms",
+    "How late the event loop ran a timer (ms); high values mean something blocked it",
+    buckets=(0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+)
+
+# ---- Request pipeline stages ----
+
+STAGE_MS = Histogram(
+    "lora_serve_stage_ms",
+    "Time spent in a pipeline stage (tokenize: one batched encode; detokenize: one step's outputs) (ms)",
+    ["stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100),
+)
+
+# ---- Response cache (tiers: memory, disk; hits also: inflight) ----
+
+RESPONSE_CACHE_HITS = Counter(
+    "lora_serve_response_cache_hits_total",
+    "Deterministic requests answered without generating (inflight: joined an identical running request)",
+    ["tier"],
+)
+
+RESPONSE_CACHE_MISSES = Counter(
+    "lora_serve_response_cache_misses_total",
+    "Cacheable requests that had to be generated",
+)
+
+RESPONSE_CACHE_EVICTIONS = Counter(
+    "lora_serve_response_cache_evictions_total",
+    "Response cache entries evicted to stay within a tier's byte budget",
+    ["tier"],
+)
+
+RESPONSE_CACHE_BYTES = Gauge(
+    "lora_serve_response_cache_bytes",
+    "Bytes held by each response cache tier",
+    ["tier"],
 )
 
 # ---- Token throughput ----
 
+WASTED_TOKENS_AVOIDED = Counter(
+    "lora_serve_wasted_tokens_avoided_total",
+    "Decode tokens not computed because a row left the batch before its max_tokens",
+    ["reason"],  # eos, stop (stop string), cancelled (client gone / timeout)
+)
+
 TOKENS_GENERATED = Counter(
     "lora_serve_tokens_generated_total",
     "Total number of tokens generated",
     ["endpoint"],
 )
 
+# ---- KV cache (paged allocator) ----
+
+KV_BLOCKS_USED = Gauge(
+    "lora_serve_kv_blocks_used",
+    "KV-cache blocks currently allocated",
+)
+
+KV_BLOCKS_FREE = Gauge(
+    "lora_serve_kv_blocks_free",
+    "KV-cache blocks on the free list",
+)
+
+KV_BLOCKS_SHARED = Gauge(
+    "lora_serve_kv_blocks_shared",
+    "KV-cache blocks referenced by more than one sequence",
+)
+
+KV_FRAGMENTATION = Gauge(
+    "lora_serve_kv_fragmentation_ratio",
+    "Fraction of allocated KV slots holding no token",
+)
+
+KV_PREEMPTIONS = Counter(
+    "lora_serve_kv_preemptions_total",
+    "Sequences preempted (KV freed, recomputed later) because the KV cache was full",
+)
+
+# ---- Memory budget ----
+
+MEMORY_BUDGET_BYTES = Gauge(
+    "lora_serve_memory_budget_bytes",
+    "Engine memory budget split into weights, KV pool and activation headroom",
+    ["part"],
+)
+
+OOM_BATCH_SPLITS = Counter(
+    "lora_serve_oom_batch_splits_total",
+    "Forward passes that ran out of memory and were retried as two half batches",
+)
+
+# ---- Prompt-prefix cache ----
+
+PREFIX_CACHE_HITS = Counter(
+    "lora_serve_prefix_cache_hits_total",
+    "Admitted prompts that reused at least one cached prefix block",
+)
+
+PREFIX_CACHE_MISSES = Counter(
+    "lora_serve_prefix_cache_misses_total",
+    "Admitted prompts with no cached prefix",
+)
+
+PREFIX_CACHE_SAVED_TOKENS = Counter(
+    "lora_serve_prefix_cache_saved_tokens_total",
+    "Prompt tokens whose prefill was skipped thanks to the prefix cache",
+)
+
+PREFIX_CACHE_BLOCKS = Gauge(
+    "lora_serve_prefix_cache_blocks",
+    "KV blocks held by the prefix cache",
+)
+
+# ---- Speculative decoding ----
+
+SPEC_DRAFTED_TOKENS = Counter(
+    "lora_serve_spec_drafted_tokens_total",
+    "Draft tokens proposed for verification",
+)
+
+SPEC_ACCEPTED_TOKENS = Counter(
+    "lora_serve_spec_accepted_tokens_total",
+    "Draft tokens accepted by the target model",
+)
+
+SPEC_ACCEPTANCE_RATE = Gauge(
+    "lora_serve_spec_acceptance_rate",
+    "Moving average of the fraction of drafted tokens accepted",
+)
+
+# tokens emitted per target forward; its mean is the decode-step speedup over plain decoding
+SPEC_TOKENS_PER_STEP = Histogram(
+    "lora_serve_spec_tokens_per_step",
+    "Tokens emitted per sequence per target forward pass with speculative decoding",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 12, 16),
+)
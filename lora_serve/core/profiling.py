@@ -0,0 +1,190 @@
+# On-demand profiling of the live server: torch profiler on the engines + sampled event-loop stacks
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+_session: Optional["ProfileSession"] = None  # the running capture; None = profiling off
+
+
+def active() -> bool:
+    return _session is not None
+
+
+def record_batch(batcher, batch: int, start_ns: int, end_ns: int, rows: int, adapters: Sequence[str]) -> None:
+    """Batcher hook: one engine step, called only while a capture runs."""
+    if _session is not None:
+        _session.record_batch(batcher, batch, start_ns, end_ns, rows, adapters)
+
+
+def torch_profiler() -> torch.profiler.profile:
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(activities=activities)
+
+
+def chrome_trace(prof: torch.profiler.profile) -> dict:
+    """The finished profile as a Chrome trace dict (ts in us after baseTimeNanoseconds)."""
+    fd, path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        prof.export_chrome_trace(path)
+        return json.loads(Path(path).read_text())
+    finally:
+        os.unlink(path)
+
+
+class StackSampler:
+    """Samples the Python stack of one thread (the event loop) every `interval_ms` from a side thread."""
+
+    def __init__(self, thread_id: int, interval_ms: float = 5.0):
+        self.thread_id = thread_id
+        self.interval_s = interval_ms / 1000
+        self.samples: List[Tuple[int, Tuple[str, ...]]] = []  # (time_ns, frames root first)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{getattr(code, 'co_qualname', code.co_name)} "
+                             f"({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples.append((time.time_ns(), tuple(reversed(stack))))
+
+    def folded(self) -> str:
+        """Collapsed stacks (`a;b;c count` lines) for flamegraph.pl / speedscope."""
+        counts = Counter(";".join(stack) for _, stack in self.samples if stack)
+        return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+
+    def chrome_events(self, base_ns: int, pid: int, tid: str) -> List[dict]:
+        """Flame chart: a frame spans the consecutive samples whose stacks share it (and its callers)."""
+        events, open_ = [], []  # open_[depth] = (frame, first seen ns)
+        end = self.samples[-1][0] + int(self.interval_s * 1e9) if self.samples else base_ns
+        for ts, stack in self.samples + [(end, ())]:
+            common = 0
+            while common < min(len(open_), len(stack)) and open_[common][0] == stack[common]:
+                common += 1
+            for frame, start in reversed(open_[common:]):
+                events.append({"name": frame, "ph": "X", "cat": "python", "pid": pid, "tid": tid,
+                               "ts": (start - base_ns) / 1000, "dur": (ts - start) / 1000})
+            del open_[common:]
+            open_.extend((frame, ts) for frame in stack[common:])
+        return events
+
+
+class ProfileSession:
+    """
+    One bounded capture over the live server: the torch profiler runs on every engine
+    that supports it (start_profile/stop_profile; the model runs on the engine's worker
+    thread or process), the event-loop thread is stack-sampled, and the batchers report
+    each engine step. The result is a single Chrome trace (chrome://tracing, Perfetto):
+    engine op ranges labelled `batch N ... adapters=...`, one `batch N` range per step on
+    each batcher track with its rows and adapters, and the sampled loop stacks as a flame
+    chart. Batch N is the N-th step of that engine, counted on both sides.
+    """
+
+    def __init__(self, batchers: Sequence, interval_ms: float = 5.0):
+        self.batchers = list(batchers)
+        self.interval_ms = interval_ms
+        self.batches = 0
+        self.start_ns = 0
+        self.end_ns = 0
+        self.sampler: Optional[StackSampler] = None
+        self._batch_events: List[dict] = []
+        self._engine_traces: List[Tuple[str, dict]] = []
+        self._enough: Optional[asyncio.Event] = None
+        self._target = 0
+
+    async def run(self, seconds: float, batches: int = 0) -> "ProfileSession":
+        """Capture until `batches` engine steps ran (0 = no step limit) or `seconds` passed."""
+        global _session
+        if _session is not None:
+            raise RuntimeError("a profile capture is already running")
+        _session = self
+        engines = [(getattr(b.engine, "name", f"engine-{i}"), b.engine) for i, b in enumerate(self.batchers)]
+        engines = [(name, e) for name, e in engines if hasattr(e, "start_profile")]
+        self._enough, self._target = asyncio.Event(), batches
+        self.sampler = StackSampler(threading.get_ident(), self.interval_ms)
+        self.start_ns = time.time_ns()
+        started, sampling = [], False
+        try:
+            for name, engine in engines:
+                await engine.start_profile()
+                started.append((name, engine))
+            self.sampler.start()
+            sampling = True
+            try:
+                await asyncio.wait_for(self._enough.wait(), seconds)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            _session = None
+            self.end_ns = time.time_ns()
+            if sampling:  # an engine that failed to start profiling leaves the sampler unstarted
+                self.sampler.stop()
+            for name, engine in started:
+                try:
+                    self._engine_traces.append((name, await engine.stop_profile()))
+                except Exception:
+                    logger.exception("Stopping the profiler of %s failed", name)
+        logger.info("Profile captured: %.1f s, %d batches, %d loop samples, %d engine traces",
+                    (self.end_ns - self.start_ns) / 1e9, self.batches, len(self.sampler.samples),
+                    len(self._engine_traces))
+        return self
+
+    def record_batch(self, batcher, batch: int, start_ns: int, end_ns: int, rows: int,
+                     adapters: Sequence[str]) -> None:
+        index = self.batchers.index(batcher) if batcher in self.batchers else len(self.batchers)
+        self._batch_events.append({"name": f"batch {batch}", "ph": "X", "cat": "scheduler", "pid": os.getpid(),
+                                   "tid": f"batcher {index}", "ts": (start_ns - self.start_ns) / 1000,
+                                   "dur": (end_ns - start_ns) / 1000,
+                                   "args": {"batch": batch, "rows": rows, "adapters": list(adapters)}})
+        self.batches += 1
+        if self._target and self.batches >= self._target:
+            self._enough.set()
+
+    def folded(self) -> str:
+        return self.sampler.folded()
+
+    def chrome_trace(self) -> dict:
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "lora-serve"}}]
+        events += self._batch_events
+        events += self.sampler.chrome_events(self.start_ns, pid, "event loop (sampled)")
+        for name, trace in self._engine_traces:
+            # re-base onto the capture start; kineto's base + ts is wall-clock time
+            shift = (trace.get("baseTimeNanoseconds", 0) - self.start_ns) / 1000
+            for event in trace.get("traceEvents", []):
+                if isinstance(event.get("ts"), (int, float)):
+                    event["ts"] += shift
+                events.append(event)
+            engine_pid = next((e["pid"] for e in trace.get("traceEvents", []) if isinstance(e.get("pid"), int)), None)
+            if engine_pid is not None and engine_pid != pid:
+                events.append({"name": "process_name", "ph": "M", "pid": engine_pid, "args": {"name": name}})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "baseTimeNanoseconds": self.start_ns,
+                "otherData": {"batches": self.batches, "loop_samples": len(self.sampler.samples),
+                              "sample_interval_ms": self.interval_ms,
+                              "duration_ms": (self.end_ns - self.start_ns) / 1e6}}
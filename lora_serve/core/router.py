@@ -1,22 +1,128 @@
 
 import asyncio
 import logging
-from .adapters import LoRAAdapterManager
+from contextlib import aclosing
+from typing import Any, AsyncIterator, List, Optional, Sequence, Tuple
+from ..decoding.tokenize import TokenizerPool
+from ..storage.cache_store import ResponseCache
 from ..scheduler.batcher import DynamicBatcher
-from .types import GenerateRequest
+from . import tracing
+from .types import GenerateRequest, GenerateResult
 
 
 logger = logging.getLogger(__name__)
 
 
 class RequestRouter:
-    def __init__(self, batcher: DynamicBatcher, adapters: LoRAAdapterManager):
-        self.batcher = batcher
-        self.adapters = adapters
+    """
+    Front door over one or more engine workers, each a DynamicBatcher with its own
+    engine replica, adapter store and queues.
+
+    A request goes to the least-loaded worker, except that a worker which already has
+    the request's adapter attached wins as long as it is at most `affinity_slack`
+    requests busier than the least-loaded one (an attach costs more than a short wait).
+    With a `tokenizer` pool, prompts are tokenized before scheduling, so the batcher
+    and the fairness policy see exact prompt lengths and the engine skips that work.
+    With a response `cache`, deterministic requests are answered from it when possible.
+    """
+
+    def __init__(self, batchers: List[DynamicBatcher], affinity_slack: int = 4,
+                 tokenizer: Optional[TokenizerPool] = None, cache: Optional[ResponseCache] = None):
+        self.batchers = batchers
+        self.affinity_slack = affinity_slack
+        self.tokenizer = tokenizer
+        self.cache = cache
+
+    def pick(self, adapter_id: Optional[str]) -> DynamicBatcher:
+        least = min(self.batchers, key=lambda b: b.load())
+        if adapter_id is None:
+            return least
+        resident = [b for b in self.batchers if adapter_id in b.adapters.active]
+        if resident:
+            best = min(resident, key=lambda b: b.load())
+            if best.load() - least.load() <= self.affinity_slack:
+                return best
+        return least
 
     async def submit(self, req: GenerateRequest):
+        batcher = self.pick(req.adapter_id)
         if req.adapter_id:
             logger.debug("Ensuring adapter %s is loaded", req.adapter_id)
-            await self.adapters.ensure_loaded(req.adapter_id)
-        logger.debug("Enqueueing request for prompt len=%d", len(req.prompt))
-        return await self.batcher.enqueue(req)
+            await batcher.adapters.ensure_loaded(req.adapter_id)
+
+        async def generate():
+            await self._tokenize(req)
+            logger.debug("Enqueueing request for prompt len=%d", len(req.prompt))
+            return await batcher.enqueue(req)
+
+        if self.cache is None or not self.cache.cacheable(req):
+            return await generate()
+        return await self._cached(batcher, req, generate)
+
+    async def submit_many(self, reqs: Sequence[GenerateRequest]) -> AsyncIterator[Tuple[int, Any]]:
+        """
+        Schedule `reqs` together and yield (index, GenerateResult or the exception it
+        failed with) in completion order. Every adapter is validated once, all prompts go
+        to the tokenizer pool in one round, and the requests are queued without a
+        suspension point in between, so the batcher sees them at once. Closing the
+        iterator early drops the requests still pending.
+        """
+        adapters = sorted({r.adapter_id for r in reqs if r.adapter_id})
+        checks = await asyncio.gather(*(self.resolve_path(a) for a in adapters), return_exceptions=True)
+        missing = {a: ex for a, ex in zip(adapters, checks) if isinstance(ex, BaseException)}
+        await asyncio.gather(*(self._tokenize(r) for r in reqs if r.adapter_id not in missing))
+
+        done: asyncio.Queue = asyncio.Queue()
+        futs: List[asyncio.Future] = []
+        for i, req in enumerate(reqs):
+            if req.adapter_id in missing:
+                done.put_nowait((i, missing[req.adapter_id]))
+                continue
+            batcher = self.pick(req.adapter_id)
+            if self.cache is not None and self.cache.cacheable(req):
+                fut = asyncio.ensure_future(self._cached(batcher, req, lambda b=batcher, r=req: b.enqueue(r)))
+            else:
+                fut = batcher.push(req)
+            fut.add_done_callback(lambda f, i=i: done.put_nowait((i, f)))
+            futs.append(fut)
+        try:
+            for _ in range(len(reqs)):
+                i, out = await done.get()
+                if isinstance(out, asyncio.Future):
+                    out = asyncio.CancelledError() if out.cancelled() else out.exception() or out.result()
+                yield i, out
+        finally:
+            for fut in futs:
+                if not fut.done():
+                    fut.cancel()
+
+    async def stream(self, req: GenerateRequest) -> AsyncIterator[str]:
+        await self._tokenize(req)
+        batcher = self.pick(req.adapter_id)
+        async with aclosing(batcher.stream(req)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    async def stream_choices(self, req: GenerateRequest) -> AsyncIterator[Tuple[int, str, Optional[GenerateResult]]]:
+        """(choice index, text, result on a choice's last chunk) for n >= 1 requests."""
+        await self._tokenize(req)
+        batcher = self.pick(req.adapter_id)
+        async with aclosing(batcher.stream_choices(req)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    async def prefetch(self, adapter_id: str) -> str:
+        """Prefetch on the worker the adapter's next request would be routed to."""
+        return await self.pick(adapter_id).adapters.prefetch(adapter_id)
+
+    async def resolve_path(self, adapter_id: str):
+        return await self.batchers[0].adapters.resolve_path(adapter_id)
+
+    async def _cached(self, batcher: DynamicBatcher, req: GenerateRequest, generate):
+        adapter_hash = await batcher.adapters.content_hash(req.adapter_id) if req.adapter_id else ""
+        return await self.cache.get_or_generate(self.cache.key(req, adapter_hash), generate)
+
+    async def _tokenize(self, req: GenerateRequest) -> None:
+        if self.tokenizer is not None and req.prompt_ids is None:
+            with tracing.span("tokenize", prompt_chars=len(req.prompt)):
+                req.prompt_ids = await self.tokenizer.encode(req.prompt)
@@ -0,0 +1,93 @@
+# Optional OpenTelemetry spans for the request lifecycle (exported over OTLP when configured)
+import contextlib
+import logging
+import time
+from typing import Iterable, Optional, Tuple
+
+from opentelemetry import context as otel_context
+from opentelemetry import trace
+
+logger = logging.getLogger(__name__)
+
+_tracer: Optional[trace.Tracer] = None  # set by setup_tracing(); None = tracing off
+_provider = None
+
+
+def setup_tracing(endpoint: Optional[str] = None, sample_ratio: float = 1.0, service_name: str = "lora-serve",
+                  exporter=None) -> bool:
+    """
+    Export spans to an OTLP/HTTP collector at `endpoint` (e.g. http://localhost:4318/v1/traces),
+    or to `exporter` (any SpanExporter, e.g. console or in-memory). Without either, or
+    without the OTLP exporter package, tracing stays off and every helper here is a no-op.
+    """
+    global _tracer, _provider
+    if exporter is None and endpoint:
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            logger.warning("Tracing needs opentelemetry-exporter-otlp-proto-http (pip install 'lora-serve[tracing]')")
+            return False
+        exporter = OTLPSpanExporter(endpoint=endpoint)
+    if exporter is None:
+        return False
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}),
+                              sampler=ParentBased(TraceIdRatioBased(sample_ratio)))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    _tracer, _provider = provider.get_tracer("lora_serve"), provider
+    logger.info("Tracing on (%s, sample ratio %.2f)", endpoint or type(exporter).__name__, sample_ratio)
+    return True
+
+
+def shutdown_tracing() -> None:
+    """Flush pending spans and turn tracing off."""
+    global _tracer, _provider
+    if _provider is not None:
+        _provider.shutdown()
+    _tracer = _provider = None
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, **attributes):
+    """Context manager: a child span of the current one, made current (no-op when tracing is off)."""
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.start_as_current_span(name, attributes=attributes)
+
+
+def current_context() -> Optional[otel_context.Context]:
+    """The caller's trace context, to parent spans recorded later from another task."""
+    return otel_context.get_current() if _tracer is not None else None
+
+
+def sampled(parent: Optional[otel_context.Context]) -> bool:
+    """Whether spans under `parent` will be exported (a root span, None, is left to the sampler)."""
+    if _tracer is None:
+        return False
+    return parent is None or trace.get_current_span(parent).get_span_context().trace_flags.sampled
+
+
+def now_ns() -> int:
+    return time.time_ns()
+
+
+def record_span(name: str, parent: Optional[otel_context.Context], start_ns: int, end_ns: int,
+                attributes: Optional[dict] = None, events: Iterable[Tuple[str, int]] = ()) -> None:
+    """
+    Emit a finished span from timestamps taken earlier, so the hot path only reads the
+    clock. `parent` comes from current_context(); None makes a root span.
+    """
+    if _tracer is None:
+        return
+    s = _tracer.start_span(name, context=parent or otel_context.Context(), start_time=start_ns,
+                           attributes=attributes)
+    for event, ts in events:
+        s.add_event(event, timestamp=ts)
+    s.end(end_time=end_ns)
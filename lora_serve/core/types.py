@@ -11,11 +11,34 @@ class GenerateRequest:
     adapter_id: Optional[str] = None
     tenant_id: Optional[str] = None
     stream: bool = False
+    top_k: int = 0                   # 0 = disabled
+    repetition_penalty: float = 1.0  # 1.0 = disabled
+    seed: Optional[int] = None       # per-request reproducible sampling
+    prompt_ids: Optional[List[int]] = None  # pre-tokenized prompt (see TokenizerPool); else the engine tokenizes
+    stop: Optional[List[str]] = None        # generation ends before the first of these strings
+    n: int = 1                              # continuations returned, all forked from one prefill of the prompt
+    best_of: Optional[int] = None           # continuations sampled (>= n); the n most likely are returned
 
 @dataclass
 class GenerateResult:
     text: str
     tokens: int
+    prompt_tokens: int = 0
+    finish_reason: Optional[str] = None  # "stop" (EOS or stop string) or "length" (max_tokens)
+    logprob: Optional[float] = None      # sum of the sampled tokens' log-probabilities (best_of > n only)
+    # n > 1: the returned continuations; `tokens` then counts every sampled one and the
+    # other fields describe choices[0]
+    choices: Optional[List["GenerateResult"]] = None
+
+@dataclass
+class StepOutput:
+    """Tokens produced for one sequence by a single engine step (several with speculative decoding)."""
+    seq_id: str
+    token_ids: List[int]
+    finished: bool = False
+    result: Optional[GenerateResult] = None  # set once the sequence finishes
+    error: Optional[str] = None              # finished without a result
+    text: str = ""                           # newly decoded text (stream=True requests only)
 
 @dataclass
 class VerifyRequest:
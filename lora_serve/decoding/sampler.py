@@ -1,2 +1,105 @@
 
-# Placeholder: implement nucleus/top-k sampling here later
+# Batched sampler: every row carries its own temperature / top-p / top-k /
+# repetition penalty / seed, and all rows are sampled in one vectorized pass.
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+import torch
+
+
+@dataclass
+class SamplingBatch:
+    temperature: torch.Tensor          # [B] float, <= 0 means greedy
+    top_p: torch.Tensor                # [B] float in (0, 1]
+    top_k: torch.Tensor                # [B] long, 0 means disabled
+    repetition_penalty: torch.Tensor   # [B] float, 1.0 means disabled
+    generators: List[Optional[torch.Generator]]  # per-row RNG for seeded requests
+
+    @classmethod
+    def from_requests(cls, reqs: Sequence, generators: Sequence[Optional[torch.Generator]],
+                      device="cpu") -> "SamplingBatch":
+        return cls(
+            temperature=torch.tensor([float(r.temperature or 0.0) for r in reqs], device=device),
+            top_p=torch.tensor([float(r.top_p or 1.0) for r in reqs], device=device),
+            top_k=torch.tensor([int(getattr(r, "top_k", 0) or 0) for r in reqs], device=device),
+            repetition_penalty=torch.tensor([float(getattr(r, "repetition_penalty", 1.0) or 1.0) for r in reqs],
+                                            device=device),
+            generators=list(generators),
+        )
+
+    @property
+    def greedy(self) -> torch.Tensor:
+        return self.temperature <= 0
+
+
+def apply_repetition_penalty(logits: torch.Tensor, batch: SamplingBatch,
+                             context_ids: Sequence[Sequence[int]]) -> torch.Tensor:
+    """HF-style penalty on every token already in a row's context (prompt + output)."""
+    if not bool((batch.repetition_penalty != 1.0).any()):
+        return logits
+    width = max(len(c) for c in context_ids)
+    ids = torch.zeros((len(context_ids), width), dtype=torch.long, device=logits.device)
+    valid = torch.zeros((len(context_ids), width), dtype=torch.int32, device=logits.device)
+    for i, c in enumerate(context_ids):
+        ids[i, :len(c)] = torch.tensor(c, dtype=torch.long)
+        valid[i, :len(c)] = 1
+    seen = torch.zeros(logits.shape, dtype=torch.int32, device=logits.device).scatter_add_(1, ids, valid) > 0
+    penalty = batch.repetition_penalty.view(-1, 1)
+    penalized = torch.where(logits > 0, logits / penalty, logits * penalty)
+    return torch.where(seen, penalized, logits)
+
+
+def probs_from_logits(logits: torch.Tensor, batch: SamplingBatch,
+                      context_ids: Optional[Sequence[Sequence[int]]] = None) -> torch.Tensor:
+    """
+    Final per-row sampling distribution [B, V] after penalty, temperature, top-k and
+    top-p. Greedy rows get a one-hot on their argmax.
+    """
+    logits = logits.float()
+    if context_ids is not None:
+        logits = apply_repetition_penalty(logits, batch, context_ids)
+    greedy = batch.greedy
+    vocab = logits.shape[-1]
+
+    temp = torch.where(greedy, torch.ones_like(batch.temperature), batch.temperature).view(-1, 1)
+    sorted_logits, sorted_idx = (logits / temp).sort(dim=-1, descending=True)
+    rank = torch.arange(vocab, device=logits.device).view(1, -1)
+
+    # top-k: keep the first k sorted entries (k=0 -> whole vocab)
+    k = torch.where(batch.top_k > 0, batch.top_k, torch.full_like(batch.top_k, vocab)).view(-1, 1)
+    sorted_logits = sorted_logits.masked_fill(rank >= k, float("-inf"))
+
+    # top-p: drop entries once the mass before them already exceeds p (top entry always kept)
+    sorted_probs = sorted_logits.softmax(dim=-1)
+    drop = sorted_probs.cumsum(dim=-1) - sorted_probs > batch.top_p.view(-1, 1)
+    sorted_probs = sorted_probs.masked_fill(drop, 0.0)
+    sorted_probs = sorted_probs / sorted_probs.sum(dim=-1, keepdim=True)
+
+    probs = torch.zeros_like(sorted_probs).scatter_(1, sorted_idx, sorted_probs)
+    if bool(greedy.any()):
+        one_hot = torch.zeros_like(probs).scatter_(1, logits.argmax(dim=-1, keepdim=True), 1.0)
+        probs = torch.where(greedy.view(-1, 1), one_hot, probs)
+    return probs
+
+
+def sample_from_probs(probs: torch.Tensor, batch: SamplingBatch) -> torch.Tensor:
+    """
+    Draw one token per row. Uses the exponential-race trick (argmax p / E, E ~ Exp(1)),
+    which is equivalent to multinomial sampling but vectorizes across rows; seeded rows
+    draw their noise from their own generator so output does not depend on batch mates.
+    """
+    noise = torch.empty_like(probs).exponential_()
+    for i, gen in enumerate(batch.generators):
+        if gen is not None:
+            noise[i] = torch.empty(probs.shape[-1], device=probs.device).exponential_(generator=gen)
+    return (probs / noise.clamp_(min=1e-10)).argmax(dim=-1)
+
+
+def sample(logits: torch.Tensor, batch: SamplingBatch,
+           context_ids: Optional[Sequence[Sequence[int]]] = None) -> torch.Tensor:
+    """Sample the next token id for every row of `logits` [B, V]."""
+    if bool(batch.greedy.all()):
+        if context_ids is not None:
+            logits = apply_repetition_penalty(logits.float(), batch, context_ids)
+        return logits.argmax(dim=-1)
+    return sample_from_probs(probs_from_logits(logits, batch, context_ids), batch)
@@ -1,17 +1,182 @@
 
-from typing import List
-from ..core.engines.engine import IEngine
-from ..core.types import GenerateRequest, GenerateResult, VerifyRequest
+# Speculative decoding. Cheap proposers draft a few tokens per sequence, the target
+# model scores them all in one forward pass, and rejection sampling keeps the output
+# distribution identical to plain decoding.
+from typing import Dict, List, Optional, Protocol, Sequence, Tuple
+
+import torch
+
+from .sampler import SamplingBatch, probs_from_logits, sample_from_probs
+from ..core.engines.cache_utils import cache_layers, to_cache
+from ..core.metrics import (
+    SPEC_ACCEPTANCE_RATE,
+    SPEC_ACCEPTED_TOKENS,
+    SPEC_DRAFTED_TOKENS,
+    SPEC_TOKENS_PER_STEP,
+)
+
+# draft tokens plus, for model proposers, the draft distribution q [k, V] they came from
+Draft = Tuple[List[int], Optional[torch.Tensor]]
+
+
+class Proposer(Protocol):
+    def propose(self, seq_id: str, context: List[int], k: int, req, generator) -> Draft: ...
+    def forget(self, seq_id: str) -> None: ...
+
+
+class NgramProposer:
+    """
+    Prompt-lookup proposer: find the most recent earlier occurrence of the context's
+    trailing n-gram (longest n first) and propose the tokens that followed it.
+    Needs no second model; deterministic, so q is a point mass.
+    """
+
+    def __init__(self, max_ngram: int = 3, min_ngram: int = 1):
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+
+    def propose(self, seq_id: str, context: List[int], k: int, req=None, generator=None) -> Draft:
+        for n in range(min(self.max_ngram, len(context) - 1), self.min_ngram - 1, -1):
+            tail = context[-n:]
+            for start in range(len(context) - n - 1, -1, -1):
+                if context[start:start + n] == tail:
+                    follow = context[start + n:start + n + k]
+                    if follow:
+                        return follow, None
+        return [], None
+
+    def forget(self, seq_id: str) -> None:
+        pass
+
+
+class DraftModelProposer:
+    """
+    Small draft model sharing the target's tokenizer. Each sequence keeps its own draft
+    KV (trimmed back to the accepted tokens on the next call) and drafts by sampling
+    with the request's own parameters, so q is a real distribution.
+    """
+
+    def __init__(self, model, vocab_size: int):
+        self.model = model
+        self.vocab_size = vocab_size
+        self._cache: Dict[str, Tuple[List[int], list]] = {}  # seq_id -> (ids with KV, layers)
+
+    @torch.inference_mode()
+    def propose(self, seq_id: str, context: List[int], k: int, req, generator) -> Draft:
+        ids, layers = self._cache.pop(seq_id, ([], None))
+        keep = 0
+        while keep < min(len(ids), len(context) - 1) and ids[keep] == context[keep]:
+            keep += 1
+        layers = [(kk[:, :, :keep], vv[:, :, :keep]) for kk, vv in layers] if layers and keep else None
+
+        batch = SamplingBatch.from_requests([req], [generator], self.model.device)
+        tokens: List[int] = []
+        probs: List[torch.Tensor] = []
+        feed = context[keep:]
+        pos = keep
+        for _ in range(k):
+            out = self.model(
+                input_ids=torch.tensor([feed], device=self.model.device),
+                position_ids=torch.arange(pos, pos + len(feed), device=self.model.device).unsqueeze(0),
+                past_key_values=to_cache(layers) if layers else None,
+                use_cache=True,
+            )
+            layers = cache_layers(out.past_key_values)
+            pos += len(feed)
+            q = probs_from_logits(out.logits[:, -1, :self.vocab_size], batch)
+            if q.shape[-1] < self.vocab_size:
+                q = torch.nn.functional.pad(q, (0, self.vocab_size - q.shape[-1]))
+            tok = int(sample_from_probs(q, batch)[0])
+            tokens.append(tok)
+            probs.append(q[0])
+            feed = [tok]
+        # the last drafted token was never fed, so KV covers context + tokens[:-1]
+        self._cache[seq_id] = (context + tokens[:-1], layers)
+        return tokens, torch.stack(probs)
+
+    def forget(self, seq_id: str) -> None:
+        self._cache.pop(seq_id, None)
+
 
 class SpeculativeOrchestrator:
-    def __init__(self, draft: IEngine, target: IEngine, max_draft_steps: int = 8):
-        self.draft = draft
-        self.target = target
+    """
+    Per-sequence draft length control and acceptance/rejection of drafted tokens.
+
+    The engine asks `draft()` for proposals, runs [last token + drafts] through the
+    target in one pass, and hands the target distributions to `accept()`. The draft
+    length of each sequence adapts to its measured acceptance rate: it grows while most
+    drafts are accepted and shrinks when they are mostly rejected.
+    """
+
+    def __init__(self, proposer: Proposer, max_draft_steps: int = 8, ema: float = 0.7):
+        self.proposer = proposer
         self.max_draft_steps = max_draft_steps
+        self.ema = ema
+        self._rate: Dict[str, float] = {}
+        self._k: Dict[str, int] = {}
+        self.rate = 0.0  # global EMA, exported as a gauge
+
+    def draft(self, seq_id: str, context: List[int], req, generator) -> Draft:
+        k = self._k.setdefault(seq_id, max(1, self.max_draft_steps // 2))
+        return self.proposer.propose(seq_id, context, k, req, generator)
+
+    def accept(self, seq_id: str, drafts: List[int], draft_probs: Optional[torch.Tensor],
+               target_probs: torch.Tensor, generator) -> List[int]:
+        """
+        Speculative sampling over `target_probs` [len(drafts) + 1, V]: draft x_j is kept
+        with probability min(1, p_j(x_j) / q_j(x_j)); the first rejection is replaced by a
+        sample from normalize(max(p_j - q_j, 0)); if all are kept a bonus token is drawn
+        from the last distribution. Returns the tokens to append (at least one).
+        """
+        out: List[int] = []
+        for j, x in enumerate(drafts):
+            p = target_probs[j]
+            q = draft_probs[j] if draft_probs is not None else None
+            q_x = float(q[x]) if q is not None else 1.0
+            u = float(torch.rand((), generator=generator, device=p.device))
+            if u * q_x <= float(p[x]):
+                out.append(x)
+                continue
+            if q is not None:
+                residual = (p - q).clamp(min=0)
+            else:
+                residual = p.clone()
+                residual[x] = 0.0
+            if float(residual.sum()) <= 0:
+                residual = p
+            out.append(int(torch.multinomial(residual / residual.sum(), 1, generator=generator)))
+            break
+        else:
+            p = target_probs[len(drafts)]
+            out.append(int(torch.multinomial(p / p.sum(), 1, generator=generator)))
+        self._update(seq_id, len(drafts), len(out) - 1)
+        return out
+
+    def forget(self, seq_id: str) -> None:
+        self._rate.pop(seq_id, None)
+        self._k.pop(seq_id, None)
+        self.proposer.forget(seq_id)
+
+    def _update(self, seq_id: str, drafted: int, accepted: int):
+        SPEC_TOKENS_PER_STEP.observe(accepted + 1)
+        if not drafted:
+            return
+        SPEC_DRAFTED_TOKENS.inc(drafted)
+        SPEC_ACCEPTED_TOKENS.inc(accepted)
+        ratio = accepted / drafted
+        rate = self._rate[seq_id] = self.ema * self._rate.get(seq_id, ratio) + (1 - self.ema) * ratio
+        self.rate = self.ema * self.rate + (1 - self.ema) * ratio
+        SPEC_ACCEPTANCE_RATE.set(self.rate)
+        k = self._k.get(seq_id, 1)
+        if rate > 0.8 and accepted == drafted:
+            self._k[seq_id] = min(self.max_draft_steps, k + 1)
+        elif rate < 0.4:
+            self._k[seq_id] = max(1, k - 1)
+
 
-    async def generate(self, reqs: List[GenerateRequest]) -> List[GenerateResult]:
-        draft_res = await self.draft.generate_batch(reqs)
-        verify = [VerifyRequest(prompt=r.prompt, proposed=list(range(min(self.max_draft_steps, dr.tokens))))
-                  for r, dr in zip(reqs, draft_res)]
-        verified = await self.target.verify_batch(verify)
-        return [v.to_generate_result() for v in verified]
+def target_probs_for(logits: torch.Tensor, reqs: Sequence, generators: Sequence,
+                     contexts: Sequence[List[int]]) -> torch.Tensor:
+    """Sampling distributions for verification rows (same per-request params as plain decoding)."""
+    batch = SamplingBatch.from_requests(reqs, generators, logits.device)
+    needs_context = any(getattr(r, "repetition_penalty", 1.0) != 1.0 for r in reqs)
+    return probs_from_logits(logits, batch, contexts if needs_context else None)
@@ -1,2 +1,71 @@
+# Incremental detokenization for streamed output
+from typing import List, Optional, Sequence
 
-# Placeholder for SSE or gRPC streaming utilities
+
+class IncrementalDetokenizer:
+    """
+    Turns a growing list of token ids into text deltas with O(1) decode work per token.
+
+    Only a short window is re-decoded each time: the tokens already emitted since the
+    previous delta (context, so merges such as SentencePiece's leading space come out
+    right) plus the new ones. Text ending in an incomplete UTF-8 sequence ("\\ufffd") is
+    held back until the bytes completing it arrive. With `incremental=False` nothing is
+    decoded until `final`, which then decodes everything once.
+
+    `stop` strings: text is cut before the first occurrence and `stopped` is set. A
+    tail that could still grow into a stop string is held back until it cannot.
+    """
+
+    def __init__(self, tokenizer, incremental: bool = True, skip_special_tokens: bool = True,
+                 stop: Optional[Sequence[str]] = None):
+        self.tokenizer = tokenizer
+        self.stop = [s for s in stop or () if s]
+        self.incremental = incremental or bool(self.stop)  # stop strings need the text as it grows
+        self.skip_special_tokens = skip_special_tokens
+        self.ids: List[int] = []
+        self.text = ""
+        self.stopped = False
+        self._prefix = 0  # start of the decode window
+        self._read = 0    # ids[:_read] are already decoded
+        self._held = ""   # decoded, but possibly the start of a stop string
+
+    def add(self, token_ids: List[int], final: bool = False) -> str:
+        """Append `token_ids`; returns the text they complete (possibly "")."""
+        self.ids += token_ids
+        if self.stopped:
+            return ""
+        if not self.incremental:
+            if final:
+                self.text = self._decode(self.ids)
+                return self.text
+            return ""
+        pending = self._held + self._decode_new(final)
+        delta, self._held = self._cut(pending, final)
+        self.text += delta
+        return delta
+
+    def _decode_new(self, final: bool) -> str:
+        if self._read == len(self.ids):
+            return ""
+        seen = self._decode(self.ids[self._prefix:self._read])
+        window = self._decode(self.ids[self._prefix:])
+        if len(window) <= len(seen) or (window.endswith("\ufffd") and not final):
+            return ""
+        self._prefix, self._read = self._read, len(self.ids)
+        return window[len(seen):]
+
+    def _cut(self, pending: str, final: bool):
+        """Split `pending` into (text to emit, text to hold back)."""
+        if not self.stop:
+            return pending, ""
+        hits = [i for i in (pending.find(s) for s in self.stop) if i >= 0]
+        if hits:
+            self.stopped = True
+            return pending[:min(hits)], ""
+        if final:
+            return pending, ""
+        hold = max((k for s in self.stop for k in range(1, len(s)) if pending.endswith(s[:k])), default=0)
+        return pending[:len(pending) - hold], pending[len(pending) - hold:]
+
+    def _decode(self, ids: List[int]) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
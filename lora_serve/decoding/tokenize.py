@@ -0,0 +1,75 @@
+# Prompt tokenization off the event loop, batched across concurrent requests
+import asyncio
+import copy
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Tuple, TypeVar
+
+from ..core.metrics import STAGE_MS
+
+T = TypeVar("T")
+
+
+class TokenizerPool:
+    """
+    Tokenizes prompts in worker threads. Prompts submitted in the same event-loop
+    iteration are encoded together with one batched call (fast tokenizers encode a
+    batch in parallel and release the GIL); each worker thread uses its own copy of the
+    tokenizer, since HF tokenizers are not safe to share across threads.
+    """
+
+    def __init__(self, tokenizer, workers: int = 2, max_batch: int = 64):
+        self.tokenizer = tokenizer
+        self.max_batch = max_batch
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tokenize")
+        self._local = threading.local()
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+
+    @classmethod
+    def from_pretrained(cls, model_id: str, **kwargs) -> "TokenizerPool":
+        from transformers import AutoTokenizer
+        return cls(AutoTokenizer.from_pretrained(model_id, use_fast=True, trust_remote_code=True), **kwargs)
+
+    async def encode(self, text: str) -> List[int]:
+        """Token ids of `text`, exactly as the engine would tokenize the prompt."""
+        fut = asyncio.get_running_loop().create_future()
+        if not self._pending:
+            asyncio.get_running_loop().call_soon(self._flush)
+        self._pending.append((text, fut))
+        return await fut
+
+    async def run(self, fn: Callable[[Any], T]) -> T:
+        """`fn(tokenizer)` on a worker thread, with that thread's copy of the tokenizer."""
+        return await asyncio.get_running_loop().run_in_executor(self._pool, lambda: fn(self._tokenizer()))
+
+    def _flush(self) -> None:
+        batch, self._pending = self._pending, []
+        loop = asyncio.get_running_loop()
+        for i in range(0, len(batch), self.max_batch):
+            chunk = batch[i:i + self.max_batch]
+            loop.run_in_executor(self._pool, self._encode, [t for t, _ in chunk]).add_done_callback(
+                lambda f, chunk=chunk: _deliver(chunk, f))
+
+    def _tokenizer(self):
+        tok = getattr(self._local, "tokenizer", None)
+        if tok is None:
+            tok = self._local.tokenizer = copy.deepcopy(self.tokenizer)
+        return tok
+
+    def _encode(self, texts: List[str]) -> List[List[int]]:
+        start = time.perf_counter()
+        ids = self._tokenizer()(texts, truncation=True)["input_ids"]
+        STAGE_MS.labels(stage="tokenize").observe((time.perf_counter() - start) * 1000)
+        return ids
+
+
+def _deliver(chunk: List[Tuple[str, asyncio.Future]], done: asyncio.Future) -> None:
+    ex = done.exception()
+    for i, (_, fut) in enumerate(chunk):
+        if fut.done():
+            continue
+        if ex is not None:
+            fut.set_exception(ex)
+        else:
+            fut.set_result(done.result()[i])
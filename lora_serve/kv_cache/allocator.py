@@ -1,21 +1,116 @@
 
+import heapq
+from typing import Dict, List, Optional, Tuple
+
+
 class BlockAllocator:
+    """
+    Paged KV allocator: a free-list of fixed-size blocks, a block table per key
+    (request/sequence id) and reference counts so blocks can be shared between
+    keys (forks, cached prefixes) and copied on write.
+
+    Free block ids are handed out lowest-first so the backing storage stays compact.
+    """
+
     def __init__(self, block_tokens: int, capacity_blocks: int):
         self.block_tokens = block_tokens
         self.capacity = capacity_blocks
-        self.used = 0
+        self._free: List[int] = list(range(capacity_blocks))  # already a valid min-heap
+        self._refs: Dict[int, int] = {}
+        self.tables: Dict[str, List[int]] = {}
+        self.tokens: Dict[str, int] = {}
+
+    def blocks_for(self, tokens: int) -> int:
+        return (tokens + self.block_tokens - 1) // self.block_tokens
+
+    def reserve(self, key: str, tokens: int) -> Optional[List[int]]:
+        """
+        Grow `key`'s block table so it can hold `tokens` tokens in total.
+        Returns the block table, or None (and allocates nothing) if out of blocks.
+        """
+        table = self.tables.setdefault(key, [])
+        missing = self.blocks_for(tokens) - len(table)
+        if missing > len(self._free):
+            if not table:
+                del self.tables[key]
+            return None
+        for _ in range(missing):
+            table.append(self._take())
+        self.tokens[key] = max(self.tokens.get(key, 0), tokens)
+        return table
+
+    def share(self, key: str, blocks: List[int], tokens: int) -> List[int]:
+        """Start `key`'s table with existing blocks (e.g. a cached prefix) holding `tokens` tokens."""
+        for b in blocks:
+            self._refs[b] += 1
+        self.tables[key] = list(blocks)
+        self.tokens[key] = tokens
+        return self.tables[key]
 
-    def reserve(self, key: str, tokens: int):
-        blocks = (tokens + self.block_tokens - 1) // self.block_tokens
-        if self.used + blocks > self.capacity:
+    def fork(self, src: str, dst: str) -> List[int]:
+        """`dst` shares every block of `src`; writes to either copy-on-write from then on."""
+        return self.share(dst, self.tables[src], self.tokens.get(src, 0))
+
+    def copy_on_write(self, key: str, index: int) -> Optional[Tuple[int, int]]:
+        """
+        Make block `index` of `key`'s table exclusively owned before a write.
+        Returns (src, dst) when a copy is needed, None when the block is already private.
+        Raises MemoryError if no block is free for the copy.
+        """
+        table = self.tables[key]
+        src = table[index]
+        if self._refs[src] == 1:
             return None
-        self.used += blocks
-        return blocks
+        if not self._free:
+            raise MemoryError("KV cache out of blocks (copy-on-write)")
+        dst = self._take()
+        self._refs[src] -= 1
+        table[index] = dst
+        return src, dst
+
+    def shared_in(self, key: str, start: int, end: int) -> int:
+        """Shared blocks of `key` among those holding positions start..end-1 (a write there copies each)."""
+        table = self.tables.get(key, [])
+        return sum(1 for b in table[start // self.block_tokens:self.blocks_for(end)] if self._refs[b] > 1)
+
+    def incref(self, block: int):
+        self._refs[block] += 1
+
+    def decref(self, block: int):
+        self._refs[block] -= 1
+        if self._refs[block] == 0:
+            del self._refs[block]
+            heapq.heappush(self._free, block)
+
+    def truncate(self, key: str, tokens: int):
+        """Shrink `key` to its first `tokens` tokens, freeing blocks past the end."""
+        table = self.tables[key]
+        keep = self.blocks_for(tokens)
+        for b in table[keep:]:
+            self.decref(b)
+        del table[keep:]
+        self.tokens[key] = tokens
 
     def release(self, key: str):
-        # scaffold: no per-key tracking
-        pass
+        for b in self.tables.pop(key, []):
+            self.decref(b)
+        self.tokens.pop(key, None)
+
+    def refcount(self, block: int) -> int:
+        return self._refs.get(block, 0)
+
+    def _take(self) -> int:
+        b = heapq.heappop(self._free)
+        self._refs[b] = 1
+        return b
+
+    def free_blocks(self): return len(self._free)
+    def used_blocks(self): return self.capacity - len(self._free)
+    def shared_blocks(self): return sum(1 for r in self._refs.values() if r > 1)
 
-    def free_blocks(self): return self.capacity - self.used
-    def used_blocks(self): return self.used
-    def fragmentation(self): return 0.0
+    def fragmentation(self) -> float:
+        """Fraction of slots in tables' blocks that hold no token (tail-block waste)."""
+        slots = sum(len(t) for t in self.tables.values()) * self.block_tokens
+        if not slots:
+            return 0.0
+        return 1.0 - sum(self.tokens.values()) / slots
@@ -1,19 +1,141 @@
 
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+
 from .allocator import BlockAllocator
+from ..core.metrics import KV_BLOCKS_FREE, KV_BLOCKS_SHARED, KV_BLOCKS_USED, KV_FRAGMENTATION
+
+# per-layer (key, value) pair
+LayerKV = Tuple[torch.Tensor, torch.Tensor]
+
 
 class KVCacheManager:
+    """
+    Block-paged KV storage for the engine.
+
+    Every block holds `block_size_tokens` positions of K and V for all layers in one
+    pool tensor shaped [blocks, layers, 2, kv_heads, block_tokens, head_dim]. The pool
+    is materialized lazily and grows (doubling, up to `capacity_blocks`) only as blocks
+    are actually handed out, so memory follows the tokens in use rather than a padded
+    batch x max_new_tokens reservation.
+    """
+
     def __init__(self, block_size_tokens: int, capacity_blocks: int):
         self.alloc = BlockAllocator(block_size_tokens, capacity_blocks)
+        self.block_tokens = block_size_tokens
+        self.pool: Optional[torch.Tensor] = None
+
+    # ---- allocation ---------------------------------------------------------
 
     def allocate(self, req_id: str, tokens: int):
+        """Make room for `tokens` tokens in total; returns the block table or None."""
         return self.alloc.reserve(req_id, tokens)
 
+    def can_allocate(self, req_id: str, tokens: int) -> bool:
+        have = len(self.alloc.tables.get(req_id, ()))
+        return self.alloc.blocks_for(tokens) - have <= self.alloc.free_blocks()
+
+    def share(self, req_id: str, blocks: List[int], tokens: int):
+        """Start `req_id` on already-filled blocks (e.g. a cached prefix)."""
+        return self.alloc.share(req_id, blocks, tokens)
+
+    def unshare(self, req_id: str, start: int, end: int) -> bool:
+        """
+        Copy-on-write now the shared blocks that a write of positions start..end-1 would
+        copy, so the write itself cannot run out of blocks. False (nothing copied) if
+        there are not enough free blocks.
+        """
+        if self.alloc.shared_in(req_id, start, end) > self.alloc.free_blocks():
+            return False
+        # the engine writes the pool under inference mode; copies into it must be made the same way
+        with torch.inference_mode(self.pool is not None and self.pool.is_inference()):
+            for idx in range(start // self.block_tokens, self.alloc.blocks_for(end)):
+                self._copy_on_write(req_id, idx)
+        return True
+
+    def fork(self, src_id: str, dst_id: str):
+        return self.alloc.fork(src_id, dst_id)
+
+    def truncate(self, req_id: str, tokens: int):
+        """Drop cached positions from `tokens` on (e.g. rejected speculative tokens)."""
+        self.alloc.truncate(req_id, tokens)
+
     def free(self, req_id: str):
         self.alloc.release(req_id)
 
+    def num_tokens(self, req_id: str) -> int:
+        return self.alloc.tokens.get(req_id, 0)
+
+    # ---- storage ------------------------------------------------------------
+
+    def write(self, req_id: str, start: int, layers: Sequence[LayerKV]):
+        """Store K/V ([kv_heads, n, head_dim] per layer) for positions start..start+n."""
+        n = layers[0][0].shape[1]
+        self._ensure_pool(layers)
+        table = self.alloc.tables[req_id]
+        kv = torch.stack([torch.stack([k, v]) for k, v in layers])  # [layers, 2, H, n, D]
+        pos = start
+        while pos < start + n:
+            idx, offset = divmod(pos, self.block_tokens)
+            self._copy_on_write(req_id, idx)
+            take = min(self.block_tokens - offset, start + n - pos)
+            self._grow(table[idx] + 1)
+            self.pool[table[idx], :, :, :, offset:offset + take] = kv[:, :, :, pos - start:pos - start + take]
+            pos += take
+
+    def gather(self, req_ids: List[str], lengths: List[int], width: int) -> List[LayerKV]:
+        """
+        Left-padded batch view of the first `lengths[i]` cached tokens of each request:
+        per layer (k, v) shaped [batch, kv_heads, width, head_dim].
+        """
+        _, layers, _, heads, _, dim = self.pool.shape
+        out = self.pool.new_zeros((layers, 2, len(req_ids), heads, width, dim))
+        for i, (req_id, n) in enumerate(zip(req_ids, lengths)):
+            if n == 0:
+                continue
+            blocks = self.alloc.tables[req_id][:self.alloc.blocks_for(n)]
+            idx = torch.tensor(blocks, device=self.pool.device)
+            # [nb, L, 2, H, bt, D] -> [L, 2, H, nb*bt, D]
+            seq = self.pool.index_select(0, idx).permute(1, 2, 3, 0, 4, 5).reshape(layers, 2, heads, -1, dim)
+            out[:, :, i, :, width - n:] = seq[:, :, :, :n]
+        return [(out[layer, 0], out[layer, 1]) for layer in range(layers)]
+
+    def _copy_on_write(self, req_id: str, idx: int):
+        cow = self.alloc.copy_on_write(req_id, idx)
+        if cow is not None:
+            src, dst = cow
+            self._grow(dst + 1)
+            self.pool[dst] = self.pool[src]
+
+    def _ensure_pool(self, layers: Sequence[LayerKV]):
+        if self.pool is None:
+            k = layers[0][0]
+            shape = (1, len(layers), 2, k.shape[0], self.block_tokens, k.shape[2])
+            self.pool = k.new_zeros(shape)
+
+    def _grow(self, blocks: int):
+        have = self.pool.shape[0]
+        if blocks <= have:
+            return
+        size = min(max(blocks, have * 2), self.alloc.capacity)
+        grown = self.pool.new_zeros((size,) + tuple(self.pool.shape[1:]))
+        grown[:have] = self.pool
+        self.pool = grown
+
+    # ---- stats --------------------------------------------------------------
+
     def stats(self):
         return {
             "blocks_free": self.alloc.free_blocks(),
             "blocks_used": self.alloc.used_blocks(),
+            "blocks_shared": self.alloc.shared_blocks(),
             "frag_ratio": self.alloc.fragmentation(),
+            "pool_blocks": 0 if self.pool is None else self.pool.shape[0],
         }
+
+    def publish_metrics(self):
+        KV_BLOCKS_USED.set(self.alloc.used_blocks())
+        KV_BLOCKS_FREE.set(self.alloc.free_blocks())
+        KV_BLOCKS_SHARED.set(self.alloc.shared_blocks())
+        KV_FRAGMENTATION.set(self.alloc.fragmentation())
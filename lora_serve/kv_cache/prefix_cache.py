@@ -0,0 +1,147 @@
+
+import itertools
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from .allocator import BlockAllocator
+from ..core.metrics import PREFIX_CACHE_BLOCKS, PREFIX_CACHE_HITS, PREFIX_CACHE_MISSES, PREFIX_CACHE_SAVED_TOKENS
+
+
+@dataclass
+class _Node:
+    block: int
+    parent: Optional["_Node"]
+    key: Tuple[int, ...]
+    last_access: int = 0
+    children: Dict[Tuple[int, ...], "_Node"] = field(default_factory=dict)
+
+
+class PrefixCache:
+    """
+    Block-granular radix tree over prompt token ids mapping shared prefixes to KV blocks.
+
+    Each edge is one full KV block worth of token ids, so a path from the root spells a
+    cacheable prefix and its nodes hold the blocks with that prefix's K/V. There is one
+    tree per adapter (LoRA changes the K/V of identical tokens). The cache keeps its own
+    reference on every block it holds; LRU leaves are evicted once more than
+    `max_blocks` are cached, or on demand when the allocator runs dry.
+    """
+
+    def __init__(self, alloc: BlockAllocator, max_blocks: int):
+        self.alloc = alloc
+        self.block_tokens = alloc.block_tokens
+        self.max_blocks = max_blocks
+        self._roots: Dict[Optional[str], _Node] = {}
+        self._num_blocks = 0
+        self._clock = itertools.count(1)
+
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def lookup(self, adapter_id: Optional[str], token_ids: List[int]) -> Tuple[List[int], int]:
+        """
+        Longest cached prefix of `token_ids` (whole blocks, always leaving at least the
+        last token to compute). Returns (blocks, num_tokens).
+        """
+        node = self._roots.get(adapter_id)
+        blocks: List[int] = []
+        if node is None or self.max_blocks <= 0:
+            return blocks, 0
+        now = next(self._clock)
+        usable = (len(token_ids) - 1) // self.block_tokens
+        for i in range(usable):
+            node = node.children.get(tuple(token_ids[i * self.block_tokens:(i + 1) * self.block_tokens]))
+            if node is None:
+                break
+            node.last_access = now
+            blocks.append(node.block)
+        return blocks, len(blocks) * self.block_tokens
+
+    def record(self, cached_tokens: int):
+        """Count one admitted lookup (hit if any prefix tokens were reused)."""
+        if cached_tokens:
+            self.hits += 1
+            self.saved_tokens += cached_tokens
+            PREFIX_CACHE_HITS.inc()
+            PREFIX_CACHE_SAVED_TOKENS.inc(cached_tokens)
+        else:
+            self.misses += 1
+            PREFIX_CACHE_MISSES.inc()
+
+    def insert(self, adapter_id: Optional[str], token_ids: List[int], blocks: List[int]):
+        """Cache every full block of `token_ids` (whose K/V live in `blocks`)."""
+        if self.max_blocks <= 0:
+            return
+        node = self._roots.setdefault(adapter_id, _Node(block=-1, parent=None, key=()))
+        now = next(self._clock)
+        for i in range(min(len(token_ids) // self.block_tokens, len(blocks))):
+            key = tuple(token_ids[i * self.block_tokens:(i + 1) * self.block_tokens])
+            child = node.children.get(key)
+            if child is None:
+                child = _Node(block=blocks[i], parent=node, key=key)
+                node.children[key] = child
+                self.alloc.incref(blocks[i])
+                self._num_blocks += 1
+            child.last_access = now
+            node = child
+        if self._num_blocks > self.max_blocks:
+            self.evict(self._num_blocks - self.max_blocks)
+        PREFIX_CACHE_BLOCKS.set(self._num_blocks)
+
+    def evict(self, num_blocks: int, reclaim: bool = False) -> int:
+        """
+        Drop up to `num_blocks` least-recently-used leaves; returns how many were dropped.
+        With `reclaim`, only leaves no running sequence still uses are taken, so every
+        dropped block goes straight back to the allocator's free list.
+        """
+        dropped = 0
+        while dropped < num_blocks:
+            leaves = [n for n in self._nodes()
+                      if not n.children and (not reclaim or self.alloc.refcount(n.block) == 1)]
+            if not leaves:
+                break
+            leaves.sort(key=lambda n: n.last_access)
+            for leaf in leaves[:num_blocks - dropped]:
+                self._remove(leaf)
+                dropped += 1
+        PREFIX_CACHE_BLOCKS.set(self._num_blocks)
+        return dropped
+
+    def drop(self, adapter_id: Optional[str]):
+        """Forget every prefix cached for `adapter_id` (its weights changed or went away)."""
+        root = self._roots.pop(adapter_id, None)
+        if root is None:
+            return
+        stack = list(root.children.values())
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            self.alloc.decref(node.block)
+            self._num_blocks -= 1
+        PREFIX_CACHE_BLOCKS.set(self._num_blocks)
+
+    def num_blocks(self) -> int:
+        return self._num_blocks
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "blocks": self._num_blocks,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_tokens": self.saved_tokens,
+        }
+
+    def _remove(self, node: _Node):
+        del node.parent.children[node.key]
+        self.alloc.decref(node.block)
+        self._num_blocks -= 1
+
+    def _nodes(self):
+        stack = [c for root in self._roots.values() for c in root.children.values()]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            yield node
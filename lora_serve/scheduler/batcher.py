@@ -1,60 +1,366 @@
 
 import asyncio
+import dataclasses
+import itertools
 import logging
-from typing import List
-from .queue import TenantQueues
-from .policies import choose_batch
+from contextlib import aclosing
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Set, Tuple
+from .queue import ANY_ADAPTER, TenantQueues, _Entry, _now_ms
+from .policies import choose_batch, _choices, _prompt_tokens, _rough_tokens
+from ..core import profiling, tracing
+from ..core.metrics import (ADAPTER_PREFETCHES, ADAPTER_SWITCH_MS, ADAPTER_SWITCHES, BATCH_OCCUPANCY, BATCH_SIZE,
+                            QUEUE_WAIT_MS, TOKENS_GENERATED, TTFT_MS, WASTED_TOKENS_AVOIDED)
 from ..core.engines.engine import IEngine
 from ..core.adapters import LoRAAdapterManager
+from ..core.types import GenerateResult, StepOutput
 
 
 logger = logging.getLogger(__name__)
 
 
 class DynamicBatcher:
+    """
+    Iteration-level scheduler: between every engine step it tops up the running
+    batch from the tenant queues, and resolves a request's future as soon as the
+    engine reports its sequence finished. Streaming requests share the same batches;
+    their text is fanned out per step to a per-request queue. A request with n (or
+    best_of) > 1 runs as that many engine sequences forked from one prefill, and
+    completes when all of them have.
+
+    With tracing on, each request gets queue / adapter.attach / prefill / decode spans
+    (one event per decode step) under the caller's span, built from timestamps when it
+    finishes, plus one engine.step span per step.
+    """
+
     def __init__(self, engine: IEngine, queues: TenantQueues, adapters: LoRAAdapterManager,
-                 max_batch_tokens: int, max_wait_ms: int):
+                 max_batch_tokens: int, max_wait_ms: int, max_staleness_ms: int = 500,
+                 warm_adapters: Sequence[str] = ()):
         self.engine = engine
         self.queues = queues
         self.adapters = adapters
-        self.max_batch_tokens = max_batch_tokens
+        # never schedule more tokens than the engine's memory budget leaves KV room for
+        self.max_batch_tokens = min(max_batch_tokens, getattr(engine, "max_batch_tokens", None) or max_batch_tokens)
         self.max_wait_ms = max_wait_ms
+        # single-adapter engines keep serving the selected adapter's backlog until another
+        # request has waited this long (adapter switches are expensive)
+        self.max_staleness_ms = max_staleness_ms
+        self.warm_adapters = list(warm_adapters)
+
+        # seq_id -> queue entry for sequences currently inside the engine
+        self._running: Dict[str, _Entry] = {}
+        self._costs: Dict[str, int] = {}
+        self._generated: Dict[str, int] = {}  # seq_id -> tokens produced so far
+        self._first_token: Set[str] = set()  # seq_ids that already reported TTFT
+        self._timeline: Dict[str, List[int]] = {}  # tracing: seq_id -> [admitted, each step with tokens] (ns)
+        self._active_adapter = None
+        self._seq_ids = itertools.count()
+        self._batches = 0  # engine steps so far (batch ids in profiles)
 
     async def enqueue(self, req):
-        fut = self.queues.push(getattr(req, "tenant_id", "default") or "default", req)
-        return await fut
+        return await self.push(req)
+
+    def push(self, req) -> asyncio.Future:
+        """Queue `req` without waiting; the future resolves to its result (cancel it to drop the request)."""
+        return self.queues.push(getattr(req, "tenant_id", "default") or "default", req)
+
+    def load(self) -> int:
+        """Requests queued or running on this batcher's engine."""
+        return len(self.queues) + len(self._running)
+
+    async def stream(self, req) -> AsyncIterator[str]:
+        """Yield text chunks of `req` as its sequence advances (set req.stream=True)."""
+        async with aclosing(self.stream_choices(req)) as chunks:
+            async for _, text, _ in chunks:
+                if text:
+                    yield text
+
+    async def stream_choices(self, req) -> AsyncIterator[Tuple[int, str, Optional[GenerateResult]]]:
+        """
+        Yield (choice index, text, result) as the sequences of `req` advance (set
+        req.stream=True); `result` is set on the last chunk of each choice.
+        """
+        sink: asyncio.Queue = asyncio.Queue()
+        fut = self.queues.push(getattr(req, "tenant_id", "default") or "default", req, sink=sink)
+        try:
+            while (chunk := await sink.get()) is not None:
+                yield chunk
+            await fut  # re-raise a failure after the chunks already sent
+        finally:
+            if not fut.done():
+                fut.cancel()  # consumer went away: the batcher drops the request (see _reap_cancelled)
 
     async def run_forever(self):
+        await self._warmup()
         logger.info("DynamicBatcher started")
         while True:
-            batch = await choose_batch(self.queues, self.max_batch_tokens, self.max_wait_ms)
-            if not batch:
-                await asyncio.sleep(0.001)
+            if not self._running:
+                # idle: block until something is queued instead of polling
+                await self.queues.wait()
+            await self._admit()
+            self._reap_cancelled()
+            if not self._running:
+                continue
+
+            BATCH_SIZE.observe(len(self._running))
+            BATCH_OCCUPANCY.observe(min(1.0, sum(self._costs.values()) / self.max_batch_tokens))
+            start = tracing.now_ns()
+            try:
+                outputs = await self.engine.step()
+            except Exception as ex:
+                logger.exception("engine step failed; failing %d running requests", len(self._running))
+                self._fail(list(self._running), ex)
                 continue
-            logger.debug("Formed batch of %d requests", len(batch))
+            self._batches += 1
+            if tracing.enabled():
+                tracing.record_span("engine.step", None, start, tracing.now_ns(),
+                                    {"rows": len(self._running), "outputs": len(outputs)})
+            if profiling.active():
+                profiling.record_batch(self, self._batches, start, tracing.now_ns(), len(self._running),
+                                       sorted({e.adapter_id or "base" for e in self._running.values()}))
+            self._complete(outputs)
 
-            # Determine the adapter for this batch (all the same by policy)
-            adapter_id = getattr(batch[0].req, "adapter_id", None)
+    async def _warmup(self):
+        """Make the configured adapters resident and run the engine on them before serving."""
+        paths = {}
+        for adapter_id in self.warm_adapters:
             try:
-                if adapter_id:
-                    # Ensure loaded (path resolution/caching) at the manager layer
-                    path = await self.adapters.ensure_loaded(adapter_id)
-                    # Make it active on the engine (idempotent)
-                    await self.engine.attach_adapter(adapter_id, str(path))
-                    # Now generate
-                results = await self.engine.generate_batch([e.req for e in batch])
+                paths[adapter_id] = str(await self.adapters.ensure_active(adapter_id))
+                ADAPTER_PREFETCHES.labels(source="startup").inc()
             except FileNotFoundError:
-                # Defensive: adapter vanished between route check and now
-                for e in batch:
-                    if not e.fut.done():
-                        e.fut.set_exception(RuntimeError(f"Adapter '{adapter_id}' not found"))
+                logger.warning("Warm adapter '%s' not found under the adapter root", adapter_id)
+            except Exception:
+                logger.exception("Could not warm adapter '%s'", adapter_id)
+        try:
+            await self.engine.warmup(paths)
+        except Exception:
+            logger.exception("Engine warmup failed; serving cold")
+
+    async def _admit(self):
+        """Add newly queued requests to the running batch (without waiting if it is busy)."""
+        mixed = getattr(self.engine, "supports_mixed_adapters", False)
+        if self._running:
+            budget = self.max_batch_tokens - sum(self._costs.values())
+            if budget <= 0:
+                return
+            # Single-adapter engines: only same-adapter work may join a running batch
+            adapter_id = ANY_ADAPTER if mixed else self._active_adapter
+            batch = await choose_batch(self.queues, budget, 0, adapter_id=adapter_id, mixed_adapters=mixed)
+            if batch and _rough_tokens(batch[0].req) > budget:
+                # choose_batch always takes its first entry; one that does not fit waits for rows to finish
+                for e in reversed(batch):
+                    self.queues.requeue(e)
+                return
+        else:
+            prefer = ANY_ADAPTER if mixed else self._active_adapter
+            batch = await choose_batch(self.queues, self.max_batch_tokens, self.max_wait_ms,
+                                       mixed_adapters=mixed, prefer_adapter=prefer,
+                                       max_staleness_ms=self.max_staleness_ms)
+        for e in [e for e in batch if e.fut.cancelled()]:
+            batch.remove(e)
+            self._reject([e], None)
+            WASTED_TOKENS_AVOIDED.labels(reason="cancelled").inc(max(1, e.req.max_tokens))
+        if not batch:
+            return
+        logger.debug("Admitting %d requests (running=%d)", len(batch), len(self._running))
+        now, admitted_ns = _now_ms(), tracing.now_ns()
+        for e in batch:
+            QUEUE_WAIT_MS.observe(now - e.enq_ts_ms)
+        self._trace("queue", batch, None, admitted_ns)
+        # pin before attaching, so making one adapter resident cannot evict another one of this batch
+        for e in batch:
+            self._pin(e, True)
+
+        failed = {}
+        if mixed:
+            # every adapter in the batch must be resident; the engine picks per row
+            for adapter_id in {e.adapter_id for e in batch} - {None}:
+                start = tracing.now_ns()
+                ex = await self._attach(adapter_id)
+                if ex is not None:
+                    failed[adapter_id] = ex
+                self._trace("adapter.attach", [e for e in batch if e.adapter_id == adapter_id], start)
+        elif not self._running and batch[0].adapter_id != self._active_adapter:
+            start = tracing.now_ns()
+            failed = await self._switch(batch[0].adapter_id)
+            self._trace("adapter.attach", batch, start)
+
+        for e in batch:
+            adapter_id = getattr(e.req, "adapter_id", None)
+            if adapter_id in failed:
+                self._reject([e], failed[adapter_id])
                 continue
+            e.seq_ids = [f"seq-{next(self._seq_ids)}" for _ in range(_choices(e.req))]
+            try:
+                self.engine.add_sequence(e.seq_ids[0], e.req)
+                for seq_id in e.seq_ids[1:]:
+                    self.engine.add_sequence(seq_id, e.req, fork_of=e.seq_ids[0])
             except Exception as ex:
-                for e in batch:
-                    if not e.fut.done():
-                        e.fut.set_exception(ex)
+                for seq_id in e.seq_ids:
+                    self.engine.abort_sequence(seq_id)
+                self._reject([e], ex)
                 continue
+            for i, seq_id in enumerate(e.seq_ids):
+                self._running[seq_id] = e
+                # forks share the first sequence's prompt
+                self._costs[seq_id] = (_prompt_tokens(e.req) if i == 0 else 0) + max(1, e.req.max_tokens)
+                self._generated[seq_id] = 0
+                if tracing.sampled(e.trace_ctx):
+                    self._timeline[seq_id] = [tracing.now_ns()]
+
+    async def _switch(self, adapter_id) -> dict:
+        """Single-adapter engines: select `adapter_id` (None = base model) for the next batch."""
+        start = _now_ms()
+        ex = await self._attach(adapter_id) if adapter_id is not None else None
+        if ex is not None:
+            return {adapter_id: ex}
+        ADAPTER_SWITCHES.inc()
+        ADAPTER_SWITCH_MS.observe(_now_ms() - start)
+        logger.debug("Switched adapter %s -> %s", self._active_adapter, adapter_id)
+        self._active_adapter = adapter_id
+        return {}
+
+    async def _attach(self, adapter_id: str):
+        try:
+            # host tier (thread-pool load) -> attached to the engine, evicting cold adapters
+            await self.adapters.ensure_active(adapter_id)
+        except FileNotFoundError:
+            # Defensive: adapter vanished between route check and now
+            return RuntimeError(f"Adapter '{adapter_id}' not found")
+        except Exception as ex:
+            logger.exception("attach_adapter failed for '%s'", adapter_id)
+            return ex
+        return None
+
+    def _reap_cancelled(self):
+        """Abort running sequences whose caller is gone (disconnect, timeout): frees their row and KV."""
+        cancelled = {id(e): e for e in self._running.values() if e.fut.cancelled()}
+        for e in cancelled.values():
+            generated = sum(r.tokens for r in e.results.values())
+            for seq_id in e.seq_ids:
+                if seq_id not in self._running:
+                    continue
+                tokens = self._generated.get(seq_id, 0)
+                WASTED_TOKENS_AVOIDED.labels(reason="cancelled").inc(max(0, e.req.max_tokens - tokens))
+                logger.debug("Cancelling %s after %d tokens", seq_id, tokens)
+                generated += tokens
+                self._forget(seq_id)
+                self.engine.abort_sequence(seq_id)
+            self.queues.done(e, _prompt_tokens(e.req) + generated)
+            self._pin(e, False)
+            if e.sink is not None:
+                e.sink.put_nowait(None)
+
+    def _complete(self, outputs: List[StepOutput]):
+        now = _now_ms()
+        for out in outputs:
+            e = self._running.get(out.seq_id)
+            if e is None:
+                continue
+            index = e.seq_ids.index(out.seq_id)
+            self._generated[out.seq_id] += len(out.token_ids)
+            if out.token_ids and out.seq_id not in self._first_token:
+                self._first_token.add(out.seq_id)
+                if index == 0:
+                    TTFT_MS.observe(now - e.enq_ts_ms)
+            timeline = self._timeline.get(out.seq_id)
+            if timeline is not None and out.token_ids:
+                timeline.append(tracing.now_ns())
+            if e.sink is not None and (out.text or out.finished and out.result is not None):
+                e.sink.put_nowait((index, out.text, out.result if out.finished else None))
+            if not out.finished:
+                continue
+            self._forget(out.seq_id)
+            if out.result is not None:
+                TOKENS_GENERATED.labels(endpoint="stream" if e.sink is not None else "generate").inc(out.result.tokens)
+            if timeline is not None:
+                self._trace_sequence(e, out, timeline)
+            if out.error:
+                # one failed choice fails the request: its other sequences stop too
+                for seq_id in e.seq_ids:
+                    if self._forget(seq_id) is not None:
+                        self.engine.abort_sequence(seq_id)
+                self._finish(e, error=RuntimeError(out.error))
+                continue
+            e.results[index] = out.result
+            if len(e.results) == len(e.seq_ids):
+                self._finish(e, _merge(e))
+
+    def _finish(self, e: _Entry, result: Optional[GenerateResult] = None, error: Optional[Exception] = None):
+        # fairness is charged in actual prompt + generated tokens
+        self.queues.done(e, 0 if result is None else result.prompt_tokens + result.tokens)
+        self._pin(e, False)
+        if e.sink is not None:
+            e.sink.put_nowait(None)
+        if e.fut.done():
+            return
+        if error is not None:
+            e.fut.set_exception(error)
+        else:
+            e.fut.set_result(result)
+
+    def _trace(self, name: str, entries: List[_Entry], start_ns: Optional[int], end_ns: Optional[int] = None):
+        """One span per entry from `start_ns` (None: its enqueue time) to `end_ns` (None: now)."""
+        if not tracing.enabled():
+            return
+        end_ns = end_ns or tracing.now_ns()
+        for e in entries:
+            if tracing.sampled(e.trace_ctx):
+                tracing.record_span(name, e.trace_ctx, start_ns or e.enq_ns, end_ns,
+                                    {"tenant": e.tenant, "adapter_id": e.adapter_id or ""})
+
+    def _trace_sequence(self, e: _Entry, out: StepOutput, timeline: List[int]):
+        """prefill: admitted -> first token; decode: first -> last token, one event per step."""
+        admitted, steps = timeline[0], timeline[1:] or [tracing.now_ns()]
+        tracing.record_span("prefill", e.trace_ctx, admitted, steps[0], {"prompt_tokens": _prompt_tokens(e.req)})
+        if out.result is not None:
+            attributes = {"tokens": out.result.tokens, "finish_reason": out.result.finish_reason or ""}
+        else:
+            attributes = {"error": out.error or ""}
+        tracing.record_span("decode", e.trace_ctx, steps[0], steps[-1], attributes,
+                            events=[("step", ts) for ts in steps[1:]])
+
+    def _fail(self, seq_ids: List[str], ex: Exception):
+        for seq_id in seq_ids:
+            e = self._running.get(seq_id)
+            if e is None:
+                continue
+            for choice in e.seq_ids:
+                if self._forget(choice) is not None:
+                    self.engine.abort_sequence(choice)
+            self._reject([e], ex)
+
+    def _forget(self, seq_id: str) -> Optional[_Entry]:
+        self._costs.pop(seq_id, None)
+        self._generated.pop(seq_id, None)
+        self._first_token.discard(seq_id)
+        self._timeline.pop(seq_id, None)
+        return self._running.pop(seq_id, None)
+
+    def _pin(self, e: _Entry, pinned: bool):
+        if e.adapter_id is None:
+            return
+        if pinned:
+            self.adapters.acquire(e.adapter_id)
+        else:
+            self.adapters.release(e.adapter_id)
+
+    def _reject(self, batch: List[_Entry], ex: Exception):
+        for e in batch:
+            self.queues.done(e, 0)
+            self._pin(e, False)
+            if e.sink is not None:
+                e.sink.put_nowait(None)
+            if not e.fut.done():
+                e.fut.set_exception(ex)
+
 
-            logger.debug("Engine returned %d results", len(results))
-            for e, r in zip(batch, results):
-                e.fut.set_result(r)
+def _merge(e: _Entry) -> GenerateResult:
+    """One result for every choice of a request: best_of keeps the n most likely (mean token logprob)."""
+    results = [e.results[i] for i in range(len(e.seq_ids))]
+    if len(results) == 1:
+        return results[0]
+    chosen = results
+    n = max(1, getattr(e.req, "n", 1))
+    if len(results) > n:
+        chosen = sorted(results, key=lambda r: (r.logprob or 0.0) / max(1, r.tokens), reverse=True)[:n]
+    return dataclasses.replace(chosen[0], tokens=sum(r.tokens for r in results), choices=chosen)
@@ -1,65 +1,176 @@
 
-from typing import List
-from .queue import TenantQueues
+import asyncio
+from typing import Dict, Iterable, Optional
+from .queue import ANY_ADAPTER, TenantQueues, _Entry
+from ..core.metrics import TENANT_SERVED_TOKENS
 from ..core.types import GenerateRequest
 
 
-def same_adapter(entry, first_adapter):
-    return getattr(entry.req, "adapter_id", None) == first_adapter
+class WeightedFairPolicy:
+    """
+    Start-time weighted fair queuing across tenants, costed in tokens.
 
+    Every tenant has a virtual time that advances by cost / weight for the work it is
+    served. The next tenant served is the eligible one with the highest priority class,
+    then the lowest virtual time. A tenant coming back from idle starts at the current
+    virtual clock, so idle time cannot be banked into a burst. Entries are charged
+    their estimated cost when popped (so one batch cannot be filled from a single
+    tenant before any cost shows up) and corrected to the actual prompt + generated
+    tokens when they finish. Tenants at their concurrency cap are skipped.
+    """
 
-async def choose_batch(queues: TenantQueues, max_batch_tokens: int, max_wait_ms: int):
-    # naive: pick first available one-by-one
-    batch = []
-    first = await queues.pop_any()
+    def __init__(self, weights: Optional[Dict[str, float]] = None, priorities: Optional[Dict[str, int]] = None,
+                 max_concurrency: Optional[Dict[str, int]] = None, default_weight: float = 1.0):
+        self.weights = dict(weights or {})
+        self.priorities = dict(priorities or {})
+        self.max_concurrency = dict(max_concurrency or {})
+        self.default_weight = default_weight
+        self._vtime: Dict[str, float] = {}
+        self._running: Dict[str, int] = {}
+        self._clock = 0.0
+
+    def pick(self, tenants: Iterable[str]) -> Optional[str]:
+        """Tenant to serve next among those with queued work; None if all are capped."""
+        best, best_key = None, None
+        for t in tenants:
+            cap = self.max_concurrency.get(t)
+            if cap is not None and self._running.get(t, 0) >= cap:
+                continue
+            key = (-self.priorities.get(t, 0), max(self._vtime.get(t, 0.0), self._clock))
+            if best_key is None or key < best_key:
+                best, best_key = t, key
+        return best
+
+    def on_pop(self, entry: _Entry) -> None:
+        t = entry.tenant
+        start = max(self._vtime.get(t, 0.0), self._clock)
+        before = (self._clock, self._vtime.get(t, 0.0), start)
+        self._clock = start
+        entry.cost = _rough_tokens(entry.req)
+        self._vtime[t] = start + entry.cost / self._weight(t)
+        entry.undo = before + (self._vtime[t],)
+        self._running[t] = self._running.get(t, 0) + 1
+
+    def on_requeue(self, entry: _Entry) -> None:
+        t = entry.tenant
+        clock, vtime, start, after = entry.undo
+        # undo the pop exactly unless later pops built on it (entries are requeued last-popped
+        # first); compared with the stored values, not recomputed ones
+        if self._clock == start:
+            self._clock = clock
+        if self._vtime[t] == after:
+            self._vtime[t] = vtime
+        else:
+            self._vtime[t] -= entry.cost / self._weight(t)
+        entry.cost, entry.undo = 0, None
+        self._running[t] -= 1
+
+    def on_done(self, entry: _Entry, tokens: int) -> None:
+        t = entry.tenant
+        self._vtime[t] += (tokens - entry.cost) / self._weight(t)
+        self._running[t] -= 1
+        TENANT_SERVED_TOKENS.labels(tenant=t).inc(tokens)
+
+    def _weight(self, tenant: str) -> float:
+        return max(1e-6, self.weights.get(tenant, self.default_weight))
+
+
+
+async def choose_batch(queues: TenantQueues, max_batch_tokens: int, max_wait_ms: int,
+                       adapter_id=ANY_ADAPTER, mixed_adapters: bool = False,
+                       prefer_adapter=ANY_ADAPTER, max_staleness_ms: int = 0,
+                       length_buckets: bool = True, max_skips: int = 16):
+    """
+    Pop a batch of entries whose padded cost fits `max_batch_tokens`.
+
+    Prompts of a batch are prefilled together, padded to the longest one, so the cost
+    is rows x longest prompt (plus each row's max_tokens), not a sum of per-request
+    estimates. With `length_buckets` the batch only takes prompts from the first
+    entry's length bucket (powers of two); up to `max_skips` entries from other buckets
+    are passed over and put back at the head of their queues, in order.
+
+    The first entry is always taken. With `max_wait_ms=0` only already-queued work is
+    collected (used to top up a running batch between decode steps); otherwise the
+    fill blocks on the queues until the window (counted from the first entry's
+    arrival) closes. `adapter_id` restricts the batch to one adapter (the one already
+    running on the engine). Unless the engine can mix adapters per row
+    (`mixed_adapters`), the batch is limited to the first entry's adapter.
+
+    Adapter affinity: while `prefer_adapter` (the one selected on the engine) has
+    backlog, the batch is taken from it to avoid a switch, unless another request has
+    waited longer than `max_staleness_ms`; then that request's adapter goes next.
+    """
+    if adapter_id is ANY_ADAPTER and prefer_adapter is not ANY_ADAPTER and queues.has_work(prefer_adapter):
+        stale = queues.oldest(exclude_adapter=prefer_adapter)
+        if stale is None or _now_ms() - stale.enq_ts_ms < max_staleness_ms:
+            adapter_id = prefer_adapter
+        else:
+            adapter_id = stale.adapter_id
+    first = queues.pop(adapter_id)
     if not first:
         return []
 
-    batch = [first]
-    budget = _rough_tokens(first.req)
-    first_adapter = getattr(first.req, "adapter_id", None)
+    batch, skipped = [first], []
+    longest = _prompt_tokens(first.req)
+    decode = _decode_tokens(first.req)
+    bucket = _length_bucket(longest)
+    fill_adapter = ANY_ADAPTER if mixed_adapters else first.adapter_id
 
     # Fill until budget or wait window reached
-    # Small spin to let a few more arrive within wait window
-    import asyncio
     start = first.enq_ts_ms
-    while budget < max_batch_tokens:
-        # Stop if we've waited long enough
-        now = _now_ms()
-        if now - start >= max_wait_ms:
-            break
-        # Try to grab another if any
-        nxt = await queues.pop_any()
+    while len(batch) * longest + decode < max_batch_tokens:
+        # Try to grab another compatible entry if any
+        nxt = queues.pop(fill_adapter)
         if nxt is None:
-            # nothing ready; give others a moment to enqueue
-            await asyncio.sleep(0.001)
+            remaining_ms = max_wait_ms - (_now_ms() - start)
+            # sleep until a compatible entry arrives or the window closes
+            if remaining_ms <= 0 or not await queues.wait(fill_adapter, timeout=remaining_ms / 1000):
+                break
             continue
-        if not same_adapter(nxt, first_adapter):
-            # push it back for a later tick
-            queues.push(getattr(nxt.req, "tenant_id", "default") or "default", nxt.req)
-            break
-        new_cost = _rough_tokens(nxt.req)
-        if budget + new_cost > max_batch_tokens:
-            # too big; put it back? (naive policy: run it next tick → we just keep it out)
-            # In a real system you'd have a put-back. OK to just run current batch now.
-            # You could stash it in a local variable and re-enqueue; keeping it simple here.
-            # We'll run it next tick naturally since it remains in queue.
-            # (Because we didn't remove it; but we actually did pop() it.
-            # For minimalism, let's keep it and run this batch; then push it back.)
-            # Push-back:
-            queues.push(getattr(nxt.req, "tenant_id", "default") or "default", nxt.req)
+        n = _prompt_tokens(nxt.req)
+        if length_buckets and _length_bucket(n) != bucket:
+            skipped.append(nxt)
+            if len(skipped) >= max_skips:
+                break
+            continue
+        cost = (len(batch) + 1) * max(longest, n) + decode + _decode_tokens(nxt.req)
+        if cost > max_batch_tokens:
+            # too big for this batch: put it back at the head for a later tick
+            queues.requeue(nxt)
             break
         batch.append(nxt)
-        budget += new_cost
+        longest = max(longest, n)
+        decode += _decode_tokens(nxt.req)
 
+    for e in reversed(skipped):
+        queues.requeue(e)
     return batch
 
 
 def _rough_tokens(req: GenerateRequest) -> int:
-    # Very rough token proxy: chars/4 + max_new_tokens
-    return max(1, len(req.prompt) // 4) + max(1, req.max_tokens)
+    return _prompt_tokens(req) + _decode_tokens(req)
+
+
+def _decode_tokens(req: GenerateRequest) -> int:
+    # every sampled choice decodes on its own; the prompt is prefilled once
+    return _choices(req) * max(1, req.max_tokens)
+
+
+def _choices(req: GenerateRequest) -> int:
+    """Continuations sampled for `req` (n, or best_of when larger)."""
+    return max(1, getattr(req, "n", 1), getattr(req, "best_of", None) or 0)
+
+
+def _prompt_tokens(req: GenerateRequest) -> int:
+    # exact length once tokenized (TokenizerPool), else a chars/4 proxy
+    prompt = len(req.prompt_ids) if getattr(req, "prompt_ids", None) is not None else len(req.prompt) // 4
+    return max(1, prompt)
+
+
+def _length_bucket(tokens: int) -> int:
+    # <=16, <=32, <=64, ... tokens: rows of one bucket pad each other by less than 2x
+    return max(0, (tokens - 1).bit_length() - 4)
 
 
 def _now_ms() -> int:
-    import asyncio
     return int(asyncio.get_event_loop().time() * 1000)
@@ -1,30 +1,163 @@
 
 import asyncio
-from dataclasses import dataclass
-from typing import Any, Dict, Optional
+import itertools
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional
+
+from ..core import tracing
+from ..core.metrics import TENANT_QUEUE_DEPTH
+
+# Sentinel for "no adapter constraint" (None is a real value: the base model)
+ANY_ADAPTER = object()
+
 
 @dataclass
 class _Entry:
     fut: asyncio.Future
     req: Any
     enq_ts_ms: int
+    tenant: str = "default"
+    seq: int = 0  # global arrival order (FIFO within a tenant across adapters)
+    cost: int = 0  # tokens currently charged to the tenant by the fairness policy
+    undo: Any = None  # fairness policy state from before the pop, restored on requeue
+    sink: Optional[asyncio.Queue] = None  # streaming: text chunks, then None when finished
+    trace_ctx: Any = None  # caller's trace context: parent of the scheduler's spans for this request
+    enq_ns: int = 0        # wall clock at enqueue (span timestamps)
+    seq_ids: List[str] = field(default_factory=list)   # engine sequences once admitted, one per sampled choice
+    results: Dict[int, Any] = field(default_factory=dict)  # finished choices by index (n > 1)
+
+    @property
+    def adapter_id(self) -> Optional[str]:
+        return getattr(self.req, "adapter_id", None)
+
 
 class TenantQueues:
-    def __init__(self):
-        self._q: Dict[str, asyncio.Queue[_Entry]] = {}
+    """
+    Per-tenant FIFO queues, sub-divided by adapter.
 
-    def push(self, tenant: str, req: Any) -> asyncio.Future:
+    Two ready sets (tenants with work; tenants with work for a given adapter) make every
+    pick O(1) instead of a scan. Which ready tenant is served comes from `policy`
+    (e.g. WeightedFairPolicy); without one, the tenant just served rotates to the back.
+    Consumers block in `wait()` until a matching entry is pushed instead of polling.
+    """
+
+    def __init__(self, policy=None):
+        self.policy = policy
+        self._q: Dict[str, Dict[Optional[str], Deque[_Entry]]] = {}   # tenant -> adapter -> entries
+        self._ready: Dict[str, None] = {}                               # ordered set of tenants with work
+        self._adapter_ready: Dict[Optional[str], Dict[str, None]] = {}  # adapter -> tenants with such work
+        self._size = 0
+        self._depth: Dict[str, int] = {}
+        self.arrivals: Dict[Optional[str], int] = {}  # adapter_id -> requests ever pushed
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def push(self, tenant: str, req: Any, sink: Optional[asyncio.Queue] = None) -> asyncio.Future:
         fut: asyncio.Future = asyncio.get_event_loop().create_future()
-        q = self._q.setdefault(tenant, asyncio.Queue())
-        q.put_nowait(_Entry(fut=fut, req=req, enq_ts_ms=_now_ms()))
+        adapter_id = getattr(req, "adapter_id", None)
+        self.arrivals[adapter_id] = self.arrivals.get(adapter_id, 0) + 1
+        self._add(_Entry(fut=fut, req=req, enq_ts_ms=_now_ms(), tenant=tenant, seq=next(self._seq), sink=sink,
+                         trace_ctx=tracing.current_context(), enq_ns=tracing.now_ns()), left=False)
         return fut
 
-    async def pop_any(self) -> Optional[_Entry]:
-        # naive scan for scaffold
-        for q in self._q.values():
-            if not q.empty():
-                return await q.get()
-        return None
+    def requeue(self, entry: _Entry) -> None:
+        """Put a popped entry back at the head of its queue (same future, same timestamp)."""
+        if self.policy is not None:
+            self.policy.on_requeue(entry)
+        self._add(entry, left=True)
+
+    def done(self, entry: _Entry, tokens: int) -> None:
+        """Report that a popped entry finished (or failed) after using `tokens` tokens."""
+        if self.policy is not None:
+            self.policy.on_done(entry, tokens)
+
+    def depth(self, tenant: str) -> int:
+        return self._depth.get(tenant, 0)
+
+    def has_work(self, adapter_id=ANY_ADAPTER) -> bool:
+        tenants = self._ready if adapter_id is ANY_ADAPTER else self._adapter_ready.get(adapter_id)
+        return bool(tenants) and self._pick(tenants) is not None
+
+    def pop(self, adapter_id=ANY_ADAPTER) -> Optional[_Entry]:
+        """Oldest entry of the next ready tenant (optionally only for `adapter_id`); None if none."""
+        tenants = self._ready if adapter_id is ANY_ADAPTER else self._adapter_ready.get(adapter_id)
+        tenant = self._pick(tenants) if tenants else None
+        if tenant is None:
+            return None
+        by_adapter = self._q[tenant]
+        if adapter_id is ANY_ADAPTER:
+            adapter_id = min(by_adapter, key=lambda a: by_adapter[a][0].seq)
+        q = by_adapter[adapter_id]
+        entry = q.popleft()
+        self._size -= 1
+        self._set_depth(tenant, -1)
+
+        if not q:
+            del by_adapter[adapter_id]
+            del self._adapter_ready[adapter_id][tenant]
+            if not self._adapter_ready[adapter_id]:
+                del self._adapter_ready[adapter_id]
+        else:
+            self._adapter_ready[adapter_id][tenant] = self._adapter_ready[adapter_id].pop(tenant)
+        if not by_adapter:
+            del self._q[tenant]
+            del self._ready[tenant]
+        else:
+            self._ready[tenant] = self._ready.pop(tenant)  # served: rotate to the back
+        if self.policy is not None:
+            self.policy.on_pop(entry)
+        return entry
+
+    def queued_adapters(self) -> List[Optional[str]]:
+        """Adapters with queued work, longest-waiting first."""
+        heads: Dict[Optional[str], int] = {}
+        for by_adapter in self._q.values():
+            for a, q in by_adapter.items():
+                heads[a] = min(heads.get(a, q[0].enq_ts_ms), q[0].enq_ts_ms)
+        return sorted(heads, key=heads.get)
+
+    def oldest(self, exclude_adapter=ANY_ADAPTER) -> Optional[_Entry]:
+        """Longest-waiting queued entry, optionally ignoring one adapter's entries."""
+        heads = (q[0] for by_adapter in self._q.values() for a, q in by_adapter.items()
+                 if exclude_adapter is ANY_ADAPTER or a != exclude_adapter)
+        return min(heads, key=lambda e: e.enq_ts_ms, default=None)
+
+    async def wait(self, adapter_id=ANY_ADAPTER, timeout: Optional[float] = None) -> bool:
+        """Block until a matching entry is queued; False if `timeout` (seconds) passes first."""
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not self.has_work(adapter_id):
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def _add(self, entry: _Entry, left: bool) -> None:
+        by_adapter = self._q.setdefault(entry.tenant, {})
+        q = by_adapter.setdefault(entry.adapter_id, deque())
+        q.appendleft(entry) if left else q.append(entry)
+        self._size += 1
+        self._set_depth(entry.tenant, 1)
+        self._ready.setdefault(entry.tenant, None)
+        self._adapter_ready.setdefault(entry.adapter_id, {}).setdefault(entry.tenant, None)
+        # wake every waiter, then arm a fresh event for the next round
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+
+    def _pick(self, tenants: Dict[str, None]) -> Optional[str]:
+        return self.policy.pick(tenants) if self.policy is not None else next(iter(tenants))
+
+    def _set_depth(self, tenant: str, delta: int) -> None:
+        self._depth[tenant] = self._depth.get(tenant, 0) + delta
+        TENANT_QUEUE_DEPTH.labels(tenant=tenant).set(self._depth[tenant])
 
 
 def _now_ms() -> int:
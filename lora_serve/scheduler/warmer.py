@@ -0,0 +1,80 @@
+
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set
+
+from .queue import TenantQueues
+from ..core.adapters import LoRAAdapterManager
+from ..core.metrics import ADAPTER_PREFETCHES
+
+logger = logging.getLogger(__name__)
+
+
+class AdapterWarmer:
+    """
+    Background prefetcher: loads adapters the scheduler is about to need before their
+    batch is formed.
+
+    Every tick it looks at the adapters with queued requests (longest-waiting first)
+    and at the `top_k` adapters with the highest recent arrival rate (an EMA over the
+    queue's per-adapter arrival counts), and prefetches any that are not cached yet.
+    With nothing queued and no recent arrivals it sleeps until the next request.
+    """
+
+    def __init__(self, queues: TenantQueues, adapters: LoRAAdapterManager, interval_ms: int = 50,
+                 top_k: int = 4, ema: float = 0.8, max_inflight: int = 2):
+        self.queues = queues
+        self.adapters = adapters
+        self.interval = interval_ms / 1000
+        self.top_k = top_k
+        self.ema = ema
+        self.max_inflight = max_inflight
+        self.rates: Dict[str, float] = {}  # adapter_id -> arrivals per tick (EMA)
+        self._seen: Dict[str, int] = {}
+        self._inflight: Set[str] = set()
+
+    async def run_forever(self):
+        logger.info("AdapterWarmer started")
+        while True:
+            if not len(self.queues) and not self.rates:
+                await self.queues.wait()
+            self.tick()
+            await asyncio.sleep(self.interval)
+
+    def tick(self) -> List[str]:
+        """Update arrival rates and start prefetches; returns the adapters started."""
+        self._update_rates()
+        hot = sorted(self.rates, key=self.rates.get, reverse=True)[:self.top_k]
+        started = []
+        for adapter_id in dict.fromkeys(self.queues.queued_adapters() + hot):
+            if len(self._inflight) >= self.max_inflight:
+                break
+            if adapter_id is None or adapter_id in self._inflight or self.adapters.is_cached(adapter_id):
+                continue
+            self._inflight.add(adapter_id)
+            asyncio.get_running_loop().create_task(self._prefetch(adapter_id))
+            started.append(adapter_id)
+        return started
+
+    def _update_rates(self):
+        for adapter_id, total in self.queues.arrivals.items():
+            if adapter_id is None:
+                continue
+            new = total - self._seen.get(adapter_id, 0)
+            self._seen[adapter_id] = total
+            rate = self.ema * self.rates.get(adapter_id, 0.0) + (1 - self.ema) * new
+            if rate < 1e-3:
+                self.rates.pop(adapter_id, None)  # gone cold
+            else:
+                self.rates[adapter_id] = rate
+
+    async def _prefetch(self, adapter_id: Optional[str]):
+        try:
+            await self.adapters.prefetch(adapter_id)
+            ADAPTER_PREFETCHES.labels(source="warmer").inc()
+        except FileNotFoundError:
+            logger.debug("Not prefetching unknown adapter '%s'", adapter_id)
+        except Exception:
+            logger.exception("Prefetch of adapter '%s' failed", adapter_id)
+        finally:
+            self._inflight.discard(adapter_id)
@@ -1 +1,215 @@
-# TODO: on-disk LRU for adapters
+# Response cache for deterministic generations
+import asyncio
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from ..core.metrics import RESPONSE_CACHE_BYTES, RESPONSE_CACHE_EVICTIONS, RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES
+from ..core.types import GenerateRequest, GenerateResult
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Cached:
+    result: GenerateResult
+    nbytes: int
+    expires: float  # time.time() deadline; 0 = never
+
+
+class ResponseCache:
+    """
+    Finished generations of deterministic requests (greedy, or sampled with a fixed
+    seed), keyed by base model, adapter id + content hash, prompt and decoding params.
+
+    Memory tier: LRU within `budget_mb`. Disk tier (optional, `disk_dir`): one JSON file
+    per entry, LRU by access time within `disk_budget_mb`; entries evicted from memory
+    stay there. Entries expire after `ttl_s` (0 = never). Concurrent identical requests
+    share a single generation.
+    """
+
+    def __init__(self, model_id: str, budget_mb: int = 64, ttl_s: float = 3600,
+                 disk_dir: Optional[str] = None, disk_budget_mb: int = 1024):
+        self.model_id = model_id
+        self.budget = budget_mb * 2**20
+        self.ttl = ttl_s
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_budget = disk_budget_mb * 2**20
+        self._mem: OrderedDict[str, _Cached] = OrderedDict()
+        self._mem_bytes = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()  # key -> file size, least recently used first
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._writes: Set[asyncio.Task] = set()
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            for f in sorted(self.disk_dir.glob("*.json"), key=lambda f: f.stat().st_mtime):
+                self._disk[f.stem] = f.stat().st_size
+            self._publish()
+
+    @staticmethod
+    def cacheable(req: GenerateRequest) -> bool:
+        if req.n > 1 or (req.best_of or 0) > 1:
+            return False  # entries hold a single continuation
+        return not req.temperature or req.temperature <= 0 or req.seed is not None
+
+    def key(self, req: GenerateRequest, adapter_hash: str = "") -> str:
+        greedy = not req.temperature or req.temperature <= 0
+        params = {
+            "model": self.model_id,
+            "adapter": [req.adapter_id, adapter_hash],
+            "prompt": req.prompt,
+            "max_tokens": req.max_tokens,
+            "repetition_penalty": req.repetition_penalty,
+            "stop": req.stop,
+            # sampling knobs only matter when sampling
+            "sampling": None if greedy else [req.temperature, req.top_p, req.top_k, req.seed],
+        }
+        if req.prompt_ids is not None:
+            # pre-tokenized prompts (chat templates) are what the engine runs, not `prompt`
+            params["prompt_ids"] = req.prompt_ids
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    async def get_or_generate(self, key: str, generate: Callable[[], Awaitable[GenerateResult]]) -> GenerateResult:
+        """Cached result for `key`, else the result of `generate()` (shared by concurrent callers)."""
+        hit = self._get_mem(key)
+        if hit is None and key in self._disk:
+            hit = await self._get_disk(key)
+        if hit is not None:
+            return dataclasses.replace(hit)
+        pending = self._inflight.get(key)
+        if pending is not None:
+            RESPONSE_CACHE_HITS.labels(tier="inflight").inc()
+            try:
+                return dataclasses.replace(await asyncio.shield(pending))
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise  # this caller was cancelled
+                return await self.get_or_generate(key, generate)  # the generating caller was; take over
+
+        RESPONSE_CACHE_MISSES.inc()
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            result = await generate()
+            fut.set_result(result)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as ex:
+            fut.set_exception(ex)
+            fut.exception()  # retrieved here; waiters get it re-raised
+            raise
+        finally:
+            del self._inflight[key]
+        self._put_mem(key, result)
+        if self.disk_dir is not None:
+            task = asyncio.get_running_loop().create_task(self._put_disk(key, result))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+        return dataclasses.replace(result)
+
+    def stats(self):
+        return {"memory_entries": len(self._mem), "memory_bytes": self._mem_bytes,
+                "disk_entries": len(self._disk), "disk_bytes": sum(self._disk.values()),
+                "inflight": len(self._inflight)}
+
+    def _expiry(self) -> float:
+        return time.time() + self.ttl if self.ttl > 0 else 0
+
+    def _get_mem(self, key: str) -> Optional[GenerateResult]:
+        entry = self._mem.get(key)
+        if entry is None:
+            return None
+        if entry.expires and entry.expires < time.time():
+            self._drop_mem(key)
+            return None
+        self._mem.move_to_end(key)
+        RESPONSE_CACHE_HITS.labels(tier="memory").inc()
+        return entry.result
+
+    def _put_mem(self, key: str, result: GenerateResult, expires: Optional[float] = None) -> None:
+        nbytes = len(result.text.encode()) + 64
+        if nbytes > self.budget:
+            return
+        if key in self._mem:
+            self._drop_mem(key)
+        self._mem[key] = _Cached(result, nbytes, self._expiry() if expires is None else expires)
+        self._mem_bytes += nbytes
+        while self._mem_bytes > self.budget:
+            self._drop_mem(next(iter(self._mem)))
+            RESPONSE_CACHE_EVICTIONS.labels(tier="memory").inc()
+        self._publish()
+
+    def _drop_mem(self, key: str) -> None:
+        self._mem_bytes -= self._mem.pop(key).nbytes
+        self._publish()
+
+    # disk tier: file I/O runs in threads, the index is only touched on the event loop
+
+    async def _get_disk(self, key: str) -> Optional[GenerateResult]:
+        data = await asyncio.to_thread(_load, self.disk_dir / f"{key}.json")
+        if data is None or (data["expires"] and data["expires"] < time.time()):
+            self._forget_disk(key)
+            return None
+        if key in self._disk:
+            self._disk.move_to_end(key)
+        RESPONSE_CACHE_HITS.labels(tier="disk").inc()
+        result = GenerateResult(text=data["text"], tokens=data["tokens"], prompt_tokens=data["prompt_tokens"],
+                                finish_reason=data.get("finish_reason"), logprob=data.get("logprob"))
+        self._put_mem(key, result, data["expires"])
+        return result
+
+    async def _put_disk(self, key: str, result: GenerateResult) -> None:
+        data = json.dumps({**dataclasses.asdict(result), "expires": self._expiry()})
+        if not await asyncio.to_thread(_store, self.disk_dir / f"{key}.json", data):
+            return
+        self._disk[key] = len(data)
+        self._disk.move_to_end(key)
+        while sum(self._disk.values()) > self.disk_budget and len(self._disk) > 1:
+            self._forget_disk(next(iter(self._disk)))
+            RESPONSE_CACHE_EVICTIONS.labels(tier="disk").inc()
+        self._publish()
+
+    def _forget_disk(self, key: str) -> None:
+        self._disk.pop(key, None)
+        asyncio.get_running_loop().run_in_executor(None, _unlink, self.disk_dir / f"{key}.json")
+        self._publish()
+
+    def _publish(self):
+        RESPONSE_CACHE_BYTES.labels(tier="memory").set(self._mem_bytes)
+        RESPONSE_CACHE_BYTES.labels(tier="disk").set(sum(self._disk.values()))
+
+
+def _load(path: Path) -> Optional[dict]:
+    try:
+        data = json.loads(path.read_text())
+        os.utime(path)  # access order survives restarts
+        return data
+    except (OSError, ValueError):
+        return None
+
+
+def _store(path: Path, data: str) -> bool:
+    tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+    try:
+        tmp.write_text(data)
+        os.replace(tmp, path)
+        return True
+    except OSError:
+        logger.exception("Could not write response cache entry %s", path)
+        return False
+
+
+def _unlink(path: Path) -> None:
+    try:
+        path.unlink()
+    except OSError:
+        pass
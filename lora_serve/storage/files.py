@@ -1 +1,21 @@
-# TODO: async file ops for adapter blobs
+# File helpers for adapter directories (blocking; call from a worker thread for large trees)
+import hashlib
+from pathlib import Path
+from typing import Tuple
+
+
+def dir_stamp(path: Path) -> Tuple:
+    """Cheap change detector: (name, size, mtime) of every file under `path`."""
+    return tuple(sorted((str(f.relative_to(path)), f.stat().st_size, f.stat().st_mtime_ns)
+                        for f in Path(path).rglob("*") if f.is_file()))
+
+
+def dir_digest(path: Path, chunk_size: int = 1 << 20) -> str:
+    """sha256 over the relative names and contents of every file under `path`."""
+    h = hashlib.sha256()
+    for f in sorted(p for p in Path(path).rglob("*") if p.is_file()):
+        h.update(str(f.relative_to(path)).encode() + b"\0")
+        with open(f, "rb") as fh:
+            while block := fh.read(chunk_size):
+                h.update(block)
+    return h.hexdigest()
@@ -1,4 +1,5 @@
-
 #!/usr/bin/env bash
+# load benchmark against a running server (see tools/bench_load.py for workload options)
 set -euo pipefail
-python examples/client_generate.py --prompt "Hello" || true
+python tools/bench_load.py --url "${URL:-http://localhost:8000}" --num_requests "${N:-100}" --rate "${RATE:-5}" \
+  --out "${OUT:-bench_results.json}" "$@"
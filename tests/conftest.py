@@ -1,11 +1,12 @@
+import os
 import pytest
 import asyncio
 from lora_serve.core.engines.hf_engine import HFEngine
 
 @pytest.fixture(scope="session")
 def hf_engine():
-    """Load the model once per test session."""
-    engine = HFEngine("TinyLlama/TinyLlama-1.1B-Chat-v1.0", dtype="bfloat16")
+    """Load the model once per test session (LORASERVE_TEST_MODEL: a local checkpoint instead)."""
+    engine = HFEngine(os.getenv("LORASERVE_TEST_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0"), dtype="bfloat16")
     return engine
 
 @pytest.fixture(scope="session")
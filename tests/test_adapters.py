@@ -0,0 +1,89 @@
+import asyncio
+import json
+import torch
+from safetensors.torch import save_file
+from lora_serve.core.adapters import LoRAAdapterManager
+from lora_serve.core.types import GenerateRequest
+from lora_serve.scheduler.queue import TenantQueues
+from lora_serve.scheduler.warmer import AdapterWarmer
+
+
+class _RecordingEngine:
+    supports_mixed_adapters = True
+
+    def __init__(self):
+        self.attached, self.detached = [], []
+
+    async def attach_adapter(self, adapter_id, path, parsed=None):
+        assert parsed is not None  # weights come pre-parsed from the host tier
+        self.attached.append(adapter_id)
+
+    async def detach_adapter(self, adapter_id):
+        self.detached.append(adapter_id)
+
+
+def _write_adapter(path, r=4):
+    path.mkdir()
+    (path / "adapter_config.json").write_text(json.dumps({"peft_type": "LORA", "r": r, "lora_alpha": r}))
+    save_file({"base_model.model.proj.lora_A.weight": torch.zeros(r, 256),
+               "base_model.model.proj.lora_B.weight": torch.zeros(256, r)}, str(path / "adapter_model.safetensors"))
+
+
+def test_active_tier_evicts_lru_unpinned_and_detaches(tmp_path):
+    for name in ("a", "b", "c"):
+        _write_adapter(tmp_path / name)   # 8 KiB each
+
+    async def main():
+        engine = _RecordingEngine()
+        store = LoRAAdapterManager(tmp_path, engine=engine, active_budget_mb=0, mmap_weights=True)
+        store.active_budget = 20 * 1024   # room for two adapters
+        await asyncio.gather(store.ensure_active("a"), store.ensure_active("a"))
+        assert engine.attached == ["a"]   # concurrent requests share one load
+        store.acquire("a")
+        await store.ensure_active("b")
+        await store.ensure_active("c")
+        assert engine.detached == ["b"]   # "a" is older but pinned by a running sequence
+        store.release("a")
+        await store.ensure_active("b")
+        assert engine.detached == ["b", "a"] and list(store.active) == ["c", "b"]
+    asyncio.run(main())
+
+
+def test_engines_that_read_adapters_themselves_get_no_parsed_copy(tmp_path, monkeypatch):
+    _write_adapter(tmp_path / "a")
+
+    class _PathOnlyEngine(_RecordingEngine):
+        accepts_parsed_adapters = False
+
+        async def attach_adapter(self, adapter_id, path, parsed=None):
+            assert parsed is None
+            self.attached.append(adapter_id)
+
+    def no_parse(*args):
+        raise AssertionError("host tier parsed the adapter")
+    monkeypatch.setattr("lora_serve.core.adapters.load_lora_weights", no_parse)
+
+    async def main():
+        engine = _PathOnlyEngine()
+        store = LoRAAdapterManager(tmp_path, engine=engine)
+        assert await store.ensure_active("a") == tmp_path / "a"
+        assert engine.attached == ["a"] and not store.host["a"].weights
+        assert store.host["a"].nbytes >= 8 * 1024   # sized from the files on disk
+    asyncio.run(main())
+
+
+def test_warmer_prefetches_queued_and_busy_adapters(tmp_path):
+    for name in ("queued", "busy", "cold"):
+        _write_adapter(tmp_path / name)
+
+    async def main():
+        queues, store = TenantQueues(), LoRAAdapterManager(tmp_path)
+        warmer = AdapterWarmer(queues, store, top_k=1, max_inflight=4)
+        for _ in range(5):  # recent traffic, already scheduled
+            queues.push("t", GenerateRequest(prompt="", adapter_id="busy"))
+            queues.pop()
+        queues.push("t", GenerateRequest(prompt="", adapter_id="queued"))
+        assert warmer.tick() == ["queued", "busy"]
+        await asyncio.sleep(0.1)
+        assert sorted(store.host) == ["busy", "queued"] and warmer.tick() == []
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+import asyncio
+import importlib.util
+import json
+import random
+from pathlib import Path
+
+import httpx
+import pytest
+
+_spec = importlib.util.spec_from_file_location("bench_load", Path(__file__).parents[1] / "tools" / "bench_load.py")
+bench = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(bench)
+
+
+def test_synthetic_lengths_mixes_and_arrivals():
+    rng = random.Random(0)
+    assert bench.sample_length("fixed:12", rng) == 12
+    assert all(5 <= bench.sample_length("uniform:5,9", rng) <= 9 for _ in range(100))
+    assert bench.sample_length("lognormal:0.01,0.1", rng) == 1   # never below one token
+    with pytest.raises(ValueError):
+        bench.sample_length("zipf:2", rng)
+    assert bench.parse_mix(None) == {None: 1.0}
+    assert bench.parse_mix("code=0.3,-=0.7") == {"code": 0.3, None: 0.7}
+
+    assert bench.arrivals(3, float("inf"), 1.0, rng) == [0.0] * 3
+    times = bench.arrivals(4000, 50.0, 1.0, rng)
+    assert times == sorted(times) and 70 < times[-1] < 90    # ~4000 / 50 s
+    def gap_variance(burstiness):
+        times = bench.arrivals(4000, 50.0, burstiness, random.Random(1))
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        return sum((g - sum(gaps) / len(gaps)) ** 2 for g in gaps) / len(gaps)
+    assert gap_variance(0.2) > 10 * gap_variance(10.0)   # same rate, burstier gaps
+
+
+def test_replayed_workload_keeps_its_arrival_times(tmp_path):
+    trace = tmp_path / "trace.jsonl"
+    trace.write_text("\n".join(json.dumps(line) for line in (
+        {"prompt": "late", "max_tokens": 2, "t": 5.0},
+        {"prompt": "early", "max_tokens": 2, "t": 1.0},
+        {"prompt": "untimed", "max_tokens": 2},
+        {"prompt": "cut off", "max_tokens": 2},
+    )) + "\n\n")
+    args = bench.parse_args(["--sim", "--workload", str(trace), "--num_requests", "3", "--rate", "inf"])
+    items = bench.load_workload(args, random.Random(0))
+    assert [(i["prompt"], i["t"]) for i in items] == [("untimed", 0.0), ("early", 1.0), ("late", 5.0)]
+
+
+def test_summary_percentiles_and_goodput():
+    def rec(ttft, e2e, tokens, error=None):
+        return bench.Record(0, None, None, 4, tokens, ttft_ms=ttft, e2e_ms=e2e, tokens=tokens, error=error)
+    records = [rec(100, 1000, 10), rec(500, 600, 2), rec(50, 50, 1), rec(None, None, 0, error="boom")]
+    assert records[0].tpot_ms == 100 and records[1].tpot_ms == 100 and records[2].tpot_ms is None
+
+    args = bench.parse_args(["--sim", "--slo_ttft_ms", "200", "--slo_tpot_ms", "150"])
+    s = bench.summarize(records, duration=2.0, args=args)
+    assert s["requests"] == 4 and s["errors"] == 1 and s["output_tokens_per_s"] == 13 / 2
+    assert s["goodput"] == 1.0 and s["slo_attainment"] == 0.5   # the 500 ms TTFT misses the SLO
+    assert s["ttft_ms"]["p50"] == 100 and s["ttft_ms"]["p99"] == 500 and s["ttft_ms"]["mean"] == 650 / 3
+    assert bench.percentiles([]) == {}
+
+
+def test_in_process_run_on_sim_engine(tmp_path):
+    saved = tmp_path / "workload.jsonl"
+    argv = ["--sim", "--time_scale", "0", "--num_requests", "40", "--rate", "inf", "--prompt_len", "uniform:4,40",
+            "--output_len", "uniform:2,6", "--tenants", "a=1,b=1", "--save_workload", str(saved)]
+    result = asyncio.run(bench.run(bench.parse_args(argv)))
+
+    s, reqs = result["summary"], result["requests"]
+    assert s["requests"] == 40 and s["errors"] == 0 and s["slo_attainment"] == 1.0
+    assert all(r["tokens"] == r["max_tokens"] and 0 <= r["ttft_ms"] <= r["e2e_ms"] for r in reqs)
+    assert {r["tenant_id"] for r in reqs} == {"a", "b"}
+    json.dumps(result, default=str)   # --out
+
+    # the saved workload replays the same requests
+    replay = bench.parse_args(["--sim", "--workload", str(saved), "--rate", "inf"])
+    items = bench.load_workload(replay, random.Random(1))
+    assert [(len(i["prompt"]), i["max_tokens"]) for i in items] == [(r["prompt_chars"], r["max_tokens"]) for r in reqs]
+
+
+def test_http_target_counts_data_events_and_surfaces_errors():
+    def handler(request):
+        body = json.loads(request.content)
+        events = "event: start\ndata: \n\n" + "".join(f"data: tok{i}\n\n" for i in range(body["max_tokens"]))
+        if body["prompt"] == "fail":
+            events += "event: error\ndata: request timed out\n\n"
+        return httpx.Response(200, text=events + "event: end\ndata: [DONE]\n\n")
+
+    async def main():
+        target = bench.HTTPTarget("http://bench/", timeout=5)
+        await target.client.aclose()
+        target.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        rec = bench.Record(0, None, None, 2, 3)
+        await target.send({"prompt": "ok", "max_tokens": 3}, rec, 0.0)
+        assert rec.tokens == 3 and len(rec.chunk_ms) == 3      # start/end events are not tokens
+        with pytest.raises(RuntimeError, match="timed out"):
+            await target.send({"prompt": "fail", "max_tokens": 1}, bench.Record(0, None, None, 4, 1), 0.0)
+        assert target.url == "http://bench/v1/generate/stream"
+        await target.close()
+    asyncio.run(main())
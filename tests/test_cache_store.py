@@ -0,0 +1,50 @@
+import asyncio
+from lora_serve.core.types import GenerateRequest, GenerateResult
+from lora_serve.storage.cache_store import ResponseCache
+
+
+def test_concurrent_identical_requests_share_one_generation():
+    async def main():
+        cache = ResponseCache("m")
+        calls = []
+
+        async def generate():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return GenerateResult(text="out", tokens=1)
+
+        req = GenerateRequest(prompt="p", temperature=0)
+        key = cache.key(req)
+        results = await asyncio.gather(*[cache.get_or_generate(key, generate) for _ in range(3)])
+        assert [r.text for r in results] == ["out"] * 3 and len(calls) == 1
+        await cache.get_or_generate(key, generate)
+        assert len(calls) == 1
+        # sampling knobs are irrelevant for greedy requests, but the adapter content is not
+        assert cache.key(GenerateRequest(prompt="p", temperature=0, top_p=0.5)) == key
+        assert cache.key(req, adapter_hash="abc") != key
+        templated = lambda ids: GenerateRequest(prompt="p", temperature=0, prompt_ids=ids)
+        assert cache.key(templated([1, 2])) != cache.key(templated([2, 2])) and cache.key(templated([1, 2])) != key
+        assert not cache.cacheable(GenerateRequest(prompt="p", temperature=0.7))
+    asyncio.run(main())
+
+
+def test_ttl_and_disk_tier(tmp_path):
+    async def main():
+        async def generate():
+            return GenerateResult(text="x" * 100, tokens=5, prompt_tokens=3, finish_reason="stop")
+
+        cache = ResponseCache("m", ttl_s=0, disk_dir=str(tmp_path))
+        await cache.get_or_generate("k", generate)
+        await asyncio.gather(*cache._writes)
+
+        reopened = ResponseCache("m", disk_dir=str(tmp_path))
+        assert reopened.stats()["disk_entries"] == 1
+        async def fail():
+            raise AssertionError("should be served from disk")
+        assert await reopened.get_or_generate("k", fail) == await generate()   # every field survives the disk
+
+        expiring = ResponseCache("m", ttl_s=1e-6)
+        await expiring.get_or_generate("k", generate)
+        await asyncio.sleep(0.01)
+        assert expiring._get_mem("k") is None
+    asyncio.run(main())
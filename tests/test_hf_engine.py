@@ -1,4 +1,5 @@
 import asyncio
+import threading
 from lora_serve.core.types import GenerateRequest
 
 def test_generate_batch_smoke(hf_engine):
@@ -15,3 +16,157 @@ def test_multiple_prompts(hf_engine):
     res = asyncio.run(hf_engine.generate_batch(reqs))
     assert len(res) == 2
     assert all(len(r.text.strip()) > 0 for r in res)
+
+def test_step_loop_join_and_leave(hf_engine):
+    async def run():
+        hf_engine.add_sequence("long", GenerateRequest(prompt="Tell me a story.", max_tokens=6, temperature=0))
+        finished = []
+        for step in range(10):
+            if step == 1:
+                # joins while "long" is already decoding, and leaves before it
+                hf_engine.add_sequence("short", GenerateRequest(prompt="Hi", max_tokens=1, temperature=0))
+            for out in await hf_engine.step():
+                if out.finished:
+                    finished.append(out.seq_id)
+            if not hf_engine.has_unfinished():
+                break
+        return finished
+
+    finished = asyncio.run(run())
+    assert finished[0] == "short" or len(finished) == 2
+    assert set(finished) == {"short", "long"}
+
+def test_decode_extends_its_own_cache_instead_of_regathering(hf_engine, monkeypatch):
+    def reqs():
+        return [GenerateRequest(prompt=p, max_tokens=m, temperature=0)
+                for p, m in (("Tell me a story.", 12), ("Hi", 3), ("List two colors.", 7))]
+
+    # reference: every step gathers the batch from the paged store
+    monkeypatch.setattr(hf_engine, "_dense_past", lambda seqs, width: None)
+    gathered = [r.text for r in asyncio.run(hf_engine.generate_batch(reqs()))]
+    monkeypatch.undo()
+
+    calls = []
+    gather = hf_engine.kv.gather
+    monkeypatch.setattr(hf_engine.kv, "gather", lambda *args: calls.append(args) or gather(*args))
+    res = asyncio.run(hf_engine.generate_batch(reqs()))
+    assert [r.text for r in res] == gathered   # rows leaving early are dropped from the kept cache
+    assert len(calls) <= 2                     # prefix-cache hit on the prefill, first decode step
+
+def test_stop_string_completed_by_the_last_allowed_token(hf_engine):
+    def run(max_tokens, stop=None):
+        req = GenerateRequest(prompt="Tell me a story.", max_tokens=max_tokens, temperature=0, stop=stop)
+        return asyncio.run(hf_engine.generate_batch([req]))[0]
+
+    full, shorter = run(6), run(5)
+    assert full.finish_reason == "length" and full.text.startswith(shorter.text) and len(full.text) > len(shorter.text)
+    res = run(6, stop=[full.text])   # first complete once the 6th token is in
+    assert res.text == "" and res.tokens == 6 and res.finish_reason == "stop"
+
+def _drive(engine, reqs, on_step=None):
+    """Step `reqs` (added up front) to completion; per-sequence output chunks in arrival order."""
+    async def run():
+        for seq_id, req in reqs.items():
+            engine.add_sequence(seq_id, req)
+        chunks = {seq_id: [] for seq_id in reqs}
+        steps = 0
+        while engine.has_unfinished():
+            for out in await engine.step():
+                chunks[out.seq_id].append(out)
+            steps += 1
+            if on_step is not None:
+                on_step(steps)
+        await engine._on_worker(lambda: None)   # whatever step() left queued on the worker
+        return chunks
+    return asyncio.run(run())
+
+def test_pipelined_steps_match_the_sequential_path(hf_engine, monkeypatch):
+    def reqs(tag):
+        return {f"{tag}-{i}": GenerateRequest(prompt=p, max_tokens=m, temperature=0, stream=True)
+                for i, (p, m) in enumerate((("Tell me a story.", 9), ("Hi", 2), ("List two colors.", 5)))}
+
+    in_flight = []
+    pipelined = _drive(hf_engine, reqs("pipe"), lambda _: in_flight.append(hf_engine._next_step is not None))
+    assert in_flight[0] and hf_engine._next_step is None   # N+1 started before N returned
+
+    async def sequential_step():
+        return hf_engine._detokenize(await hf_engine._on_worker(hf_engine._step))
+    monkeypatch.setattr(hf_engine, "step", sequential_step)
+    sequential = _drive(hf_engine, reqs("seq"))
+
+    for (_, got), (_, want) in zip(pipelined.items(), sequential.items()):
+        assert [o.token_ids for o in got] == [o.token_ids for o in want]   # same tokens, same order
+        assert [o.finished for o in got] == [False] * (len(got) - 1) + [True]
+        assert "".join(o.text for o in got) == got[-1].result.text == want[-1].result.text
+
+def _abort_once_in_flight(engine, monkeypatch, seq_id):
+    """on_step callback: after the first step, abort `seq_id` once the next step has drained its inbox."""
+    drained, drain = threading.Event(), engine._drain_inbox
+    monkeypatch.setattr(engine, "_drain_inbox", lambda: (drain(), drained.set()))
+
+    def on_step(steps):
+        if steps == 1:
+            assert engine._next_step is not None   # step 2 is already running on the worker
+            drained.clear()
+            assert drained.wait(10)
+            engine.abort_sequence(seq_id)
+    return on_step
+
+def test_abort_while_a_step_is_in_flight(hf_engine, monkeypatch):
+    reqs = {"abort-a": GenerateRequest(prompt="Tell me a story.", max_tokens=20, temperature=0),
+            "abort-b": GenerateRequest(prompt="List two colors.", max_tokens=6, temperature=0)}
+    chunks = _drive(hf_engine, reqs, _abort_once_in_flight(hf_engine, monkeypatch, "abort-a"))
+
+    assert len(chunks["abort-a"]) == 1                 # its row of the in-flight step is dropped
+    assert chunks["abort-b"][-1].finished and chunks["abort-b"][-1].result.tokens == len(chunks["abort-b"])
+    assert "abort-a" not in hf_engine._running and "abort-a" not in hf_engine.kv.alloc.tables
+    assert not hf_engine._live and hf_engine._next_step is None
+
+def test_abort_of_the_last_sequence_while_its_step_is_in_flight(hf_engine, monkeypatch):
+    reqs = {"abort-last": GenerateRequest(prompt="Tell me a story.", max_tokens=20, temperature=0)}
+    chunks = _drive(hf_engine, reqs, _abort_once_in_flight(hf_engine, monkeypatch, "abort-last"))
+    assert len(chunks["abort-last"]) == 1
+    # no further step runs, but its row and K/V are still released
+    assert not hf_engine._running and "abort-last" not in hf_engine.kv.alloc.tables
+
+def test_fork_added_after_its_parent_was_prefilled(hf_engine):
+    req = GenerateRequest(prompt="Tell me a story.", max_tokens=4, temperature=0, n=2)
+
+    async def run():
+        hf_engine.add_sequence("fork-p", req)
+        results = {o.seq_id: o.result for o in await hf_engine.step() if o.finished}   # drains the parent alone
+        hf_engine.add_sequence("fork-f", req, fork_of="fork-p")
+        for _ in range(20):
+            if not hf_engine.has_unfinished():
+                break
+            results.update({o.seq_id: o.result for o in await hf_engine.step() if o.finished})
+        return results
+
+    results = asyncio.run(run())
+    assert set(results) == {"fork-p", "fork-f"} and not hf_engine._forks
+    assert results["fork-f"].text == results["fork-p"].text   # greedy: same continuation from its own prefill
+
+def test_decode_into_a_shared_block_preempts_instead_of_failing(hf_engine):
+    req = GenerateRequest(prompt="Tell me a story.", max_tokens=4, temperature=0, n=2)
+    reference = asyncio.run(hf_engine.generate_batch([GenerateRequest(prompt="Tell me a story.", max_tokens=4,
+                                                                      temperature=0)]))[0].text
+
+    async def run():
+        async def step():   # unpipelined, so nothing runs on the worker between the steps below
+            return hf_engine._detokenize(await hf_engine._on_worker(hf_engine._step))
+        hf_engine.add_sequence("cow-p", req)
+        hf_engine.add_sequence("cow-f", req, fork_of="cow-p")
+        outputs = await step()                          # prefill; the fork shares the prompt's tail block
+        alloc = hf_engine.kv.alloc
+        assert alloc.shared_in("cow-f", hf_engine._running["cow-f"].num_cached, alloc.capacity) == 1
+        hf_engine.prefix.evict(alloc.capacity, reclaim=True)
+        hf_engine.kv.allocate("cow-hog", alloc.free_blocks() * alloc.block_tokens)   # no block left to copy into
+        outputs += await step()
+        hf_engine.kv.free("cow-hog")
+        while hf_engine.has_unfinished():
+            outputs += await step()
+        return outputs
+
+    outputs = asyncio.run(run())
+    assert not [o.error for o in outputs if o.error]
+    assert {o.seq_id: o.result.text for o in outputs if o.finished} == {"cow-p": reference, "cow-f": reference}
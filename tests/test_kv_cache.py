@@ -0,0 +1,79 @@
+import torch
+from lora_serve.kv_cache.allocator import BlockAllocator
+from lora_serve.kv_cache.manager import KVCacheManager
+
+
+def test_allocator_free_list_and_refcounts():
+    alloc = BlockAllocator(block_tokens=4, capacity_blocks=4)
+    assert alloc.reserve("a", 5) == [0, 1]
+    assert alloc.reserve("b", 8) == [2, 3]
+    assert alloc.reserve("c", 1) is None          # out of blocks, nothing taken
+    assert alloc.free_blocks() == 0
+    assert abs(alloc.fragmentation() - 3 / 16) < 1e-9
+
+    alloc.fork("a", "a2")
+    assert alloc.shared_blocks() == 2
+    alloc.release("a")
+    assert alloc.free_blocks() == 0               # still referenced by a2
+    alloc.release("a2")
+    assert alloc.free_blocks() == 2
+    assert alloc.reserve("c", 1) == [0]           # lowest free id first
+
+
+def test_manager_write_gather_and_copy_on_write():
+    kv = KVCacheManager(block_size_tokens=2, capacity_blocks=8)
+    layers = [(torch.arange(6.).view(1, 3, 2), -torch.arange(6.).view(1, 3, 2))]  # 1 head, 3 tokens
+    kv.allocate("a", 3)
+    kv.write("a", 0, layers)
+
+    (k, v), = kv.gather(["a"], [3], width=4)
+    assert torch.equal(k[0, :, 1:], layers[0][0]) and torch.equal(v[0, :, 1:], layers[0][1])
+    assert torch.equal(k[0, :, :1], torch.zeros(1, 1, 2))   # left padding
+
+    kv.fork("a", "b")
+    kv.allocate("b", 4)
+    new = [(torch.full((1, 1, 2), 9.), torch.full((1, 1, 2), 9.))]
+    kv.write("b", 3, new)                         # last block is shared -> copied first
+    (ka, _), (kb, _) = [kv.gather([r], [4], 4)[0] for r in ("a", "b")]
+    assert torch.equal(ka[0, :, :3], layers[0][0]) and torch.equal(kb[0, :, 3], new[0][0][:, 0])
+    assert kv.alloc.tables["a"][0] == kv.alloc.tables["b"][0]     # first block still shared
+    assert kv.alloc.tables["a"][1] != kv.alloc.tables["b"][1]
+
+
+def test_unshare_copies_ahead_of_a_write_or_takes_nothing():
+    kv = KVCacheManager(block_size_tokens=2, capacity_blocks=3)
+    kv.allocate("a", 3)
+    kv.write("a", 0, [(torch.arange(6.).view(1, 3, 2), torch.zeros(1, 3, 2))])
+    kv.fork("a", "b")
+    assert kv.alloc.shared_in("b", 3, 4) == 1 and kv.alloc.shared_in("b", 4, 5) == 0
+    kv.allocate("hog", 2)                         # the last free block
+    assert not kv.unshare("b", 3, 4) and kv.alloc.tables["b"] == kv.alloc.tables["a"]
+    kv.free("hog")
+    assert kv.unshare("b", 3, 4)
+    assert kv.alloc.tables["b"][1] != kv.alloc.tables["a"][1] and kv.alloc.free_blocks() == 0
+    kv.write("b", 3, [(torch.ones(1, 1, 2), torch.ones(1, 1, 2))])   # no copy left to make
+
+
+def test_prefix_cache_per_adapter_lookup_and_lru_eviction():
+    from lora_serve.kv_cache.prefix_cache import PrefixCache
+
+    alloc = BlockAllocator(block_tokens=2, capacity_blocks=8)
+    cache = PrefixCache(alloc, max_blocks=3)
+    prompt = [1, 2, 3, 4, 5]
+    table = alloc.reserve("a", len(prompt))
+    cache.insert("lora-x", prompt, table)         # caches the two full blocks
+    alloc.release("a")
+    assert alloc.used_blocks() == 2               # kept alive by the cache
+
+    assert cache.lookup("lora-x", [1, 2, 3, 4, 9]) == (table[:2], 4)
+    assert cache.lookup("lora-x", [1, 2, 3, 4]) == (table[:1], 2)   # last token is never cached
+    assert cache.lookup("lora-y", prompt) == ([], 0)                # scoped per adapter
+
+    other = alloc.reserve("b", 4)
+    cache.insert(None, [7, 7, 8, 8], other)       # 4 blocks > budget -> LRU leaf goes
+    assert cache.num_blocks() == 3
+    assert cache.lookup("lora-x", prompt) == (table[:1], 2)
+
+    alloc.release("b")
+    assert cache.evict(10, reclaim=True) == 3
+    assert alloc.used_blocks() == 0
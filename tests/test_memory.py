@@ -0,0 +1,40 @@
+from lora_serve.core.engines.memory import MemoryModel, is_out_of_memory
+
+
+def test_calibration_fits_per_token_term_as_upper_bound():
+    model = MemoryModel(weight_bytes=0, kv_bytes_per_token=64, act_bytes_per_token=100,
+                        score_bytes=8, logit_bytes=1000)
+    true_per_token = {(1, 16, 0, 1): 500, (4, 64, 0, 1): 700}
+    measure = lambda s: s[0] * s[1] * true_per_token[s] + s[0] * s[1] * (s[1] + s[2]) * 8 + s[0] * s[3] * 1000
+    model.calibrate(measure, list(true_per_token))
+    assert model.calibrated and model.act_bytes_per_token == 700
+    for shape in true_per_token:
+        assert model.activation_bytes(*shape) >= measure(shape)
+
+
+def test_calibration_fits_gathered_kv_copies_from_decode_probes():
+    model = MemoryModel(weight_bytes=0, kv_bytes_per_token=64, act_bytes_per_token=100,
+                        score_bytes=8, logit_bytes=1000)
+    copies = {(1, 16, 0, 1): 0, (2, 1, 256, 1): 2.5, (8, 1, 1024, 1): 3}
+    measure = lambda s: (s[0] * s[1] * 500 + s[0] * s[1] * (s[1] + s[2]) * 8 + s[0] * s[3] * 1000
+                         + s[0] * s[2] * copies[s] * 64)
+    model.calibrate(measure, list(copies)[::-1])  # decode probes first: still fitted after the per-token term
+    assert model.act_bytes_per_token == 500 and model.kv_copies == 3
+    for shape in copies:
+        assert model.activation_bytes(*shape) >= measure(shape)
+    # the gathered context dominates a decode step
+    assert model.activation_bytes(8, 1, 2048) - model.activation_bytes(8, 1, 1024) >= 8 * 1024 * 3 * 64
+
+
+def test_kept_decode_cache_is_padded_to_the_longest_row():
+    model = MemoryModel(weight_bytes=0, kv_bytes_per_token=64, act_bytes_per_token=100,
+                        score_bytes=8, logit_bytes=1000)
+    # four rows, one of them 1000 tokens long: every row pays for 1000 positions
+    assert model.dense_cache_bytes(4, 1000) == 4 * 1000 * 64
+    assert model.dense_cache_bytes(0, 1000) == 0
+
+
+def test_out_of_memory_detection():
+    assert is_out_of_memory(MemoryError())
+    assert is_out_of_memory(RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB"))
+    assert not is_out_of_memory(RuntimeError("shape mismatch"))
@@ -0,0 +1,68 @@
+import json
+import pytest
+import torch
+from torch import nn
+from safetensors.torch import save_file
+from lora_serve.core.engines.multi_lora import MultiLoRAModel
+
+
+class _Tiny(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.proj = nn.Linear(8, 6, bias=False)
+        self.other = nn.Linear(6, 6, bias=False)
+
+    def forward(self, x):
+        return self.other(self.proj(x))
+
+
+def _write_adapter(path, targets, r, alpha=8):
+    path.mkdir()
+    (path / "adapter_config.json").write_text(json.dumps({"peft_type": "LORA", "r": r, "lora_alpha": alpha}))
+    shapes = {"proj": (8, 6), "other": (6, 6)}
+    state, weights = {}, {}
+    for name in targets:
+        a, b = torch.randn(r, shapes[name][0]), torch.randn(shapes[name][1], r)
+        state[f"base_model.model.{name}.lora_A.weight"] = a
+        state[f"base_model.model.{name}.lora_B.weight"] = b
+        weights[name] = (a, b, alpha / r)
+    save_file(state, str(path / "adapter_model.safetensors"))
+    return weights
+
+
+def test_per_row_adapters_match_single_adapter_math(tmp_path):
+    torch.manual_seed(0)
+    model = _Tiny()
+    ref = _Tiny()
+    ref.load_state_dict(model.state_dict())
+    w1 = _write_adapter(tmp_path / "one", ["proj"], r=2)
+    w2 = _write_adapter(tmp_path / "two", ["proj", "other"], r=4)
+
+    multi = MultiLoRAModel(model)
+    multi.load("one", str(tmp_path / "one"))
+    multi.load("two", str(tmp_path / "two"))
+
+    x = torch.randn(3, 5, 8)
+    multi.set_rows(["one", None, "two"])
+    out = model(x)
+
+    def expected(xi, weights):
+        h = ref.proj(xi)
+        if "proj" in weights:
+            a, b, s = weights["proj"]
+            h = h + s * (xi @ a.T @ b.T)
+        y = ref.other(h)
+        if "other" in weights:
+            a, b, s = weights["other"]
+            y = y + s * (h @ a.T @ b.T)
+        return y
+
+    for row, weights in enumerate([w1, {}, w2]):
+        assert torch.allclose(out[row], expected(x[row], weights), atol=1e-5)
+
+    # unloading frees the slot; rows may no longer ask for the adapter
+    multi.unload("two")
+    with pytest.raises(KeyError):
+        multi.set_rows(["one", "two"])
+    multi.set_rows([None])
+    assert torch.allclose(model(x[2:3])[0], expected(x[2], {}), atol=1e-5)
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from safetensors.torch import save_file
+
+from lora_serve.core import profiling
+from lora_serve.core.adapters import LoRAAdapterManager
+from lora_serve.core.engines.sim_engine import CostModel, SimEngine
+from lora_serve.core.types import GenerateRequest
+from lora_serve.scheduler.batcher import DynamicBatcher
+from lora_serve.scheduler.queue import TenantQueues
+
+
+def test_profile_session_captures_batches_and_loop_stacks(tmp_path):
+    for adapter_id in ("a1", "a2"):
+        (tmp_path / adapter_id).mkdir()
+        (tmp_path / adapter_id / "adapter_config.json").write_text('{"peft_type": "LORA"}')
+        save_file({}, str(tmp_path / adapter_id / "adapter_model.safetensors"))
+
+    async def main():
+        engine = SimEngine(CostModel(decode_base_ms=5), multi_lora=True)
+        batcher = DynamicBatcher(engine, TenantQueues(), LoRAAdapterManager(tmp_path, engine), max_batch_tokens=4096,
+                                 max_wait_ms=0)
+        task = asyncio.create_task(batcher.run_forever())
+        reqs = [GenerateRequest(prompt="x" * 40, max_tokens=50, adapter_id=a) for a in ("a1", "a2", None)]
+        pending = asyncio.gather(*(batcher.enqueue(r) for r in reqs))
+        session = await profiling.ProfileSession([batcher], interval_ms=1).run(seconds=10, batches=4)
+        await pending
+        task.cancel()
+        return session
+
+    session = asyncio.run(main())
+    assert not profiling.active() and session.batches == 4
+    trace = session.chrome_trace()
+    batches = [e for e in trace["traceEvents"] if e.get("cat") == "scheduler"]
+    assert [e["args"]["batch"] for e in batches] == [1, 2, 3, 4]
+    assert batches[-1]["args"] == {"batch": 4, "rows": 3, "adapters": ["a1", "a2", "base"]}
+    assert any(e.get("cat") == "python" for e in trace["traceEvents"])
+    assert "run_forever" in session.folded()
+
+
+def test_profile_session_cleans_up_when_an_engine_cannot_profile():
+    class _Engine:
+        def __init__(self, fail):
+            self.fail, self.stopped = fail, False
+
+        async def start_profile(self):
+            if self.fail:
+                raise RuntimeError("profiler busy")
+
+        async def stop_profile(self):
+            self.stopped = True
+            return {"traceEvents": []}
+
+    ok, broken = _Engine(False), _Engine(True)
+    batchers = [type("B", (), {"engine": engine})() for engine in (ok, broken)]
+    with pytest.raises(RuntimeError, match="profiler busy"):   # not a "cannot join thread" from the sampler
+        asyncio.run(profiling.ProfileSession(batchers).run(seconds=1))
+    assert not profiling.active()
+    assert ok.stopped and not broken.stopped
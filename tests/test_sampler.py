@@ -0,0 +1,45 @@
+import torch
+from lora_serve.core.types import GenerateRequest
+from lora_serve.decoding.sampler import SamplingBatch, probs_from_logits, sample
+
+
+def _batch(reqs, seeds=None):
+    gens = [torch.Generator().manual_seed(s) if s is not None else None for s in (seeds or [None] * len(reqs))]
+    return SamplingBatch.from_requests(reqs, gens)
+
+
+def test_per_row_params_in_one_batch():
+    logits = torch.tensor([[0.0, 3.0, 1.0, 2.0]]).repeat(3, 1)
+    reqs = [
+        GenerateRequest(prompt="", temperature=0.0),               # greedy
+        GenerateRequest(prompt="", temperature=5.0, top_k=1),      # top-k=1 is greedy too
+        GenerateRequest(prompt="", temperature=1.0, top_p=0.5),    # only the top token survives
+    ]
+    for _ in range(20):
+        assert sample(logits, _batch(reqs)).tolist() == [1, 1, 1]
+
+
+def test_sampled_distribution_matches_temperature_softmax():
+    logits = torch.tensor([[0.0, 1.0, 2.0]])
+    reqs = [GenerateRequest(prompt="", temperature=2.0, top_p=1.0)] * 4000
+    draws = sample(logits.repeat(len(reqs), 1), _batch(reqs))
+    freq = torch.bincount(draws, minlength=3).float() / len(reqs)
+    assert torch.allclose(freq, torch.softmax(logits[0] / 2.0, -1), atol=0.03)
+
+
+def test_seeded_rows_do_not_depend_on_batch_mates():
+    logits = torch.randn(1, 50)
+    seeded = GenerateRequest(prompt="", temperature=1.0, top_p=1.0, seed=7)
+    other = GenerateRequest(prompt="", temperature=1.0, top_p=1.0)
+    alone = sample(logits, _batch([seeded], [7])).item()
+    mixed = sample(logits.repeat(3, 1), _batch([other, seeded, other], [None, 7, None]))[1].item()
+    assert alone == mixed
+
+
+def test_repetition_penalty_and_top_k_mask():
+    logits = torch.tensor([[2.0, 1.9, -1.0]])
+    req = GenerateRequest(prompt="", temperature=0.0, repetition_penalty=2.0)
+    assert sample(logits, _batch([req]), context_ids=[[0]]).item() == 1   # 2.0 -> 1.0 < 1.9
+
+    probs = probs_from_logits(logits, _batch([GenerateRequest(prompt="", temperature=1.0, top_k=2, top_p=1.0)]))
+    assert probs[0, 2] == 0 and torch.isclose(probs.sum(), torch.tensor(1.0))
@@ -0,0 +1,224 @@
+import asyncio
+from types import SimpleNamespace
+from lora_serve.core.router import RequestRouter
+from lora_serve.core.types import GenerateRequest, GenerateResult, StepOutput
+from lora_serve.scheduler.batcher import DynamicBatcher
+from lora_serve.scheduler.policies import WeightedFairPolicy, choose_batch
+from lora_serve.scheduler.queue import TenantQueues
+
+
+def _req(adapter_id=None):
+    return GenerateRequest(prompt="hi", max_tokens=4, adapter_id=adapter_id)
+
+
+def test_tenants_rotate_and_requeue_keeps_entry_at_head():
+    async def main():
+        q = TenantQueues()
+        futs = [q.push("a", _req()), q.push("a", _req()), q.push("b", _req())]
+        first = q.pop()
+        assert first.fut is futs[0]
+        assert q.pop().fut is futs[2]       # "a" was just served, so "b" goes next
+        q.requeue(first)
+        assert q.pop().fut is futs[0]        # same entry, same future, back at the head
+        assert q.pop().fut is futs[1] and q.pop() is None
+    asyncio.run(main())
+
+
+def test_adapter_index_and_blocking_fill():
+    async def main():
+        q = TenantQueues()
+        q.push("a", _req("x"))
+        q.push("a", _req("y"))
+        assert q.pop("y").adapter_id == "y" and len(q) == 1
+        assert not await q.wait("y", timeout=0.01)
+
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.02, q.push, "b", _req("x"))
+        batch = await choose_batch(q, max_batch_tokens=1000, max_wait_ms=200)
+        assert [e.tenant for e in batch] == ["a", "b"]   # woke up for the late arrival
+    asyncio.run(main())
+
+
+def test_weighted_fair_share_priority_and_caps():
+    async def main():
+        q = TenantQueues(policy=WeightedFairPolicy(weights={"heavy": 1, "light": 3}))
+        for _ in range(40):
+            q.push("heavy", _req())
+            q.push("light", _req())
+        served = [q.pop().tenant for _ in range(40)]
+        assert 28 <= served.count("light") <= 32   # ~3:1 despite identical backlogs
+
+        q = TenantQueues(policy=WeightedFairPolicy(priorities={"vip": 1}, max_concurrency={"vip": 1}))
+        q.push("bulk", _req())
+        q.push("vip", _req())
+        q.push("vip", _req())
+        vip = q.pop()
+        assert vip.tenant == "vip"
+        assert q.pop().tenant == "bulk"             # vip is at its cap of one in flight
+        assert q.pop() is None and not q.has_work()
+        q.done(vip, tokens=10)
+        assert q.pop().tenant == "vip"
+    asyncio.run(main())
+
+
+def test_requeue_rolls_back_the_fair_clock():
+    async def main():
+        policy = WeightedFairPolicy()
+        q = TenantQueues(policy=policy)
+        q.push("a", _req())
+        q.push("a", _req())
+        q.pop()
+        before = (policy._clock, dict(policy._vtime))
+        q.requeue(q.pop())                      # e.g. did not fit the batch
+        assert (policy._clock, policy._vtime) == before
+        q.push("b", _req())
+        assert q.pop().tenant == "b"            # a newcomer starts at the clock before the requeued pop
+    asyncio.run(main())
+
+
+def test_requeue_restores_the_fair_clock_after_a_weight_change():
+    async def main():
+        policy = WeightedFairPolicy(weights={"a": 3.0})
+        q = TenantQueues(policy=policy)
+        for _ in range(3):
+            q.push("a", _req())
+        q.pop()
+        before = (policy._clock, dict(policy._vtime))
+        second, third = q.pop(), q.pop()
+        policy.weights["a"] = 7.0               # the charge can no longer be recomputed
+        q.requeue(third)
+        q.requeue(second)
+        assert (policy._clock, policy._vtime) == before
+    asyncio.run(main())
+
+
+class _CountingEngine:
+    """Emits the letters of the prompt one per step; records the batch size of each step."""
+    supports_mixed_adapters = True
+
+    def __init__(self):
+        self.seqs, self.batch_sizes = {}, []
+
+    async def warmup(self, adapters=None):
+        pass
+
+    def add_sequence(self, seq_id, req):
+        self.seqs[seq_id] = [req, 0]
+
+    def abort_sequence(self, seq_id):
+        self.seqs.pop(seq_id, None)
+
+    async def step(self):
+        self.batch_sizes.append(len(self.seqs))
+        outs = []
+        for seq_id, state in list(self.seqs.items()):
+            req, n = state
+            state[1] = n + 1
+            done = state[1] == len(req.prompt)
+            result = GenerateResult(text=req.prompt, tokens=len(req.prompt)) if done else None
+            text = req.prompt[n] if req.stream else ""
+            outs.append(StepOutput(seq_id=seq_id, token_ids=[n], finished=done, result=result, text=text))
+            if done:
+                del self.seqs[seq_id]
+        await asyncio.sleep(0)
+        return outs
+
+
+def test_streaming_and_plain_requests_share_batches():
+    async def main():
+        engine = _CountingEngine()
+        batcher = DynamicBatcher(engine, TenantQueues(), adapters=None, max_batch_tokens=1000, max_wait_ms=20)
+        task = asyncio.create_task(batcher.run_forever())
+
+        async def collect(prompt):
+            return [c async for c in batcher.stream(GenerateRequest(prompt=prompt, stream=True))]
+        streamed, plain = await asyncio.gather(collect("abcd"), batcher.enqueue(GenerateRequest(prompt="wxyz")))
+        task.cancel()
+        assert streamed == list("abcd") and plain.text == "wxyz"
+        assert engine.batch_sizes[0] == 2
+    asyncio.run(main())
+
+
+def test_adapter_affinity_bounded_by_staleness():
+    async def main():
+        q = TenantQueues()
+        q.push("a", _req("x"))
+        q.push("b", _req("y"))
+        batch = await choose_batch(q, 1000, 0, prefer_adapter="y", max_staleness_ms=10_000)
+        assert [e.adapter_id for e in batch] == ["y"]   # older "x" waits: no switch needed
+
+        q.push("b", _req("y"))
+        batch = await choose_batch(q, 1000, 0, prefer_adapter="y", max_staleness_ms=0)
+        assert [e.adapter_id for e in batch] == ["x"]   # "x" is now too stale to keep waiting
+    asyncio.run(main())
+
+
+def test_router_prefers_resident_adapter_within_slack():
+    def worker(load, active=()):
+        return SimpleNamespace(load=lambda: load, adapters=SimpleNamespace(active=dict.fromkeys(active)))
+    idle, busy = worker(0), worker(3, active=["x"])
+    router = RequestRouter([idle, busy], affinity_slack=4)
+    assert router.pick(None) is idle
+    assert router.pick("x") is busy      # resident and only 3 requests busier
+    assert router.pick("y") is idle
+    router.affinity_slack = 2
+    assert router.pick("x") is idle      # too busy: attaching elsewhere is cheaper
+
+
+def test_cancelled_requests_leave_the_batch():
+    async def main():
+        engine = _CountingEngine()
+        batcher = DynamicBatcher(engine, TenantQueues(), adapters=None, max_batch_tokens=1000, max_wait_ms=0)
+        task = asyncio.create_task(batcher.run_forever())
+        stream = batcher.stream(GenerateRequest(prompt="a" * 50, stream=True))
+        assert await stream.__anext__() == "a"
+        await stream.aclose()                         # client disconnected mid-stream
+        timed_out = asyncio.create_task(batcher.enqueue(GenerateRequest(prompt="b" * 50)))
+        await asyncio.sleep(0.01)
+        timed_out.cancel()
+        assert (await batcher.enqueue(GenerateRequest(prompt="cd"))).text == "cd"
+        task.cancel()
+        assert not engine.seqs and not batcher._running
+        assert engine.batch_sizes[-1] == 1            # the last step ran only the live request
+    asyncio.run(main())
+
+
+def test_running_batch_is_not_topped_up_past_its_budget():
+    async def main():
+        engine = _CountingEngine()
+        batcher = DynamicBatcher(engine, TenantQueues(), adapters=None, max_batch_tokens=1000, max_wait_ms=0)
+        step, costs = engine.step, []
+
+        async def checked_step():
+            costs.append(sum(batcher._costs.values()))
+            return await step()
+        engine.step = checked_step
+        task = asyncio.create_task(batcher.run_forever())
+        big = lambda: batcher.enqueue(GenerateRequest(prompt="x" * 20, max_tokens=50, prompt_ids=[1] * 900))
+        first = asyncio.create_task(big())
+        while not costs:                              # running when the second one arrives
+            await asyncio.sleep(0)
+        results = await asyncio.gather(first, big())
+        task.cancel()
+        assert [r.text for r in results] == ["x" * 20] * 2
+        assert max(costs) == 950 and max(engine.batch_sizes) == 1   # the second waited for the first
+    asyncio.run(main())
+
+
+def test_batches_group_prompt_lengths_and_cost_padding():
+    async def main():
+        q = TenantQueues()
+        short = lambda: GenerateRequest(prompt="s", max_tokens=1, prompt_ids=[1] * 10)
+        q.push("a", short())
+        q.push("a", GenerateRequest(prompt="l", max_tokens=1, prompt_ids=[1] * 3000))
+        q.push("a", short())
+        batch = await choose_batch(q, max_batch_tokens=10_000, max_wait_ms=0)
+        assert [len(e.req.prompt_ids) for e in batch] == [10, 10]   # the long prompt waits for its own batch
+        assert len(q.pop().req.prompt_ids) == 3000                   # ...at the head of the queue
+
+        for _ in range(3):
+            q.push("a", GenerateRequest(prompt="m", max_tokens=1, prompt_ids=[1] * 1000))
+        q.push("a", GenerateRequest(prompt="m", max_tokens=1, prompt_ids=[1] * 600))
+        batch = await choose_batch(q, max_batch_tokens=3500, max_wait_ms=0)
+        assert len(batch) == 3   # a 4th row would make 4 x 1000 padded tokens
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+import asyncio
+from types import SimpleNamespace
+
+from lora_serve.core.engines.sim_engine import CostModel, SimEngine
+from lora_serve.core.router import RequestRouter
+from lora_serve.core.types import GenerateRequest
+from lora_serve.scheduler.batcher import DynamicBatcher
+from lora_serve.scheduler.queue import TenantQueues
+
+
+def test_batcher_load_test_on_sim_engine():
+    async def main():
+        engine = SimEngine(CostModel(), multi_lora=True, time_scale=0)
+        batcher = DynamicBatcher(engine, TenantQueues(), adapters=None, max_batch_tokens=4096, max_wait_ms=0)
+        task = asyncio.create_task(batcher.run_forever())
+        reqs = [GenerateRequest(prompt="x" * (4 * (i % 50 + 1)), max_tokens=i % 7 + 1, tenant_id=f"t{i % 3}")
+                for i in range(500)]
+        results = await asyncio.gather(*(batcher.enqueue(r) for r in reqs))
+        task.cancel()
+        assert [r.tokens for r in results] == [r.max_tokens for r in reqs]
+        assert engine.steps < 500 and engine.busy_ms > 0  # requests shared steps
+    asyncio.run(main())
+
+
+def test_sim_engine_admits_within_kv_capacity_and_charges_padded_shapes():
+    async def main():
+        cost = CostModel(prefill_base_ms=1, prefill_ms_per_token=0.1, decode_base_ms=2, decode_ms_per_row=0.5,
+                         decode_ms_per_kv_token=0.01)
+        engine = SimEngine(cost, time_scale=0, kv_capacity_tokens=100)
+        for i, n in enumerate((10, 30, 50)):
+            engine.add_sequence(f"s{i}", GenerateRequest(prompt="", prompt_ids=[0] * n, max_tokens=20))
+        assert [o.seq_id for o in await engine.step()] == ["s0", "s1"]  # s2 (70 tokens) waits for room
+        assert engine.busy_ms == cost.prefill_ms(2, 30) == 7
+        await engine.step()
+        assert engine.busy_ms == 7 + cost.decode_ms(2, 31)
+    asyncio.run(main())
+
+
+def test_n_choices_fork_from_one_prefill():
+    async def main():
+        cost = CostModel(prefill_base_ms=1, prefill_ms_per_token=0.1, decode_base_ms=2, decode_ms_per_row=0,
+                         decode_ms_per_kv_token=0)
+        engine = SimEngine(cost, time_scale=0)
+        batcher = DynamicBatcher(engine, TenantQueues(), adapters=None, max_batch_tokens=4096, max_wait_ms=0)
+        task = asyncio.create_task(batcher.run_forever())
+        res = await batcher.enqueue(GenerateRequest(prompt="", prompt_ids=[0] * 10, max_tokens=3, n=3))
+        assert len(res.choices) == 3 and res.tokens == 9 and res.prompt_tokens == 10
+        assert engine.busy_ms == cost.prefill_ms(1, 10) + 2 * cost.decode_ms(3, 0)  # one prefill row
+
+        req = GenerateRequest(prompt="", prompt_ids=[0] * 10, max_tokens=2, n=2, best_of=4, stream=True)
+        seen = [(i, result is not None) async for i, _, result in batcher.stream_choices(req)]
+        task.cancel()
+        assert {i for i, _ in seen} == {0, 1, 2, 3} and sum(done for _, done in seen) == 4
+    asyncio.run(main())
+
+
+def test_router_submit_many_yields_in_completion_order():
+    async def resolve_path(adapter_id):
+        raise FileNotFoundError(adapter_id)
+
+    async def main():
+        engine = SimEngine(CostModel(), time_scale=0)
+        batcher = DynamicBatcher(engine, TenantQueues(), adapters=None, max_batch_tokens=4096, max_wait_ms=0)
+        batcher.adapters = SimpleNamespace(active={}, resolve_path=resolve_path)
+        task = asyncio.create_task(batcher.run_forever())
+        router = RequestRouter([batcher])
+        reqs = [GenerateRequest(prompt="x" * 8, max_tokens=t) for t in (5, 1, 3)]
+        reqs.append(GenerateRequest(prompt="x", adapter_id="missing"))
+        out = [(i, r) async for i, r in router.submit_many(reqs)]
+        assert [i for i, _ in out] == [3, 1, 2, 0] and isinstance(out[0][1], FileNotFoundError)
+        assert engine.steps == 5  # one batch: all three joined the first step
+
+        results = router.submit_many([GenerateRequest(prompt="x", max_tokens=m) for m in (1, 1000)])
+        assert (await results.__anext__())[0] == 0
+        await results.aclose()  # caller went away: the long request leaves the batch
+        await asyncio.sleep(0.01)
+        task.cancel()
+        assert not batcher._running and not engine.has_unfinished()
+    asyncio.run(main())
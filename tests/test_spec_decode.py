@@ -0,0 +1,28 @@
+import torch
+from lora_serve.decoding.spec_decode import NgramProposer, SpeculativeOrchestrator
+
+
+def test_ngram_proposer_prefers_longest_recent_match():
+    proposer = NgramProposer(max_ngram=2)
+    assert proposer.propose("s", [1, 2, 3, 9, 2, 3, 4, 2, 3], k=2)[0] == [4, 2]
+    assert proposer.propose("s", [5, 6, 7], k=2)[0] == []
+
+
+def test_greedy_verification_keeps_matching_prefix_plus_correction():
+    spec = SpeculativeOrchestrator(NgramProposer())
+    target = torch.eye(5)[[1, 2, 4, 0]]  # greedy target continues 1, 2, 4, ...
+    assert spec.accept("s", [1, 2, 3], None, target, None) == [1, 2, 4]
+    assert spec.accept("s", [1, 2, 4], None, target, None) == [1, 2, 4, 0]
+
+
+def test_rejection_sampling_preserves_target_distribution():
+    spec = SpeculativeOrchestrator(NgramProposer())
+    gen = torch.Generator().manual_seed(0)
+    p = torch.tensor([0.1, 0.6, 0.3])
+    q = torch.tensor([0.5, 0.25, 0.25])
+    counts = torch.zeros(3)
+    for _ in range(4000):
+        draft = int(torch.multinomial(q, 1, generator=gen))
+        first = spec.accept("s", [draft], q.unsqueeze(0), torch.stack([p, p]), gen)[0]
+        counts[first] += 1
+    assert torch.allclose(counts / counts.sum(), p, atol=0.03)
@@ -0,0 +1,32 @@
+from lora_serve.decoding.stream import IncrementalDetokenizer
+
+
+class _ByteTokenizer:
+    """Token id = one UTF-8 byte, like the byte-fallback pieces of real tokenizers."""
+
+    def decode(self, ids, skip_special_tokens=True):
+        return bytes(ids).decode("utf-8", errors="replace")
+
+
+def test_incremental_detokenizer_holds_back_partial_characters():
+    text = "añ日🚀"
+    ids = list(text.encode())
+    detok = IncrementalDetokenizer(_ByteTokenizer())
+    deltas = [detok.add([i]) for i in ids]
+    assert "".join(deltas) == text == detok.text
+    assert all("\ufffd" not in d for d in deltas)
+    assert deltas[:3] == ["a", "", "ñ"]
+
+
+def test_non_incremental_decodes_once_at_the_end():
+    detok = IncrementalDetokenizer(_ByteTokenizer(), incremental=False)
+    assert detok.add(list(b"hi")) == ""
+    assert detok.add(list(b"!"), final=True) == "hi!" == detok.text
+
+
+def test_stop_string_cuts_text_and_holds_back_possible_prefix():
+    detok = IncrementalDetokenizer(_ByteTokenizer(), stop=["END"])
+    deltas = [detok.add([i]) for i in b"ok EN"]
+    assert "".join(deltas) == "ok " and not detok.stopped   # "EN" may become "END"
+    detok.add(list(b"D more"))
+    assert detok.stopped and detok.text == "ok "
@@ -0,0 +1,31 @@
+import asyncio
+
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+from lora_serve.core import tracing
+from lora_serve.core.engines.sim_engine import CostModel, SimEngine
+from lora_serve.core.types import GenerateRequest
+from lora_serve.scheduler.batcher import DynamicBatcher
+from lora_serve.scheduler.queue import TenantQueues
+
+
+def test_request_lifecycle_spans_share_the_request_trace():
+    async def main():
+        batcher = DynamicBatcher(SimEngine(CostModel(), time_scale=0), TenantQueues(), adapters=None,
+                                 max_batch_tokens=4096, max_wait_ms=0)
+        task = asyncio.create_task(batcher.run_forever())
+        with tracing.span("generate"):
+            await batcher.enqueue(GenerateRequest(prompt="x" * 40, max_tokens=3))
+        task.cancel()
+
+    exporter = InMemorySpanExporter()
+    assert tracing.setup_tracing(exporter=exporter)
+    try:
+        asyncio.run(main())
+    finally:
+        tracing.shutdown_tracing()
+    spans = {s.name: s for s in exporter.get_finished_spans()}
+    root = spans["generate"].context.trace_id
+    assert all(spans[name].context.trace_id == root for name in ("queue", "prefill", "decode"))
+    assert len(spans["decode"].events) == 2  # one per decode step after the prefill token
+    assert not tracing.enabled()
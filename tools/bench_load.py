@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+Open-loop load generator: replays a JSONL workload or synthesizes one, drives it
+against a running server (--url) or an in-process DynamicBatcher over an HFEngine
+(--model_id) or a model-free SimEngine (--sim, optionally with a cost model fitted by
+tools/fit_cost_model.py), and reports TTFT, time per output token (TPOT), end-to-end latency, goodput under an SLO
+and token throughput.
+
+    python tools/bench_load.py --model_id <tiny causal LM> --num_requests 200 --rate 20 --out run.json
+    python tools/bench_load.py --url http://localhost:8000 --workload trace.jsonl --out run.json
+    python tools/bench_load.py --sim cost.json --num_requests 20000 --rate 2000
+
+A workload line is a /v1/generate body (prompt, max_tokens, adapter_id, tenant_id, ...)
+plus an optional "t": its arrival time in seconds from the start. Lines without "t"
+get arrivals from --rate/--burstiness: gamma-distributed gaps, where burstiness 1 is a
+Poisson process, < 1 burstier and > 1 more regular; --rate inf sends everything at once.
+Synthetic prompt/output lengths are "fixed:N", "uniform:LO,HI" or "lognormal:MEDIAN,SIGMA";
+adapter/tenant mixes are "name=weight,..." with "-" for the base model / default tenant.
+
+Over HTTP every SSE data event counts as one output token (the server emits one per
+decoded token, minus the few held back for incomplete characters); in-process runs use
+the exact counts. --out writes the config, a summary and every request's timings as JSON,
+so two runs can be diffed.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+WORDS = ("alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike "
+         "november oscar papa quebec romeo sierra tango uniform victor whiskey xray yankee zulu").split()
+
+
+@dataclass
+class Record:
+    t: float                       # scheduled arrival (s from start)
+    adapter_id: Optional[str]
+    tenant_id: Optional[str]
+    prompt_chars: int
+    max_tokens: int
+    ttft_ms: Optional[float] = None
+    e2e_ms: Optional[float] = None
+    tokens: int = 0
+    error: Optional[str] = None
+    chunk_ms: List[float] = field(default_factory=list, repr=False)
+
+    @property
+    def tpot_ms(self) -> Optional[float]:
+        if self.e2e_ms is None or self.ttft_ms is None or self.tokens < 2:
+            return None
+        return (self.e2e_ms - self.ttft_ms) / (self.tokens - 1)
+
+
+# ---- workload -----------------------------------------------------------------
+
+def sample_length(spec: str, rng: random.Random) -> int:
+    kind, _, params = spec.partition(":")
+    vals = [float(v) for v in params.split(",")]
+    if kind == "fixed":
+        n = vals[0]
+    elif kind == "uniform":
+        n = rng.uniform(vals[0], vals[1])
+    elif kind == "lognormal":
+        n = rng.lognormvariate(math.log(vals[0]), vals[1])
+    else:
+        raise ValueError(f"unknown length distribution '{spec}'")
+    return max(1, int(round(n)))
+
+
+def parse_mix(spec: Optional[str]) -> Dict[Optional[str], float]:
+    if not spec:
+        return {None: 1.0}
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[None if name in ("-", "") else name] = float(weight or 1)
+    return mix
+
+
+def arrivals(n: int, rate: float, burstiness: float, rng: random.Random) -> List[float]:
+    if math.isinf(rate):
+        return [0.0] * n
+    t, out = 0.0, []
+    for _ in range(n):
+        out.append(t)
+        t += rng.gammavariate(burstiness, 1 / (rate * burstiness))
+    return out
+
+
+def synthesize(args, rng: random.Random) -> List[dict]:
+    adapters, tenants = parse_mix(args.adapters), parse_mix(args.tenants)
+    items = []
+    for _ in range(args.num_requests):
+        # distinct words so the prefix cache does not make every prompt free
+        prompt = " ".join(rng.choice(WORDS) for _ in range(sample_length(args.prompt_len, rng)))
+        items.append({
+            "prompt": prompt,
+            "max_tokens": sample_length(args.output_len, rng),
+            "temperature": args.temperature,
+            "adapter_id": rng.choices(list(adapters), list(adapters.values()))[0],
+            "tenant_id": rng.choices(list(tenants), list(tenants.values()))[0],
+        })
+    return items
+
+
+def load_workload(args, rng: random.Random) -> List[dict]:
+    if args.workload:
+        items = [json.loads(line) for line in Path(args.workload).read_text().splitlines() if line.strip()]
+        if args.num_requests:
+            items = items[:args.num_requests]
+    else:
+        items = synthesize(args, rng)
+    times = arrivals(len(items), args.rate, args.burstiness, rng)
+    for item, t in zip(items, times):
+        item.setdefault("t", t)
+    items.sort(key=lambda item: item["t"])
+    return items
+
+
+# ---- targets --------------------------------------------------------------------
+
+class HTTPTarget:
+    def __init__(self, url: str, timeout: float):
+        import httpx
+        self.url = url.rstrip("/") + "/v1/generate/stream"
+        self.client = httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=None))
+
+    async def send(self, body: dict, rec: Record, start: float) -> None:
+        async with self.client.stream("POST", self.url, json=body) as r:
+            r.raise_for_status()
+            event = None
+            async for line in r.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    if event == "error":
+                        raise RuntimeError(line[5:].strip())
+                    if event is None:
+                        rec.chunk_ms.append((time.perf_counter() - start) * 1000)
+                        rec.tokens += 1
+                elif not line:
+                    event = None
+
+    def prepare(self, items: List[dict]) -> None:
+        pass  # the server tokenizes
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+class InProcessTarget:
+    """
+    A DynamicBatcher over an engine in this process, fed through its tenant queues.
+    Prompts are tokenized up front (as the server's TokenizerPool does), with the
+    engine's tokenizer or --tokenizer, so a SimEngine sees real prompt lengths.
+    """
+
+    def __init__(self, engine, args):
+        from lora_serve.core.adapters import LoRAAdapterManager
+        from lora_serve.scheduler.batcher import DynamicBatcher
+        from lora_serve.scheduler.policies import WeightedFairPolicy
+        from lora_serve.scheduler.queue import TenantQueues
+
+        self.engine = engine
+        self.queues = TenantQueues(policy=WeightedFairPolicy())
+        self.adapters = LoRAAdapterManager(Path(args.adapter_root), engine=engine)
+        self.batcher = DynamicBatcher(engine, self.queues, self.adapters, args.max_batch_tokens, args.max_wait_ms)
+        self.tokenizer = getattr(engine, "tokenizer", None)
+        if args.tokenizer:
+            from transformers import AutoTokenizer
+            self.tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        self._task = asyncio.get_running_loop().create_task(self.batcher.run_forever())
+
+    def prepare(self, items: List[dict]) -> None:
+        if self.tokenizer is None:
+            return
+        for item, ids in zip(items, self.tokenizer([item["prompt"] for item in items])["input_ids"]):
+            item.setdefault("prompt_ids", ids)
+
+    async def send(self, body: dict, rec: Record, start: float) -> None:
+        from lora_serve.core.types import GenerateRequest
+
+        body = {k: v for k, v in body.items() if k not in ("t", "stream")}
+        req = GenerateRequest(**body, stream=True)
+        sink: asyncio.Queue = asyncio.Queue()
+        fut = self.queues.push(req.tenant_id or "default", req, sink=sink)
+        while (chunk := await sink.get()) is not None:
+            if chunk:
+                rec.chunk_ms.append((time.perf_counter() - start) * 1000)
+        rec.tokens = (await fut).tokens
+
+    async def close(self) -> None:
+        self._task.cancel()
+
+
+def make_engine(args):
+    if args.sim is not None:
+        from lora_serve.core.engines.sim_engine import CostModel, SimEngine
+        cost = CostModel.load(args.sim) if args.sim else CostModel()
+        return SimEngine(cost, multi_lora=args.multi_lora, time_scale=args.time_scale)
+    from lora_serve.core.engines.hf_engine import HFEngine
+    return HFEngine(args.model_id, dtype=args.dtype, device=args.device, multi_lora=args.multi_lora)
+
+
+# ---- run + report ---------------------------------------------------------------
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    items = load_workload(args, rng)
+    if args.save_workload:
+        Path(args.save_workload).write_text("".join(json.dumps(i) + "\n" for i in items))
+    target = HTTPTarget(args.url, args.timeout) if args.url else InProcessTarget(make_engine(args), args)
+    target.prepare(items)
+    try:
+        # one request first, so model warmup and connection setup are not measured
+        await target.send({"prompt": "Hello", "max_tokens": 2}, Record(0, None, None, 5, 2), time.perf_counter())
+        records = []
+        start = time.perf_counter()
+
+        async def one(item: dict) -> None:
+            rec = Record(item["t"], item.get("adapter_id"), item.get("tenant_id"), len(item["prompt"]),
+                         item.get("max_tokens", 64))
+            records.append(rec)
+            await asyncio.sleep(max(0.0, start + item["t"] - time.perf_counter()))
+            sent = time.perf_counter()
+            try:
+                await asyncio.wait_for(target.send(item, rec, sent), args.timeout)
+                rec.e2e_ms = (time.perf_counter() - sent) * 1000
+                rec.ttft_ms = rec.chunk_ms[0] if rec.chunk_ms else rec.e2e_ms
+            except Exception as ex:
+                rec.error = f"{type(ex).__name__}: {ex}"
+
+        await asyncio.gather(*(one(item) for item in items))
+        duration = time.perf_counter() - start
+    finally:
+        await target.close()
+    return {"config": vars(args), "summary": summarize(records, duration, args), "requests": [
+        {**{k: v for k, v in asdict(r).items() if k != "chunk_ms"}, "tpot_ms": r.tpot_ms} for r in records]}
+
+
+def percentiles(values: List[float]) -> dict:
+    values = sorted(values)
+    if not values:
+        return {}
+    pick = lambda p: values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+    return {"mean": sum(values) / len(values), "p50": pick(50), "p95": pick(95), "p99": pick(99)}
+
+
+def summarize(records: List[Record], duration: float, args) -> dict:
+    ok = [r for r in records if r.error is None]
+    good = [r for r in ok if r.ttft_ms <= args.slo_ttft_ms and (r.tpot_ms or 0) <= args.slo_tpot_ms]
+    tokens = sum(r.tokens for r in ok)
+    return {
+        "requests": len(records),
+        "errors": len(records) - len(ok),
+        "duration_s": duration,
+        "request_rate": len(ok) / duration,
+        "output_tokens_per_s": tokens / duration,
+        "goodput": len(good) / duration,  # requests/s meeting both SLOs
+        "slo_attainment": len(good) / len(records) if records else 0.0,
+        "ttft_ms": percentiles([r.ttft_ms for r in ok]),
+        "tpot_ms": percentiles([r.tpot_ms for r in ok if r.tpot_ms is not None]),
+        "e2e_ms": percentiles([r.e2e_ms for r in ok]),
+    }
+
+
+def print_summary(s: dict) -> None:
+    print(f"requests {s['requests']}  errors {s['errors']}  duration {s['duration_s']:.1f}s")
+    print(f"throughput {s['request_rate']:.2f} req/s  {s['output_tokens_per_s']:.1f} tok/s  "
+          f"goodput {s['goodput']:.2f} req/s ({s['slo_attainment']:.0%} within SLO)")
+    print(f"{'':>6} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for name in ("ttft_ms", "tpot_ms", "e2e_ms"):
+        p = s[name]
+        if p:
+            print(f"{name[:-3]:>6} " + " ".join(f"{p[k]:>9.1f}" for k in ("mean", "p50", "p95", "p99")))
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser()
+    target = ap.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="running server, e.g. http://localhost:8000")
+    target.add_argument("--model_id", help="serve in-process with an HFEngine on this model")
+    target.add_argument("--sim", nargs="?", const="", metavar="COST_JSON",
+                        help="serve in-process with a SimEngine (default cost model without a file)")
+    ap.add_argument("--time_scale", type=float, default=1.0, help="SimEngine: real seconds per simulated second")
+    ap.add_argument("--tokenizer", default=None, help="tokenize prompts with this model's tokenizer (SimEngine)")
+    ap.add_argument("--dtype", default="float32")
+    ap.add_argument("--device", default="cpu")
+    ap.add_argument("--multi_lora", action="store_true")
+    ap.add_argument("--adapter_root", default="./examples/adapters")
+    ap.add_argument("--max_batch_tokens", type=int, default=8192)
+    ap.add_argument("--max_wait_ms", type=int, default=10)
+    ap.add_argument("--workload", help="JSONL workload to replay (default: synthesize)")
+    ap.add_argument("--save_workload", help="write the (synthesized) workload here for replay")
+    ap.add_argument("--num_requests", type=int, default=100)
+    ap.add_argument("--rate", type=float, default=10.0, help="mean arrivals per second (inf = all at once)")
+    ap.add_argument("--burstiness", type=float, default=1.0)
+    ap.add_argument("--prompt_len", default="lognormal:64,0.6", help="words per synthetic prompt")
+    ap.add_argument("--output_len", default="uniform:16,64", help="max_tokens per synthetic request")
+    ap.add_argument("--adapters", default=None, help="e.g. 'code=0.3,chat=0.2,-=0.5'")
+    ap.add_argument("--tenants", default=None, help="e.g. 'a=0.7,b=0.3'")
+    ap.add_argument("--temperature", type=float, default=0.0)
+    ap.add_argument("--slo_ttft_ms", type=float, default=1000)
+    ap.add_argument("--slo_tpot_ms", type=float, default=100)
+    ap.add_argument("--timeout", type=float, default=300)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", help="write config, summary and per-request timings as JSON")
+    return ap.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    result = asyncio.run(run(args))
+    print_summary(result["summary"])
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
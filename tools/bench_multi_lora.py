@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Throughput of mixed-adapter batches (multi-LoRA engine) vs. today's one-adapter-per-batch
+path, as the number of distinct adapters in the traffic grows.
+
+    python tools/bench_multi_lora.py --model_id <tiny causal LM> --adapters 1,2,4,8,16
+
+Both modes run the same workload through DynamicBatcher in-process; fake adapters are
+generated under --adapter_root when missing (see make_fake_adapters.py).
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from lora_serve.core.adapters import LoRAAdapterManager
+from lora_serve.core.engines.hf_engine import HFEngine
+from lora_serve.core.types import GenerateRequest
+from lora_serve.scheduler.batcher import DynamicBatcher
+from lora_serve.scheduler.queue import TenantQueues
+
+
+async def run_workload(engine: HFEngine, adapter_root: Path, num_adapters: int, args) -> tuple[float, int]:
+    queues = TenantQueues()
+    # default byte budgets are far above what the bench adapters need, so nothing is evicted mid-run
+    batcher = DynamicBatcher(engine, queues, LoRAAdapterManager(adapter_root, engine=engine),
+                             args.max_batch_tokens, args.max_wait_ms)
+    task = asyncio.create_task(batcher.run_forever())
+    reqs = [
+        GenerateRequest(prompt=f"Request {i}: say something.", max_tokens=args.max_tokens, temperature=0,
+                        adapter_id=f"bench-{i % num_adapters}", tenant_id=f"t{i % num_adapters}")
+        for i in range(args.requests)
+    ]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(batcher.enqueue(r) for r in reqs))
+    elapsed = time.perf_counter() - start
+    task.cancel()
+    return elapsed, sum(r.tokens for r in results)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model_id", required=True)
+    ap.add_argument("--dtype", default="float32")
+    ap.add_argument("--adapter_root", default="/tmp/lora_serve_bench_adapters")
+    ap.add_argument("--adapters", default="1,2,4,8,16", help="comma-separated distinct adapter counts")
+    ap.add_argument("--requests", type=int, default=64)
+    ap.add_argument("--max_tokens", type=int, default=16)
+    ap.add_argument("--max_batch_tokens", type=int, default=8192)
+    ap.add_argument("--max_wait_ms", type=int, default=10)
+    ap.add_argument("--rank", type=int, default=8)
+    args = ap.parse_args()
+
+    counts = [int(n) for n in args.adapters.split(",")]
+    root = Path(args.adapter_root)
+    missing = [i for i in range(max(counts)) if not (root / f"bench-{i}").exists()]
+    if missing:
+        from make_fake_adapters import make_adapter
+        for i in missing:
+            make_adapter(args.model_id, str(root / f"bench-{i}"), r=args.rank)
+
+    engines = {
+        "single": HFEngine(args.model_id, dtype=args.dtype, device="cpu"),
+        "mixed": HFEngine(args.model_id, dtype=args.dtype, device="cpu", multi_lora=True),
+    }
+    print(f"{'adapters':>8} {'single tok/s':>13} {'mixed tok/s':>12} {'speedup':>8}")
+    for n in counts:
+        tps = {}
+        for mode, engine in engines.items():
+            elapsed, tokens = asyncio.run(run_workload(engine, root, n, args))
+            tps[mode] = tokens / elapsed
+        print(f"{n:>8} {tps['single']:>13.1f} {tps['mixed']:>12.1f} {tps['mixed'] / tps['single']:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Decode throughput with speculative decoding off vs. the n-gram (prompt lookup) and
+draft-model proposers.
+
+    python tools/bench_spec_decode.py --model_id <tiny causal LM> [--draft_model_id <smaller LM>]
+
+Prompts are deliberately repetitive (code/lists), which is where prompt lookup pays off.
+Without --draft_model_id the target itself is used as draft, which gives an upper bound
+on acceptance but no speedup.
+"""
+import argparse
+import asyncio
+import time
+
+from lora_serve.core.engines.hf_engine import HFEngine
+from lora_serve.core.types import GenerateRequest
+
+PROMPTS = [
+    "def add(a, b):\n    return a + b\n\ndef sub(a, b):\n    return a - b\n\ndef mul(a, b):\n",
+    "1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16,",
+    "The cat sat on the mat. The dog sat on the mat. The bird sat on the",
+    "Monday, Tuesday, Wednesday, Thursday, Friday, Saturday, Sunday, Monday, Tuesday,",
+]
+
+
+def run(engine: HFEngine, args) -> tuple[float, int]:
+    reqs = [GenerateRequest(prompt=p, max_tokens=args.max_tokens, temperature=args.temperature, seed=i)
+            for i, p in enumerate(PROMPTS * args.repeat)]
+    start = time.perf_counter()
+    results = asyncio.run(engine.generate_batch(reqs))
+    return time.perf_counter() - start, sum(r.tokens for r in results)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model_id", required=True)
+    ap.add_argument("--draft_model_id", default=None)
+    ap.add_argument("--dtype", default="float32")
+    ap.add_argument("--max_tokens", type=int, default=64)
+    ap.add_argument("--max_draft_tokens", type=int, default=4)
+    ap.add_argument("--temperature", type=float, default=0.0)
+    ap.add_argument("--repeat", type=int, default=2)
+    args = ap.parse_args()
+
+    modes = {
+        "off": dict(spec_decode=False),
+        "ngram": dict(spec_decode=True, spec_proposer="ngram"),
+        "draft": dict(spec_decode=True, spec_proposer="draft", draft_model_id=args.draft_model_id or args.model_id),
+    }
+    print(f"{'mode':>6} {'tok/s':>8} {'speedup':>8} {'accept':>7}")
+    baseline = None
+    for mode, kw in modes.items():
+        engine = HFEngine(args.model_id, dtype=args.dtype, device="cpu",
+                          spec_max_draft_tokens=args.max_draft_tokens, **kw)
+        run(engine, args)  # warm up
+        elapsed, tokens = run(engine, args)
+        tps = tokens / elapsed
+        baseline = baseline or tps
+        rate = f"{engine.spec.rate:.2f}" if engine.spec else "-"
+        print(f"{mode:>6} {tps:>8.1f} {tps / baseline:>7.2f}x {rate:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""
+Fit a SimEngine cost model to a real engine: times prefills over a few prompt lengths,
+decode steps over a few batch sizes and, with --adapter, a cold attach and a re-select.
+
+    python tools/fit_cost_model.py --model_id <causal LM> [--adapter code=./examples/adapters/code] --out cost.json
+    python tools/bench_load.py --sim cost.json --num_requests 5000 --rate 500
+"""
+import argparse
+import asyncio
+from dataclasses import asdict
+
+from lora_serve.core.engines.hf_engine import HFEngine
+from lora_serve.core.engines.sim_engine import CostModel
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model_id", required=True)
+    ap.add_argument("--dtype", default="float32")
+    ap.add_argument("--device", default="cpu")
+    ap.add_argument("--multi_lora", action="store_true")
+    ap.add_argument("--adapter", default=None, help="id=path of an adapter to time attaching")
+    ap.add_argument("--out", default="cost.json")
+    args = ap.parse_args()
+
+    engine = HFEngine(args.model_id, dtype=args.dtype, device=args.device, multi_lora=args.multi_lora)
+    adapter = tuple(args.adapter.split("=", 1)) if args.adapter else None
+
+    async def fit():
+        await engine.warmup()
+        return await CostModel.profile(engine, adapter=adapter)
+
+    cost = asyncio.run(fit())
+    cost.save(args.out)
+    for name, value in asdict(cost).items():
+        print(f"{name:>24} {value:12.6g}")
+
+
+if __name__ == "__main__":
+    main()